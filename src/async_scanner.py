@@ -0,0 +1,256 @@
+"""
+Asyncio API for embedding the scanner in an event loop, such as a deployment orchestrator.
+
+    async with AsyncScanner() as scanner:
+        results = await scanner.scan_many(find_templates(["stacks"]))
+
+Settings are read from the same environment variables as `scanner.py`. Scans never exit the process: each one returns
+a `ScanResult`, with `error` set when the template couldn't be scanned. Requests are sent with `httpx`, which has to be
+installed for this API (`pip install httpx`), so many templates can be scanned concurrently on one event loop, through
+the proxies set in `HTTPS_PROXY` and `NO_PROXY`. Results are cached, rate limited and retried in the same way as in
+`scanner.py`.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from scanner import (
+    CONNECT_TIMEOUT,
+    CcValidator,
+    ErrorCapture,
+    ScanResult,
+    get_scan_endpoint,
+    merge_findings,
+    parse_retry_after,
+)
+
+
+class ScanError(Exception):
+    """Raised where `scanner.py` would log an error and exit."""
+
+
+class AsyncScanner:
+    """
+    Scans templates concurrently on the running event loop, with up to `max_concurrency` (default:
+    `CC_MAX_CONCURRENCY`) requests in flight. Reading, parsing and filtering reuse `CcValidator`, and are run in worker
+    threads so they never block the event loop.
+    """
+
+    def __init__(self, validator=None, max_concurrency=None):
+        # optional, as only this API needs it
+        try:
+            import httpx
+
+        except ImportError:
+            raise ScanError("The async scanner requires httpx. Please install it with `pip install httpx`") from None
+
+        self.error_capture = ErrorCapture()
+        logging.getLogger().addHandler(self.error_capture)
+
+        try:
+            self.validator = validator or self._call(CcValidator, template_required=False)
+
+        except ScanError:
+            logging.getLogger().removeHandler(self.error_capture)
+            raise
+
+        self.max_concurrency = max_concurrency or self.validator.max_concurrency
+        # like `requests`, proxies are taken from `HTTPS_PROXY` and `NO_PROXY`
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=max(self.max_concurrency, self.validator.pool_size)),
+            timeout=httpx.Timeout(self.validator.request_timeout, connect=CONNECT_TIMEOUT),
+            trust_env=True,
+        )
+        self._requests = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+        logging.getLogger().removeHandler(self.error_capture)
+
+    def _call(self, func, *args, **kwargs):
+        """Calls a blocking scanner function, raising `ScanError` with the logged reason instead of exiting."""
+        self.error_capture.start()
+
+        try:
+            return func(*args, **kwargs)
+
+        except SystemExit:
+            errors = self.error_capture.stop()
+            raise ScanError(errors[-1] if errors else "The scan failed") from None
+
+        finally:
+            self.error_capture.stop()
+
+    async def _call_in_thread(self, func, *args, **kwargs):
+        """Runs a blocking scanner function, such as reading or parsing a template, off the event loop, like `_call`."""
+        # the whole call runs in the worker thread, as the errors are captured per thread
+        return await asyncio.to_thread(self._call, func, *args, **kwargs)
+
+    async def _choose_region(self):
+        validator = self.validator
+
+        # the regions are probed with blocking requests, so the first choice is made off the event loop. Retries then
+        # choose from the probed regions without blocking
+        if validator.region_selector and not validator.region_selector.probed:
+            return await asyncio.to_thread(validator.choose_region)
+
+        return validator.choose_region()
+
+    async def _post(self, headers, body):
+        """
+        Sends a rate limited scan request, retried and failed over in the same way as `CcValidator._post`, but without
+        blocking the event loop.
+        """
+        import httpx
+
+        validator = self.validator
+        failed_regions = set()
+        region = await self._choose_region()
+
+        for attempt in range(validator.max_retries + 1):
+            while True:
+                wait = validator.rate_limiters[region].try_acquire()
+
+                if not wait:
+                    break
+
+                await asyncio.sleep(wait)
+
+            start = time.perf_counter()
+
+            try:
+                async with self._requests:
+                    resp = await self.client.post(get_scan_endpoint(region), headers=headers, content=body)
+
+            except httpx.TransportError as e:
+                validator.record_attempt(region, time.perf_counter() - start, len(body), type(e).__name__)
+                retry = validator.get_retry(attempt, region, failed_regions, error=e)
+
+                if retry is None:
+                    raise ScanError(f"Unable to connect to Conformity after {attempt + 1} attempt(s): {e!r}") from e
+
+            else:
+                request_metrics = validator.record_attempt(
+                    region, time.perf_counter() - start, len(body), resp.status_code
+                )
+                validator.metrics.record_bytes_received(request_metrics, len(resp.content))
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                retry = validator.get_retry(attempt, region, failed_regions, resp.status_code, retry_after=retry_after)
+
+                if retry is None:
+                    return resp
+
+            region, delay = retry
+
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def run_validation(self, payload):
+        validator = self.validator
+        cache_key = validator.get_cache_key(payload)
+
+        if cache_key:
+            # the cache is on disk, so it's read and written off the event loop
+            cached_resp_text = await asyncio.to_thread(validator.cache.get, cache_key)
+
+            if cached_resp_text is not None:
+                logging.info("Using cached scan results for unchanged template")
+                validator.metrics.record_cache_hit()
+                return json.loads(cached_resp_text)
+
+        headers, request_body = await asyncio.to_thread(validator.build_request, payload)
+        resp = await self._post(headers, request_body)
+
+        try:
+            resp_json = json.loads(resp.text)
+
+        except ValueError:
+            raise ScanError(f"Conformity returned an invalid response (HTTP {resp.status_code}): {resp.text[:200]}")
+
+        self._call(validator.check_response, resp_json)
+
+        if "data" not in resp_json:
+            raise ScanError(f"Conformity returned no findings (HTTP {resp.status_code}): {resp.text[:200]}")
+
+        # only complete scans are cached so errors are retried on the next run
+        if cache_key and not resp_json.get("errors"):
+            # setting an entry may also scan the whole cache directory to evict old entries
+            await asyncio.to_thread(validator.cache.set, cache_key, resp.text)
+
+        return resp_json
+
+    async def run_validations(self, payloads):
+        """Scans the payloads of a split template concurrently and merges their findings."""
+        chunk_findings = await asyncio.gather(*(self.run_validation(payload) for payload in payloads))
+
+        return chunk_findings[0] if len(chunk_findings) == 1 else merge_findings(chunk_findings)
+
+    async def _scan(self, cfn_template_file_location):
+        validator = self.validator
+        cfn_template = await self._call_in_thread(validator.read_template, cfn_template_file_location)
+        local_entries = []
+
+        if validator.local_rules != "disabled":
+            local_entries = await self._call_in_thread(validator.run_local_rules, cfn_template)
+
+        if validator.skip_conformity_scan(local_entries):
+            findings = {"data": local_entries}
+
+        else:
+            contents = await self._call_in_thread(validator.split_template_contents, cfn_template)
+            profile_findings = await asyncio.gather(
+                *(
+                    self.run_validations([validator.generate_payload(chunk, cc_profile_id) for chunk in contents])
+                    for cc_profile_id, _ in validator.profiles
+                )
+            )
+            findings = (
+                profile_findings[0]
+                if len(profile_findings) == 1
+                else validator.merge_profile_findings(profile_findings)
+            )
+            findings["data"] = local_entries + list(findings["data"])
+
+        result = ScanResult(template=cfn_template_file_location)
+        result.offending_entries = await self._call_in_thread(
+            validator.get_results, findings, output_file=None, index=result.findings
+        )
+
+        if result.offending_entries:
+            result.fail_pipeline = await self._call_in_thread(validator._fail_pipeline, cfn_template)
+
+        return result
+
+    async def scan(self, cfn_template_file_location):
+        """Scans a template. Returns a `ScanResult`, with `error` set instead of exiting if the scan fails."""
+        try:
+            return await self._scan(cfn_template_file_location)
+
+        # a template which can't be read, parsed or checked only fails its own scan, not the others in `scan_many`
+        except (ScanError, ValueError, KeyError, OSError, AttributeError) as e:
+            logging.error(f"Unable to scan {cfn_template_file_location}: {e}")
+            return ScanResult(template=cfn_template_file_location, error=str(e))
+
+    async def scan_many(self, templates):
+        """Scans templates concurrently. Results are returned in input order."""
+        return list(await asyncio.gather(*(self.scan(template) for template in templates)))
+
+
+async def scan(cfn_template_file_location, **kwargs):
+    """Scans a single template with a new `AsyncScanner`."""
+    async with AsyncScanner(**kwargs) as scanner:
+        return await scanner.scan(cfn_template_file_location)
+
+
+async def scan_many(templates, **kwargs):
+    """Scans templates concurrently with a new `AsyncScanner`."""
+    async with AsyncScanner(**kwargs) as scanner:
+        return await scanner.scan_many(templates)
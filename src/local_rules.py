@@ -0,0 +1,255 @@
+"""
+Offline rules which pre-screen CloudFormation templates for common misconfigurations.
+
+Rules are registered with the `local_rule` decorator. Each is called with a resource's logical ID, type and
+`Properties` and returns a message when the resource is misconfigured, or `None` when it passes. Values which are
+intrinsic functions (e.g. `{"Ref": ...}`) can't be resolved offline, so rules treat them as passing.
+
+Results use the same shape as Conformity's check entries, so `CcValidator.get_results` can filter them like any
+other finding.
+"""
+
+from dataclasses import dataclass
+
+PRETTY_RISK_LEVELS = {
+    "LOW": "Low",
+    "MEDIUM": "Medium",
+    "HIGH": "High",
+    "VERY_HIGH": "Very High",
+    "EXTREME": "Extreme",
+}
+
+PUBLIC_S3_ACLS = ("PublicRead", "PublicReadWrite", "AuthenticatedRead")
+ADMIN_PORTS = (22, 3389)
+OPEN_CIDRS = ("0.0.0.0/0", "::/0")
+
+
+@dataclass
+class LocalRule:
+    rule_id: str
+    title: str
+    risk_level: str
+    resource_types: tuple
+    check: object
+    categories: tuple = ("security",)
+
+
+LOCAL_RULES = []
+
+
+def local_rule(rule_id, title, risk_level, resource_types, categories=("security",)):
+    """Registers the decorated function as a rule for the given resource types."""
+
+    def decorator(check):
+        LOCAL_RULES.append(LocalRule(rule_id, title, risk_level, tuple(resource_types), check, tuple(categories)))
+        return check
+
+    return decorator
+
+
+def is_intrinsic(value):
+    return isinstance(value, dict) and len(value) == 1 and next(iter(value)).startswith(("Ref", "Fn::", "Condition"))
+
+
+def is_false(value):
+    return not is_intrinsic(value) and str(value).lower() == "false"
+
+
+@local_rule("LOCAL-S3-001", "S3 Bucket Public Access Via ACL", "VERY_HIGH", ["AWS::S3::Bucket"])
+def s3_public_acl(logical_id, resource_type, properties):
+    access_control = properties.get("AccessControl")
+
+    if access_control in PUBLIC_S3_ACLS:
+        return f"Bucket {logical_id} grants public access with the '{access_control}' canned ACL"
+
+
+@local_rule("LOCAL-S3-002", "S3 Bucket Public Access Block", "HIGH", ["AWS::S3::Bucket"])
+def s3_public_access_block(logical_id, resource_type, properties):
+    block_config = properties.get("PublicAccessBlockConfiguration")
+
+    if block_config is None:
+        return f"Bucket {logical_id} does not have a public access block configuration"
+
+    if is_intrinsic(block_config):
+        return None
+
+    settings = ("BlockPublicAcls", "BlockPublicPolicy", "IgnorePublicAcls", "RestrictPublicBuckets")
+    disabled = [setting for setting in settings if setting not in block_config or is_false(block_config[setting])]
+
+    if disabled:
+        return f"Bucket {logical_id} does not enable {', '.join(disabled)}"
+
+
+@local_rule("LOCAL-S3-003", "S3 Bucket Default Encryption", "HIGH", ["AWS::S3::Bucket"])
+def s3_default_encryption(logical_id, resource_type, properties):
+    if "BucketEncryption" not in properties:
+        return f"Bucket {logical_id} does not have default encryption enabled"
+
+
+@local_rule("LOCAL-S3-004", "S3 Bucket Versioning Enabled", "LOW", ["AWS::S3::Bucket"], ["reliability"])
+def s3_versioning(logical_id, resource_type, properties):
+    versioning = properties.get("VersioningConfiguration")
+
+    if versioning is None or (isinstance(versioning, dict) and versioning.get("Status") == "Suspended"):
+        return f"Bucket {logical_id} does not have versioning enabled"
+
+
+def _open_admin_ports(rules):
+    if not isinstance(rules, list):
+        return []
+
+    open_ports = []
+
+    for rule in rules:
+        if not isinstance(rule, dict) or is_intrinsic(rule):
+            continue
+
+        cidr = rule.get("CidrIp", rule.get("CidrIpv6"))
+
+        if cidr not in OPEN_CIDRS:
+            continue
+
+        try:
+            protocol = str(rule.get("IpProtocol", "-1"))
+            from_port = int(rule.get("FromPort", 0))
+            to_port = int(rule.get("ToPort", 65535))
+
+        except (TypeError, ValueError):
+            continue
+
+        if protocol == "-1":
+            from_port, to_port = 0, 65535
+
+        elif protocol.lower() not in ("tcp", "6"):
+            continue
+
+        open_ports.extend(port for port in ADMIN_PORTS if from_port <= port <= to_port)
+
+    return open_ports
+
+
+@local_rule(
+    "LOCAL-EC2-001",
+    "Unrestricted Admin Port Access",
+    "VERY_HIGH",
+    ["AWS::EC2::SecurityGroup", "AWS::EC2::SecurityGroupIngress"],
+)
+def security_group_admin_ports(logical_id, resource_type, properties):
+    # standalone ingress resources hold a single rule in their properties
+    rules = properties.get("SecurityGroupIngress", [properties])
+    open_ports = _open_admin_ports(rules)
+
+    if open_ports:
+        ports = ", ".join(str(port) for port in sorted(set(open_ports)))
+        return f"Security group {logical_id} allows unrestricted inbound access on port(s) {ports}"
+
+
+@local_rule("LOCAL-RDS-001", "RDS Encryption Enabled", "HIGH", ["AWS::RDS::DBInstance", "AWS::RDS::DBCluster"])
+def rds_encryption(logical_id, resource_type, properties):
+    # instances in an Aurora cluster inherit the cluster's encryption setting, while a cluster's identifier is its name
+    if resource_type == "AWS::RDS::DBInstance" and "DBClusterIdentifier" in properties:
+        return None
+
+    storage_encrypted = properties.get("StorageEncrypted", False)
+
+    if not is_intrinsic(storage_encrypted) and str(storage_encrypted).lower() != "true":
+        return f"Database {logical_id} does not have storage encryption enabled"
+
+
+@local_rule("LOCAL-RDS-002", "RDS Publicly Accessible", "VERY_HIGH", ["AWS::RDS::DBInstance"])
+def rds_publicly_accessible(logical_id, resource_type, properties):
+    publicly_accessible = properties.get("PubliclyAccessible", False)
+
+    if not is_intrinsic(publicly_accessible) and str(publicly_accessible).lower() == "true":
+        return f"Database {logical_id} is publicly accessible"
+
+
+@local_rule("LOCAL-EBS-001", "EBS Encrypted", "HIGH", ["AWS::EC2::Volume"])
+def ebs_encryption(logical_id, resource_type, properties):
+    encrypted = properties.get("Encrypted", False)
+
+    if not is_intrinsic(encrypted) and str(encrypted).lower() != "true":
+        return f"Volume {logical_id} is not encrypted"
+
+
+def _policy_documents(resource_type, properties):
+    if resource_type == "AWS::IAM::Role":
+        return [policy.get("PolicyDocument") for policy in properties.get("Policies", []) if isinstance(policy, dict)]
+
+    return [properties.get("PolicyDocument")]
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+@local_rule(
+    "LOCAL-IAM-001",
+    "IAM Policy Grants Full Administrative Privileges",
+    "VERY_HIGH",
+    ["AWS::IAM::Policy", "AWS::IAM::ManagedPolicy", "AWS::IAM::Role"],
+)
+def iam_admin_privileges(logical_id, resource_type, properties):
+    for document in _policy_documents(resource_type, properties):
+        if not isinstance(document, dict):
+            continue
+
+        for statement in _as_list(document.get("Statement", [])):
+            if not isinstance(statement, dict) or statement.get("Effect") != "Allow":
+                continue
+
+            if "*" in _as_list(statement.get("Action")) and "*" in _as_list(statement.get("Resource")):
+                return f"{logical_id} allows all actions on all resources"
+
+
+def make_entry(rule, logical_id, resource_type, message):
+    return {
+        "attributes": {
+            "categories": list(rule.categories),
+            "descriptorType": resource_type,
+            "local": True,
+            "message": message or f"{logical_id} passed {rule.title}",
+            "pretty-risk-level": PRETTY_RISK_LEVELS[rule.risk_level],
+            "provider": "aws",
+            "resource": logical_id,
+            "risk-level": rule.risk_level,
+            "rule-title": rule.title,
+            "status": "FAILURE" if message else "SUCCESS",
+        },
+        "id": f"local:{rule.rule_id}:{logical_id}",
+        "relationships": {"rule": {"data": {"id": rule.rule_id, "type": "rules"}}},
+        "type": "checks",
+    }
+
+
+def evaluate_local_rules(template, rules=None):
+    """Runs `rules` (default: every registered rule) against a parsed template and returns their check entries."""
+    rules = LOCAL_RULES if rules is None else rules
+    resources = template.get("Resources") if isinstance(template, dict) else None
+
+    if not isinstance(resources, dict):
+        return []
+
+    rules_by_type = {}
+
+    for rule in rules:
+        for resource_type in rule.resource_types:
+            rules_by_type.setdefault(resource_type, []).append(rule)
+
+    entries = []
+
+    for logical_id, resource in resources.items():
+        if not isinstance(resource, dict):
+            continue
+
+        resource_type = resource.get("Type")
+        properties = resource.get("Properties") or {}
+
+        if not isinstance(properties, dict):
+            continue
+
+        for rule in rules_by_type.get(resource_type, []):
+            message = rule.check(logical_id, resource_type, properties)
+            entries.append(make_entry(rule, logical_id, resource_type, message))
+
+    return entries
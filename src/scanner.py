@@ -1,13 +1,77 @@
 import os
+import re
 import sys
-import requests
+import glob
+import time
+import random
+import codecs
+import functools
+import tempfile
+import threading
+from contextlib import contextmanager
 import json
-import yaml
 import logging
+import itertools
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 
+# slower imports such as `requests` and `yaml` are deferred to the functions which need them, so invocations which
+# fail fast on a missing environment variable, or never parse YAML, don't pay for them at startup
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 OUTPUT_FILE = "findings.json"
+DEFAULT_BASELINE_FILE = "baseline.json"
+DEFAULT_JOURNAL_FILE = "findings.journal.jsonl"
+
+CC_API_ENDPOINT = "https://{region}-api.cloudconformity.com"
+CC_SCAN_PATH = "/v1/iac-scanning/scan"
+
+OUTPUT_FORMATS = ("json", "jsonl")
+
+TEMPLATE_EXTENSIONS = (".json", ".yaml", ".yml")
+
+LOCAL_RULES_MODES = ("disabled", "enabled", "fail-fast", "only")
+
+TEMPLATE_DETECTION_MODES = ("enabled", "strict", "disabled")
+TEMPLATE_DETECTION_BYTES = 64 * 1024
+RESOURCES_KEY_REGEX = re.compile(r'(?:^|[{,\s])"?Resources"?\s*:', re.MULTILINE)
+
+SPLIT_TEMPLATE_KEYS = ("AWSTemplateFormatVersion", "Description", "Transform")
+SPLIT_TEMPLATE_SECTIONS = ("Parameters", "Mappings", "Conditions")
+SUB_REFERENCE_REGEX = re.compile(r"\$\{([A-Za-z0-9:]+)(?:\.[^}]*)?\}")
+
+NESTED_STACK_MODES = ("disabled", "enabled")
+NESTED_STACK_TYPE = "AWS::CloudFormation::Stack"
+REMOTE_URL_REGEX = re.compile(r"^[a-z][a-z0-9+.-]*://", re.IGNORECASE)
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Conformity allows short bursts but throttles sustained traffic, so start conservatively and adapt
+DEFAULT_RATE_LIMIT = 5.0
+DEFAULT_MAX_RETRIES = 5
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_CAP = 30.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# a stalled connection is retried like a failed one, rather than blocking its worker and the batch forever
+CONNECT_TIMEOUT = 10.0
+DEFAULT_REQUEST_TIMEOUT = 120.0
+
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+REGION_LATENCY_WEIGHT = 0.3
+REGION_ERROR_PENALTY = 10.0
+REGION_ERROR_HALF_LIFE = 60.0
+REGION_PROBE_TIMEOUT = 5.0
+
+# a crash loses at most the journal records written since the last sync, whose templates are scanned again on resume
+JOURNAL_SYNC_INTERVAL = 1.0
+JOURNAL_SYNC_RECORDS = 64
+
+DEFAULT_CACHE_DIR = ".cc-cache"
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_MAX_SIZE = 100 * 1024 * 1024
 
 CC_REGIONS = [
     "eu-west-1",
@@ -24,115 +88,2141 @@ RISK_LEVEL_NUMS = {
 }
 
 
-class CcValidator:
-    def __init__(self):
+RISK_LEVELS = {risk_level_num: risk_level for risk_level, risk_level_num in RISK_LEVEL_NUMS.items()}
+
+
+class FindingsIndex:
+    """
+    Failing check entries, indexed in a single pass by risk level, rule ID, resource and category, so thresholds,
+    summaries and reports can be queried without walking the entries again. Passing entries are only counted.
+
+    Indexes map each key to the positions of its entries in `entries`, so queries return entries in the order they
+    were added. Failing entries accepted in the baseline aren't indexed, but are kept in `suppressed` so the findings
+    can be filtered again against a different baseline.
+    """
+
+    INDEXES = ("by_risk_level", "by_rule", "by_resource", "by_category")
+
+    def __init__(self):
+        self.entries = []
+        self.suppressed = []
+        self.passed = 0
+        self.by_risk_level = {}
+        self.by_rule = {}
+        self.by_resource = {}
+        self.by_category = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def rule_id(entry):
+        return entry.get("relationships", {}).get("rule", {}).get("data", {}).get("id")
+
+    def add(self, entry):
+        """Indexes an entry. Returns its risk level number if it failed, or `None` if it passed."""
+        attributes = entry["attributes"]
+
+        if attributes["status"] == "SUCCESS":
+            self.passed += 1
+            return None
+
+        risk_level_num = RISK_LEVEL_NUMS[attributes["risk-level"]]
+        position = len(self.entries)
+        self.entries.append(entry)
+
+        self.by_risk_level.setdefault(risk_level_num, []).append(position)
+        self.by_rule.setdefault(self.rule_id(entry), []).append(position)
+        self.by_resource.setdefault(attributes.get("resource"), []).append(position)
+
+        for category in attributes.get("categories") or []:
+            self.by_category.setdefault(category, []).append(position)
+
+        return risk_level_num
+
+    def update(self, other):
+        """Adds another index's entries, reusing its indexes rather than indexing each entry again."""
+        offset = len(self.entries)
+        self.entries.extend(other.entries)
+        self.suppressed.extend(other.suppressed)
+        self.passed += other.passed
+
+        for name in self.INDEXES:
+            index = getattr(self, name)
+
+            for key, positions in getattr(other, name).items():
+                index.setdefault(key, []).extend(position + offset for position in positions)
+
+    def select(self, risk_level=None, rule_id=None, resource=None, category=None):
+        """Returns the failing entries at or above `risk_level` which match every other filter that is given."""
+        positions = None
+
+        if risk_level is not None:
+            risk_level_num = RISK_LEVEL_NUMS[risk_level] if isinstance(risk_level, str) else risk_level
+            positions = set().union(
+                *(level_positions for level, level_positions in self.by_risk_level.items() if level >= risk_level_num)
+            )
+
+        for index, key in ((self.by_rule, rule_id), (self.by_resource, resource), (self.by_category, category)):
+            if key is not None:
+                key_positions = set(index.get(key, ()))
+                positions = key_positions if positions is None else positions & key_positions
+
+        if positions is None:
+            return list(self.entries)
+
+        return [self.entries[position] for position in sorted(positions)]
+
+    def summary(self):
+        """Returns the number of failing entries per risk level, rule, resource and category."""
+        return {
+            "failed": len(self.entries),
+            "passed": self.passed,
+            "risk_levels": {
+                RISK_LEVELS[risk_level_num]: len(positions)
+                for risk_level_num, positions in sorted(self.by_risk_level.items(), reverse=True)
+            },
+            "rules": {rule_id: len(positions) for rule_id, positions in self.by_rule.items()},
+            "resources": {resource: len(positions) for resource, positions in self.by_resource.items()},
+            "categories": {category: len(positions) for category, positions in self.by_category.items()},
+        }
+
+
+class Baseline:
+    """
+    Accepted findings which are never reported as offending, matched by entry ID or by rule ID and resource.
+
+    Both are held in sets, so checking an entry takes the same time however many findings have been accepted.
+    """
+
+    def __init__(self, ids=(), rules=()):
+        self.ids = set(ids)
+        self.rules = set(rules)
+
+    def __len__(self):
+        return len(self.ids) + len(self.rules)
+
+    def __contains__(self, entry):
+        if entry.get("id") in self.ids:
+            return True
+
+        return bool(self.rules) and (FindingsIndex.rule_id(entry), entry["attributes"].get("resource")) in self.rules
+
+    @classmethod
+    def from_entries(cls, entries):
+        return cls(ids=(entry["id"] for entry in entries))
+
+    @classmethod
+    def load(cls, baseline_file):
+        """Loads a baseline file. Exits if it can't be read, so a typo never silently un-suppresses every finding."""
+        try:
+            with open(baseline_file, "r") as f:
+                baseline = json.load(f)
+
+            return cls(
+                ids=baseline.get("ids", []),
+                rules=((rule["rule"], rule.get("resource")) for rule in baseline.get("rules", [])),
+            )
+
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logging.critical(f"Unable to read the baseline file {baseline_file}: {e}")
+            sys.exit(1)
+
+    def write(self, baseline_file):
+        baseline = {
+            "ids": sorted(self.ids),
+            "rules": [{"rule": rule_id, "resource": resource} for rule_id, resource in sorted(self.rules, key=str)],
+        }
+
+        with open(baseline_file, "w") as f:
+            json.dump(baseline, f, indent=4)
+
+
+@dataclass
+class ScanResult:
+    template: str
+    offending_entries: list = field(default_factory=list)
+    fail_pipeline: bool = False
+    findings: FindingsIndex = field(default_factory=FindingsIndex)
+    # with `CC_NESTED_STACKS`, the local templates of the template's nested stacks, at any depth
+    nested_templates: list = field(default_factory=list)
+    # set instead of exiting by callers which embed the scanner, such as the async API
+    error: str = None
+
+
+class ScanJournal:
+    """
+    Append-only JSON Lines journal of the templates scanned in a batch. Each record has the template's path, content
+    hash and every failing entry, including those accepted in the baseline, so its findings can be filtered again with
+    a different risk level or baseline. Records also have the fingerprint of the `settings` which change the entries
+    themselves, and are only reused with the same settings. Records are flushed and fsynced in groups, every
+    `sync_records` records or `sync_interval` seconds, rather than one by one.
+
+    With `resume`, the records of an interrupted run are reused and new records are appended to them. With
+    `changed_files`, the records of the previous run are reused for unchanged templates, and the journal is rewritten.
+    """
+
+    def __init__(
+        self,
+        path,
+        resume=False,
+        changed_files=None,
+        settings=None,
+        sync_interval=JOURNAL_SYNC_INTERVAL,
+        sync_records=JOURNAL_SYNC_RECORDS,
+    ):
+        self.path = path
+        self.resume = resume
+        self.changed_files = changed_files
+        self.settings = settings
+        self.num_reused = 0
+        self.num_missed = 0
+        self._settings_changed = False
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.completed = self.load(path) if resume or changed_files is not None else {}
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @staticmethod
+    def load(path):
+        """Returns the latest record of every template in the journal at `path`, keyed by absolute path."""
+        completed = {}
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+
+                    # the last record may have been cut short when the run was interrupted
+                    except ValueError:
+                        continue
+
+                    completed[os.path.abspath(record["template"])] = record
+
+        except FileNotFoundError:
+            logging.warning(f"No journal found at {path}. Every template will be scanned")
+
+        return completed
+
+    def get(self, template, content_hash):
+        """Returns the previous record of a template, unless the template has changed since."""
+        record = self.completed.get(os.path.abspath(template))
+        settings_changed = record is not None and record.get("settings") != self.settings
+
+        # an interrupted run has already rescanned the changed templates it recorded
+        changed = not self.resume and self.changed_files is not None and os.path.abspath(template) in self.changed_files
+
+        if record is None or record["hash"] != content_hash or settings_changed or changed:
+            record = None
+
+        with self._lock:
+            if settings_changed and not self._settings_changed:
+                logging.warning(
+                    f"Templates in the journal {self.path} were scanned with different settings, such as "
+                    f"CC_PROFILE_ID, CC_REGION, CC_API_KEY, CC_LOCAL_RULES or CC_SPLIT_RESOURCES. They will be "
+                    f"scanned again"
+                )
+
+            self._settings_changed = self._settings_changed or settings_changed
+
+            if record is None:
+                self.num_missed += 1
+
+            else:
+                self.num_reused += 1
+
+        return record
+
+    def append(self, result, content_hash):
+        record = {
+            "template": result.template,
+            "hash": content_hash,
+            "settings": self.settings,
+            "entries": result.findings.entries + result.findings.suppressed,
+            "passed": result.findings.passed,
+        }
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+
+        with self._lock:
+            self._file.write(line)
+            self._unsynced += 1
+
+            if self._unsynced >= self.sync_records or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+
+            if self._unsynced:
+                self._sync()
+
+            self._file.close()
+
+
+class ScanCoalescer:
+    """
+    Shares scans between templates with the same contents during a batch. The first template with a content hash is
+    scanned, and every other template with that hash waits for its result, even while it's still being scanned.
+    """
+
+    def __init__(self):
+        self.scans = {}
+        self._lock = threading.Lock()
+
+    def claim(self, content_hash):
+        """Returns the scan of `content_hash`, and whether the caller has claimed it and has to run it."""
+        with self._lock:
+            if content_hash in self.scans:
+                return self.scans[content_hash], False
+
+            self.scans[content_hash] = scan = Future()
+
+            return scan, True
+
+
+def get_float_env(name, default):
+    try:
+        value = float(os.getenv(name, default))
+
+        if value <= 0:
+            raise ValueError
+
+    except ValueError:
+        logging.critical(f'Please ensure "{name}" is set to a positive number')
+        sys.exit(1)
+
+    return value
+
+
+def get_int_env(name, default, minimum=1):
+    try:
+        value = int(os.getenv(name, default))
+
+        if value < minimum:
+            raise ValueError
+
+    except ValueError:
+        qualifier = "a positive" if minimum == 1 else "an"
+        logging.critical(f'Please ensure "{name}" is set to {qualifier} integer')
+        sys.exit(1)
+
+    return value
+
+
+def parse_profiles(profile_ids, default_risk_level_num):
+    """
+    Parses `CC_PROFILE_ID`: profile IDs separated by commas, each optionally followed by the risk level at which its
+    findings are offending, e.g. `prod:HIGH,pci:LOW`. Returns `(profile_id, risk_level_num)` pairs. Raises `KeyError`
+    for an unknown risk level.
+    """
+    profiles = []
+
+    for profile in profile_ids.split(","):
+        profile_id, _, risk_level = profile.partition(":")
+        risk_level_num = RISK_LEVEL_NUMS[risk_level.strip().upper()] if risk_level.strip() else default_risk_level_num
+        profiles.append((profile_id.strip(), risk_level_num))
+
+    return profiles
+
+
+def get_scan_endpoint(cc_region):
+    """Returns the scan endpoint for a region. `CC_API_ENDPOINT` overrides the API, e.g. for a local test server."""
+    api_endpoint = os.getenv("CC_API_ENDPOINT", CC_API_ENDPOINT).rstrip("/")
+
+    return api_endpoint.format(region=cc_region) + CC_SCAN_PATH
+
+
+def get_rate_limit(cc_region):
+    """Returns the requests per second for a region, e.g. `CC_RATE_LIMIT_US_WEST_2`, falling back to `CC_RATE_LIMIT`."""
+    region_env_var = "CC_RATE_LIMIT_" + cc_region.upper().replace("-", "_")
+    default = os.getenv("CC_RATE_LIMIT", DEFAULT_RATE_LIMIT)
+
+    return get_float_env(region_env_var, default)
+
+
+def parse_retry_after(retry_after):
+    """Returns the number of seconds to wait from a `Retry-After` header, which is either seconds or an HTTP date."""
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+
+    except ValueError:
+        pass
+
+    import email.utils
+
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def get_retry_delay(attempt, retry_after=None):
+    """Returns how long to wait before retrying a request: full jitter backoff, or `Retry-After` if it's longer."""
+    backoff = random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2**attempt))
+
+    return max(backoff, retry_after or 0)
+
+
+class TokenBucket:
+    """Thread safe token bucket which halves its rate when throttled and slowly recovers after successful requests."""
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Takes a token if one is available. Returns 0, or the number of seconds to wait before trying again."""
+        with self.lock:
+            self._refill()
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+
+            if not wait:
+                return
+
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+        logging.warning(f"Conformity API is throttling requests. Reducing the request rate to {self.rate:.2f}/s")
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RegionSelector:
+    """
+    Rolling latency and error rate of each Conformity region an account may use, to send scans to the healthiest.
+
+    Latency and error rate are exponentially weighted moving averages. A region is scored by its latency plus up to
+    `REGION_ERROR_PENALTY` seconds for its error rate. The penalty halves every `REGION_ERROR_HALF_LIFE` seconds, so a
+    region which failed is tried again once it has had time to recover. Ties go to the region listed first.
+    """
+
+    def __init__(self, regions):
+        self.regions = list(regions)
+        self.latency = {region: None for region in self.regions}
+        self.error_rate = {region: 0.0 for region in self.regions}
+        self.last_error = {region: 0.0 for region in self.regions}
+        self.probed = False
+        self.lock = threading.Lock()
+
+    def record(self, region, latency, ok):
+        with self.lock:
+            previous_latency = self.latency[region]
+
+            if previous_latency is None:
+                self.latency[region] = latency
+
+            else:
+                self.latency[region] = previous_latency + REGION_LATENCY_WEIGHT * (latency - previous_latency)
+
+            self.error_rate[region] += REGION_LATENCY_WEIGHT * ((0.0 if ok else 1.0) - self.error_rate[region])
+
+            if not ok:
+                self.last_error[region] = time.monotonic()
+
+    def score(self, region):
+        decay = 0.5 ** ((time.monotonic() - self.last_error[region]) / REGION_ERROR_HALF_LIFE)
+
+        return (self.latency[region] or 0.0) + REGION_ERROR_PENALTY * self.error_rate[region] * decay
+
+    def choose(self, exclude=()):
+        """Returns the healthiest region, skipping `exclude` unless every region has been excluded."""
+        candidates = [region for region in self.regions if region not in exclude] or self.regions
+
+        with self.lock:
+            return min(candidates, key=self.score)
+
+    def probe(self, session):
+        """Times a request to every region concurrently. Any HTTP response counts as the region being reachable."""
+
+        def probe_region(region):
+            start = time.perf_counter()
+
+            try:
+                session.get(get_scan_endpoint(region), timeout=REGION_PROBE_TIMEOUT).close()
+
+            except OSError as e:
+                logging.warning(f"Unable to reach the Conformity API in {region}: {e}")
+                self.record(region, REGION_PROBE_TIMEOUT, ok=False)
+
+            else:
+                self.record(region, time.perf_counter() - start, ok=True)
+
+        with ThreadPoolExecutor(max_workers=len(self.regions)) as executor:
+            list(executor.map(probe_region, self.regions))
+
+        self.probed = True
+        scores = ", ".join(f"{region}: {self.score(region) * 1000:.0f}ms" for region in self.regions)
+        logging.info(f"Probed the Conformity regions: {scores}")
+
+
+class JsonStreamParser:
+    """
+    Incrementally parses a JSON object from an iterable of byte chunks.
+
+    Top level members are decoded as they are reached. The array stored under `array_key` isn't decoded up front,
+    it's replaced by a generator which decodes and yields one item at a time as it is consumed. Members which follow
+    the array are added to the returned dict once the generator is exhausted.
+    """
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        # drop the consumed part of the buffer so only the item being decoded is held in memory
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+
+        try:
+            self._buffer += self._utf8_decoder.decode(next(self._chunks))
+
+        except StopIteration:
+            self._buffer += self._utf8_decoder.decode(b"", final=True)
+            self._eof = True
+
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in self.WHITESPACE:
+                self._pos += 1
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at position {self._pos} of the response")
+
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+
+                # a value which ends with the buffer may be a truncated number, so read on until it's delimited
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+
+            self._fill()
+
+    def _members(self, result, array_key):
+        while self._peek() != "}":
+            key = self._value()
+            self._expect(":")
+
+            if key == array_key and self._peek() == "[":
+                result[key] = self._items(result)
+                return
+
+            result[key] = self._value()
+
+            if self._peek() == ",":
+                self._pos += 1
+
+        self._expect("}")
+
+        # read to the end so the underlying chunk iterator (e.g. a cache writer) sees the whole response
+        if self._peek():
+            raise ValueError(f"Unexpected data at position {self._pos} of the response")
+
+    def _items(self, result):
+        self._expect("[")
+
+        while self._peek() != "]":
+            yield self._value()
+
+            if self._peek() == ",":
+                self._pos += 1
+
+        self._expect("]")
+
+        if self._peek() == ",":
+            self._pos += 1
+
+        self._members(result, array_key=None)
+
+    def parse(self, array_key="data"):
+        result = {}
+        self._expect("{")
+        self._members(result, array_key)
+
+        return result
+
+
+class ScanCache:
+    """
+    On-disk cache of raw scan responses, keyed by a hash of the template contents, profile ID, region and API key. The
+    key's account is part of the hash, so jobs with different API keys on a shared agent never share responses.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def key(cfn_template_contents, cc_profile_id, cc_region, api_key):
+        import hashlib
+
+        digest = hashlib.sha256()
+        api_key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+        for part in (api_key_hash, cc_region, cc_profile_id, cfn_template_contents):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _fresh_path(self, key):
+        cache_path = self._path(key)
+
+        try:
+            if time.time() - os.path.getmtime(cache_path) > self.ttl:
+                os.remove(cache_path)
+                return None
+
+        except FileNotFoundError:
+            return None
+
+        return cache_path
+
+    def get(self, key):
+        cache_path = self._fresh_path(key)
+
+        try:
+            with open(cache_path, "r") as f:
+                return f.read()
+
+        except (TypeError, FileNotFoundError):
+            return None
+
+    def get_chunks(self, key):
+        """Returns a generator over the cached response in chunks, or `None` if the response isn't cached."""
+        cache_path = self._fresh_path(key)
+
+        try:
+            f = open(cache_path, "rb")
+
+        except (TypeError, FileNotFoundError):
+            return None
+
+        def read_chunks():
+            with f:
+                yield from iter(lambda: f.read(RESPONSE_CHUNK_SIZE), b"")
+
+        return read_chunks()
+
+    def _temp_file(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write to a temporary file first so concurrent readers never see a partial response
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+
+        return os.fdopen(fd, "wb"), tmp_path
+
+    def _commit(self, key, tmp_path):
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def set(self, key, resp_text):
+        f, tmp_path = self._temp_file()
+
+        with f:
+            f.write(resp_text.encode("utf-8"))
+
+        self._commit(key, tmp_path)
+
+    def tee(self, key, chunks):
+        """Yields `chunks` while writing them to the cache. The response is only cached if it's read in full."""
+        f, tmp_path = self._temp_file()
+
+        try:
+            with f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self._commit(key, tmp_path)
+
+    def evict(self):
+        """Removes expired entries, then the oldest entries until the cache fits in `max_size` bytes."""
+        entries = []
+        now = time.time()
+
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+
+            try:
+                stat = entry.stat()
+
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(entry.path)
+                    continue
+
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, cache_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(cache_path)
+
+            except FileNotFoundError:
+                pass
+
+            total_size -= size
+
+
+class FindingsWriter:
+    """
+    Streams offending entries to disk as they are found so the whole document is never held in memory.
+
+    Entries are written as a JSON array with escaped quotes removed, or as one entry per line when the output format
+    is `jsonl`. Grouped output is keyed by template, with each template's entries written consecutively. The file is
+    only created once the first template or entry is written.
+    """
+
+    def __init__(self, output_file=OUTPUT_FILE, output_format="json", grouped=False):
+        self.output_file = output_file
+        self.output_format = output_format
+        self.grouped = grouped
+        self.num_entries = 0
+        self._file = None
+        self._template = None
+        self._template_entries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _dumps(obj, indent=None):
+        return json.dumps(obj, sort_keys=True, indent=indent).replace(r"\"", "")
+
+    @staticmethod
+    def _indent(text, level):
+        return text.replace("\n", "\n" + " " * 4 * level)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.output_file, "w")
+
+            if self.output_format == "json":
+                self._file.write("{" if self.grouped else "[")
+
+    def _end_template(self):
+        if self._template is not None and self.output_format == "json":
+            self._file.write("\n    ]" if self._template_entries else "]")
+
+    def start_template(self, template):
+        """Starts a template's group of entries. The template is recorded even if no entries are written for it."""
+        self._open()
+        self._end_template()
+
+        if self.output_format == "jsonl":
+            self._file.write(json.dumps({"template": template}) + "\n")
+
+        else:
+            separator = "," if self._template is not None else ""
+            self._file.write(f"{separator}\n    {self._dumps(template)}: [")
+
+        self._template = template
+        self._template_entries = 0
+
+    def write(self, entry, template=None):
+        self._open()
+
+        if self.grouped and template != self._template:
+            self.start_template(template)
+
+        if self.output_format == "jsonl":
+            # lines are kept as valid JSON so they can be read back, unlike the pretty printed `json` output
+            line = {"template": template, "entry": entry} if self.grouped else entry
+            self._file.write(json.dumps(line, sort_keys=True) + "\n")
+
+        elif self.grouped:
+            separator = "," if self._template_entries else ""
+            self._file.write(f"{separator}\n        " + self._indent(self._dumps(entry, indent=4), level=2))
+
+        else:
+            separator = "," if self.num_entries else ""
+            self._file.write(f"{separator}\n    " + self._indent(self._dumps(entry, indent=4), level=1))
+
+        self.num_entries += 1
+        self._template_entries += 1
+
+    def close(self):
+        if self._file is None:
+            return
+
+        if self.output_format == "json":
+            self._end_template()
+            self._file.write("\n}" if self.grouped else "\n]")
+
+        self._file.close()
+        self._file = None
+
+
+def get_changed_files(base_ref=None, changed_files_list=None):
+    """Returns the absolute paths of files added or modified since `base_ref` and/or listed in `changed_files_list`."""
+    changed_files = []
+
+    if base_ref:
+        import subprocess
+
+        git_diff = ["git", "diff", "--name-only", "--diff-filter=AMR", "--relative", f"{base_ref}...HEAD"]
+
+        try:
+            output = subprocess.run(git_diff, capture_output=True, text=True, check=True).stdout
+
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.critical(f"Unable to list the files changed since {base_ref}: {getattr(e, 'stderr', None) or e}")
+            sys.exit(1)
+
+        changed_files.extend(output.splitlines())
+
+    if changed_files_list == "-":
+        changed_files.extend(sys.stdin.read().splitlines())
+
+    elif changed_files_list:
+        try:
+            with open(changed_files_list, "r") as f:
+                changed_files.extend(f.read().splitlines())
+
+        except FileNotFoundError:
+            logging.critical(f"Changed files list does not exist: {changed_files_list}")
+            sys.exit(1)
+
+    return {os.path.abspath(path.strip()) for path in changed_files if path.strip()}
+
+
+def _construct_cfn_tag(loader, tag_suffix, node):
+    function_name = tag_suffix if tag_suffix in ("Ref", "Condition") else f"Fn::{tag_suffix}"
+
+    if node.id == "scalar":
+        value = loader.construct_scalar(node)
+
+        if tag_suffix == "GetAtt":
+            value = value.split(".", 1)
+
+    elif node.id == "sequence":
+        value = loader.construct_sequence(node, deep=True)
+
+    else:
+        value = loader.construct_mapping(node, deep=True)
+
+    return {function_name: value}
+
+
+@functools.lru_cache(maxsize=None)
+def get_cfn_yaml_loader():
+    """Builds the YAML loader for CloudFormation templates the first time a YAML template is parsed."""
+    try:
+        from yaml import CSafeLoader as YamlSafeLoader
+
+    except ImportError:  # pragma: no cover
+        from yaml import SafeLoader as YamlSafeLoader
+
+    class CfnYamlLoader(YamlSafeLoader):
+        """
+        Safe YAML loader for CloudFormation templates, using LibYAML when it is available.
+
+        Short form intrinsic functions such as `!Ref` and `!GetAtt` are loaded in their long form (`{"Ref": ...}`),
+        and dates such as `AWSTemplateFormatVersion` are kept as strings, so parsed templates can always be dumped to
+        JSON.
+        """
+
+    CfnYamlLoader.add_multi_constructor("!", _construct_cfn_tag)
+    CfnYamlLoader.yaml_implicit_resolvers = {
+        first_char: [resolver for resolver in resolvers if resolver[0] != "tag:yaml.org,2002:timestamp"]
+        for first_char, resolvers in YamlSafeLoader.yaml_implicit_resolvers.items()
+    }
+
+    return CfnYamlLoader
+
+
+class CfnTemplate:
+    """A template's text, read once, and its parsed form, which is parsed on first use and shared by every consumer."""
+
+    _UNPARSED = object()
+
+    def __init__(self, text, location=None):
+        self.text = text
+        self.location = location
+        self._parsed = self._UNPARSED
+        self._lock = threading.Lock()
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.location or "")[1].lower()
+
+    @property
+    def format(self):
+        if self.extension == ".json":
+            return "json"
+
+        if self.extension in (".yaml", ".yml"):
+            return "yaml"
+
+        return None
+
+    @functools.cached_property
+    def content_hash(self):
+        """
+        A hash of the template's text which ignores whitespace that can't change its findings: line endings, trailing
+        whitespace and trailing blank lines, as well as indentation and blank lines in JSON templates.
+        """
+        import hashlib
+
+        lines = [line.rstrip() for line in self.text.splitlines()]
+
+        if self.format == "json":
+            lines = [line.lstrip() for line in lines if line]
+
+        while lines and not lines[-1]:
+            lines.pop()
+
+        return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+    @property
+    def parsed(self):
+        if self._parsed is self._UNPARSED:
+            with self._lock:
+                if self._parsed is self._UNPARSED:
+                    self._parsed = self._parse()
+
+        return self._parsed
+
+    def _parse(self):
+        """Parses the template. Invalid JSON and YAML both raise a `ValueError`."""
+        if self.format == "json":
+            return json.loads(self.text)
+
+        if self.format == "yaml":
+            import yaml
+
+            try:
+                return yaml.load(self.text, Loader=get_cfn_yaml_loader())
+
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML: {e}") from e
+
+        raise ValueError(f"Unknown file extension for template: {self.extension}")
+
+
+def get_references(value, names=None):
+    """
+    Collects the names `value` refers to through `Ref`, `Fn::GetAtt`, `Fn::Sub`, `Fn::FindInMap`, `Fn::If`,
+    `Condition` and `DependsOn`. Names aren't resolved, so they can be parameters, mappings, conditions or resources.
+    """
+    names = set() if names is None else names
+
+    if isinstance(value, list):
+        for item in value:
+            get_references(item, names)
+
+    if not isinstance(value, dict):
+        return names
+
+    for key, item in value.items():
+        first = item[0] if isinstance(item, list) and item else item
+
+        if key in ("Ref", "Condition") and isinstance(item, str):
+            names.add(item)
+
+        elif key == "Fn::GetAtt" and isinstance(first, str):
+            names.add(first.split(".", 1)[0])
+
+        elif key == "Fn::Sub" and isinstance(first, str):
+            names.update(SUB_REFERENCE_REGEX.findall(first))
+
+        elif key in ("Fn::FindInMap", "Fn::If") and isinstance(item, list) and isinstance(first, str):
+            names.add(first)
+
+        elif key == "DependsOn":
+            names.update(name for name in (item if isinstance(item, list) else [item]) if isinstance(name, str))
+
+        get_references(item, names)
+
+    return names
+
+
+def split_template(template, max_resources):
+    """
+    Splits a parsed template's `Resources` into chunks of up to `max_resources` which can be scanned independently.
+
+    Resources which refer to each other are always kept in the same chunk, so a group of related resources larger
+    than `max_resources` becomes a chunk of its own. Each chunk keeps the `Parameters`, `Mappings` and `Conditions`
+    its resources depend on. `Outputs` are dropped as they can refer to resources in any chunk.
+    """
+    resources = template["Resources"]
+    references = {logical_id: get_references(resource) for logical_id, resource in resources.items()}
+    parents = {logical_id: logical_id for logical_id in resources}
+    positions = {logical_id: position for position, logical_id in enumerate(resources)}
+
+    def find(logical_id):
+        while parents[logical_id] != logical_id:
+            parents[logical_id] = parents[parents[logical_id]]
+            logical_id = parents[logical_id]
+
+        return logical_id
+
+    for logical_id, names in references.items():
+        for name in names:
+            if name in parents:
+                parents[find(name)] = find(logical_id)
+
+    # groups of related resources are packed into chunks in the order they first appear in the template
+    groups = {}
+
+    for logical_id in resources:
+        groups.setdefault(find(logical_id), []).append(logical_id)
+
+    chunks = []
+
+    for group in groups.values():
+        if chunks and len(chunks[-1]) + len(group) <= max_resources:
+            chunks[-1].extend(group)
+
+        else:
+            chunks.append(list(group))
+
+    conditions = template.get("Conditions")
+    conditions = conditions if isinstance(conditions, dict) else {}
+    split_templates = []
+
+    for chunk in chunks:
+        names = set().union(*(references[logical_id] for logical_id in chunk))
+        pending = [name for name in names if name in conditions]
+
+        while pending:
+            for name in get_references(conditions[pending.pop()]) - names:
+                names.add(name)
+
+                if name in conditions:
+                    pending.append(name)
+
+        split = {key: template[key] for key in SPLIT_TEMPLATE_KEYS if key in template}
+
+        for section_name in SPLIT_TEMPLATE_SECTIONS:
+            section = template.get(section_name)
+
+            if isinstance(section, dict):
+                kept = {name: value for name, value in section.items() if name in names}
+
+                if kept:
+                    split[section_name] = kept
+
+        split["Resources"] = {logical_id: resources[logical_id] for logical_id in sorted(chunk, key=positions.get)}
+        split_templates.append(split)
+
+    return split_templates
+
+
+def merge_findings(chunk_findings, split=True):
+    """
+    Merges the findings of a split template's chunks into one result set, ordered by resource logical ID. Checks which
+    aren't specific to a resource are reported by every chunk, so entries are deduplicated by their ID. Without
+    `split`, e.g. for the findings of several profiles, every entry is kept in order.
+    """
+    merged = {"data": []}
+    entry_ids = set()
+
+    for findings in chunk_findings:
+        # responses without check entries can't be merged and are handled as if the template hadn't been split
+        if "data" not in findings:
+            return findings
+
+        errors = findings.get("errors")
+
+        if errors:
+            merged.setdefault("errors", []).extend(errors if isinstance(errors, list) else [errors])
+
+        for entry in findings["data"]:
+            if split and entry.get("id") in entry_ids:
+                continue
+
+            entry_ids.add(entry.get("id"))
+            merged["data"].append(entry)
+
+    if split:
+        merged["data"].sort(key=lambda entry: entry["attributes"].get("resource") or "")
+
+    return merged
+
+
+def is_cfn_template(cfn_template_file_location, strict=False, max_bytes=TEMPLATE_DETECTION_BYTES):
+    """
+    Cheaply checks whether a file looks like a CloudFormation template by reading at most `max_bytes` of it.
+
+    A template must declare `AWSTemplateFormatVersion`, or have a `Resources` key and an `AWS::` type. With `strict`,
+    the whole file is also parsed to check that `Resources` maps logical IDs to resources with a `Type`.
+    """
+    try:
+        with open(cfn_template_file_location, "r", errors="replace") as f:
+            head = f.read(max_bytes)
+
+    except OSError:
+        return False
+
+    if "AWSTemplateFormatVersion" not in head and not ("AWS::" in head and RESOURCES_KEY_REGEX.search(head)):
+        return False
+
+    if not strict:
+        return True
+
+    try:
+        with open(cfn_template_file_location, "r") as f:
+            parsed = CfnTemplate(f.read(), cfn_template_file_location).parsed
+
+    except (OSError, ValueError):
+        return False
+
+    resources = parsed.get("Resources") if isinstance(parsed, dict) else None
+
+    return (
+        isinstance(resources, dict)
+        and bool(resources)
+        and all(isinstance(resource, dict) and isinstance(resource.get("Type"), str) for resource in resources.values())
+    )
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+
+    return ordered[index]
+
+
+class ErrorCapture(logging.Handler):
+    """Collects the errors logged by the current thread, so callers can report why a scan exited."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self._local = threading.local()
+
+    def emit(self, record):
+        messages = getattr(self._local, "messages", None)
+
+        if messages is not None:
+            messages.append(record.getMessage())
+
+    def start(self):
+        self._local.messages = []
+
+    def stop(self):
+        messages = getattr(self._local, "messages", None) or []
+        self._local.messages = None
+
+        return messages
+
+
+class ScanMetrics:
+    """
+    Thread safe collector of per-phase timings and per-request latency, size and status.
+
+    Phases and requests are attributed to the template set with `template()` on the current thread. Phase times are
+    summed across threads, so with concurrent scans they can add up to more than the wall clock time of the run.
+
+    Request counts, sizes and statuses are kept as running totals. Long running processes can set `latency_window` to
+    only keep the latest requests for the latency percentiles, and turn off `per_template` metrics, so the metrics
+    don't grow with every scan.
+    """
+
+    def __init__(self, latency_window=None, per_template=True):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.templates = {}
+        self.per_template = per_template
+        self.requests = deque(maxlen=latency_window)
+        self.num_requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.status_codes = {}
+        self.cache_hits = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def template(self, cfn_template_file_location):
+        previous = getattr(self._local, "template", None)
+        self._local.template = cfn_template_file_location
+
+        try:
+            yield
+
+        finally:
+            self._local.template = previous
+
+    def current_template(self):
+        return getattr(self._local, "template", None)
+
+    def _template_metrics(self):
+        template = self.current_template()
+
+        if template is None or not self.per_template:
+            return None
+
+        return self.templates.setdefault(template, {"phases": {}, "requests": []})
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += elapsed
+
+                template_metrics = self._template_metrics()
+
+                if template_metrics is not None:
+                    template_phases = template_metrics["phases"]
+                    template_phases[name] = template_phases.get(name, 0.0) + elapsed
+
+    def record_request(self, latency, status, bytes_sent):
+        """Records a request attempt. Returns the record for `record_bytes_received()` as the body is read."""
+        request = {"latency_seconds": latency, "status": status, "bytes_sent": bytes_sent, "bytes_received": 0}
+
+        with self._lock:
+            self.requests.append(request)
+            self.num_requests += 1
+            self.bytes_sent += bytes_sent
+            self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+            template_metrics = self._template_metrics()
+
+            if template_metrics is not None:
+                template_metrics["requests"].append(request)
+
+        return request
+
+    def record_bytes_received(self, request, num_bytes):
+        with self._lock:
+            request["bytes_received"] += num_bytes
+            self.bytes_received += num_bytes
+
+    def record_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def to_dict(self):
+        with self._lock:
+            latencies = [request["latency_seconds"] for request in self.requests]
+
+            return {
+                "total_seconds": time.perf_counter() - self.started,
+                "phases": {name: dict(phase) for name, phase in self.phases.items()},
+                "requests": {
+                    "count": self.num_requests,
+                    "cache_hits": self.cache_hits,
+                    "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received,
+                    "status_codes": dict(self.status_codes),
+                    "latency_seconds": {
+                        "p50": percentile(latencies, 50) if latencies else None,
+                        "p95": percentile(latencies, 95) if latencies else None,
+                        "p99": percentile(latencies, 99) if latencies else None,
+                        "max": max(latencies) if latencies else None,
+                    },
+                },
+                "templates": {
+                    template: {"phases": dict(metrics["phases"]), "requests": [dict(r) for r in metrics["requests"]]}
+                    for template, metrics in self.templates.items()
+                },
+            }
+
+    def to_prometheus(self):
+        metrics = self.to_dict()
+        requests_metrics = metrics["requests"]
+        lines = [
+            "# HELP cc_scanner_run_seconds Wall clock time of the scanner run.",
+            "# TYPE cc_scanner_run_seconds gauge",
+            f"cc_scanner_run_seconds {metrics['total_seconds']}",
+            "# HELP cc_scanner_phase_seconds Time spent in each scan phase, summed across templates.",
+            "# TYPE cc_scanner_phase_seconds gauge",
+        ]
+        lines += [f'cc_scanner_phase_seconds{{phase="{name}"}} {p["seconds"]}' for name, p in metrics["phases"].items()]
+        lines += [
+            "# HELP cc_scanner_phase_count Number of times each scan phase ran.",
+            "# TYPE cc_scanner_phase_count gauge",
+        ]
+        lines += [f'cc_scanner_phase_count{{phase="{name}"}} {p["count"]}' for name, p in metrics["phases"].items()]
+        lines += [
+            "# HELP cc_scanner_requests Scan request attempts by HTTP status.",
+            "# TYPE cc_scanner_requests gauge",
+        ]
+        lines += [
+            f'cc_scanner_requests{{status="{status}"}} {count}'
+            for status, count in requests_metrics["status_codes"].items()
+        ]
+        lines += [
+            "# HELP cc_scanner_request_latency_seconds Scan request latency.",
+            "# TYPE cc_scanner_request_latency_seconds summary",
+        ]
+        lines += [
+            f'cc_scanner_request_latency_seconds{{quantile="{quantile}"}} {requests_metrics["latency_seconds"][key]}'
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99"))
+            if requests_metrics["latency_seconds"][key] is not None
+        ]
+        lines += [
+            "# HELP cc_scanner_bytes_sent Bytes sent in scan requests.",
+            "# TYPE cc_scanner_bytes_sent gauge",
+            f"cc_scanner_bytes_sent {requests_metrics['bytes_sent']}",
+            "# HELP cc_scanner_bytes_received Bytes received in scan responses.",
+            "# TYPE cc_scanner_bytes_received gauge",
+            f"cc_scanner_bytes_received {requests_metrics['bytes_received']}",
+            "# HELP cc_scanner_cache_hits Scans answered from the local cache.",
+            "# TYPE cc_scanner_cache_hits gauge",
+            f"cc_scanner_cache_hits {requests_metrics['cache_hits']}",
+        ]
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(output_file, contents):
+        # write to a temporary file first so collectors such as the node exporter never read a partial file
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+
+        os.replace(tmp_path, output_file)
+
+    def write(self, metrics_file=None, prometheus_file=None):
+        if metrics_file:
+            self._write(metrics_file, json.dumps(self.to_dict(), indent=4, sort_keys=True))
+
+        if prometheus_file:
+            self._write(prometheus_file, self.to_prometheus())
+
+
+def create_session(pool_size=DEFAULT_MAX_CONCURRENCY):
+    """Creates a session which keeps up to `pool_size` connections per endpoint alive between scans."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(pool_connections=len(CC_REGIONS), pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def get_nested_templates(cfn_template):
+    """
+    Returns the local templates of a template's nested stacks, resolved relative to the template. Stacks whose
+    `TemplateURL` is remote (e.g. S3) or an intrinsic function are skipped. Raises `ValueError` if the template is invalid.
+    """
+    resources = cfn_template.parsed.get("Resources") if isinstance(cfn_template.parsed, dict) else None
+
+    if not isinstance(resources, dict):
+        return []
+
+    nested_templates = []
+    template_dir = os.path.dirname(cfn_template.location or "")
+
+    for resource in resources.values():
+        if not isinstance(resource, dict) or resource.get("Type") != NESTED_STACK_TYPE:
+            continue
+
+        template_url = (resource.get("Properties") or {}).get("TemplateURL")
+
+        if not isinstance(template_url, str):
+            continue
+
+        if template_url.lower().startswith("file://"):
+            template_url = template_url[len("file://") :]
+
+        elif REMOTE_URL_REGEX.match(template_url):
+            continue
+
+        nested_templates.append(os.path.normpath(os.path.join(template_dir, template_url)))
+
+    return list(dict.fromkeys(nested_templates))
+
+
+def get_descendants(stack_graph, template):
+    """Returns every template nested below `template` in `stack_graph`, at any depth, each once."""
+    descendants = {}
+    pending = list(stack_graph.get(template, ()))
+
+    while pending:
+        child = pending.pop()
+
+        if child in descendants or child == template:
+            continue
+
+        descendants[child] = None
+        pending.extend(stack_graph.get(child, ()))
+
+    return list(descendants)
+
+
+def find_templates(paths):
+    """Expands a list of files, directories and glob patterns into a sorted list of template files."""
+    templates = set()
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+
+                for name in files:
+                    if name.lower().endswith(TEMPLATE_EXTENSIONS):
+                        templates.add(os.path.join(root, name))
+
+        elif os.path.isfile(path):
+            templates.add(path)
+
+        else:
+            matches = glob.glob(path, recursive=True)
+
+            if not matches:
+                logging.warning(f"No templates matched: {path}")
+
+            templates.update(
+                match for match in matches if os.path.isfile(match) and match.lower().endswith(TEMPLATE_EXTENSIONS)
+            )
+
+    return sorted(templates)
+
+
+class CcValidator:
+    def __init__(self, template_required=True, session=None, use_cache=True):
+
+        try:
+            logging.info("Obtaining required environment variables...")
+            self.cc_region = os.environ["CC_REGION"].lower()
+
+            if self.cc_region not in CC_REGIONS:
+                logging.error('Please ensure "CC_REGION" is set to a region which is supported by Conformity')
+                sys.exit(1)
+
+            self.api_key = os.environ["CC_API_KEY"]
+
+            if template_required:
+                self.cfn_template_file_location = os.environ["CFN_TEMPLATE_FILE_LOCATION"]
+
+            else:
+                self.cfn_template_file_location = os.getenv("CFN_TEMPLATE_FILE_LOCATION")
+
+            risk_level = os.getenv("CC_RISK_LEVEL", "LOW").upper()
+
+        except KeyError:
+            logging.error("Please ensure all environment variables are set")
+            sys.exit(1)
+
+        try:
+            self.offending_risk_level_num = RISK_LEVEL_NUMS[risk_level]
+            self.profiles = parse_profiles(os.getenv("CC_PROFILE_ID", ""), self.offending_risk_level_num)
+
+        except KeyError:
+            logging.critical("Unknown risk level. Please use one of LOW | MEDIUM | HIGH | VERY_HIGH | EXTREME")
+            sys.exit(1)
+
+        # a single profile's risk level applies to every entry, while several profiles each tag their own entries
+        if len(self.profiles) == 1:
+            self.offending_risk_level_num = self.profiles[0][1]
+
+        self.profile_risk_levels = dict(self.profiles)
+
+        self.max_concurrency = get_int_env("CC_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+        self.pool_size = get_int_env("CC_POOL_SIZE", self.max_concurrency)
+        # templates, profiles and chunks are each scanned from their own pools, so requests are capped where they're sent
+        self._request_slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        self.max_retries = get_int_env("CC_MAX_RETRIES", DEFAULT_MAX_RETRIES, minimum=0)
+        self.request_timeout = get_float_env("CC_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT)
+        self.region_selector = None
+        failover_regions = [region.strip().lower() for region in os.getenv("CC_FAILOVER_REGIONS", "").split(",")]
+        failover_regions = [region for region in failover_regions if region]
+
+        if any(region not in CC_REGIONS for region in failover_regions):
+            logging.critical(f'Please ensure "CC_FAILOVER_REGIONS" only lists regions from: {" | ".join(CC_REGIONS)}')
+            sys.exit(1)
+
+        # `CC_REGION` is preferred while the regions are equally healthy
+        regions = [self.cc_region] + [region for region in failover_regions if region != self.cc_region]
+
+        if len(regions) > 1:
+            self.region_selector = RegionSelector(regions)
+            self._probe_lock = threading.Lock()
+
+        # each region has its own limit, so a region which is throttled or failed over to doesn't slow the others down
+        self.rate_limiters = {region: TokenBucket(get_rate_limit(region)) for region in regions}
+
+        self.stream_responses = os.getenv("CC_STREAM_RESPONSES", "").lower() == "enabled"
+        self.split_resources = get_int_env("CC_SPLIT_RESOURCES", 0, minimum=0)
+        self.minify_templates = os.getenv("CC_MINIFY_TEMPLATE", "").lower() == "enabled"
+        self.compress_requests = os.getenv("CC_COMPRESS_REQUESTS", "").lower() == "enabled"
+        self.deduplicate_templates = os.getenv("CC_DEDUPLICATE_TEMPLATES", "enabled").lower() != "disabled"
+        # set by `run_batch` while a batch is scanned
+        self.journal = None
+        self.local_rules = os.getenv("CC_LOCAL_RULES", "disabled").lower()
+
+        if self.local_rules not in LOCAL_RULES_MODES:
+            logging.critical(f"Unknown local rules mode. Please use one of {' | '.join(LOCAL_RULES_MODES)}")
+            sys.exit(1)
+
+        self.template_detection = os.getenv("CC_TEMPLATE_DETECTION", "enabled").lower()
+
+        if self.template_detection not in TEMPLATE_DETECTION_MODES:
+            logging.critical(
+                f"Unknown template detection mode. Please use one of {' | '.join(TEMPLATE_DETECTION_MODES)}"
+            )
+            sys.exit(1)
+
+        self.nested_stacks = os.getenv("CC_NESTED_STACKS", "disabled").lower()
+
+        if self.nested_stacks not in NESTED_STACK_MODES:
+            logging.critical(f"Unknown nested stacks mode. Please use one of {' | '.join(NESTED_STACK_MODES)}")
+            sys.exit(1)
+
+        self.metrics = ScanMetrics()
+        self.output_format = os.getenv("CC_OUTPUT_FORMAT", "json").lower()
+
+        if self.output_format not in OUTPUT_FORMATS:
+            logging.critical(f"Unknown output format. Please use one of {' | '.join(OUTPUT_FORMATS)}")
+            sys.exit(1)
+
+        baseline_file = os.getenv("CC_BASELINE_FILE")
+        self.baseline = Baseline.load(baseline_file) if baseline_file else None
+
+        if self.baseline is not None:
+            logging.info(f"Loaded {len(self.baseline)} accepted finding(s) from {baseline_file}")
+
+        # callers scanning with several validators can pass in one session so they share a connection pool
+        self._session = session
+        self._session_lock = threading.Lock()
+
+        if use_cache and os.getenv("CC_CACHE", "").lower() != "disabled":
+            self.cache = ScanCache(
+                cache_dir=os.getenv("CC_CACHE_DIR", DEFAULT_CACHE_DIR),
+                ttl=get_int_env("CC_CACHE_TTL", DEFAULT_CACHE_TTL, minimum=0),
+                max_size=get_int_env("CC_CACHE_MAX_SIZE", DEFAULT_CACHE_MAX_SIZE, minimum=0),
+            )
+
+        else:
+            self.cache = None
+
+        if len(self.profiles) == 1:
+            fail_levels = f'"{RISK_LEVELS[self.offending_risk_level_num]}" level issues are found'
+
+        else:
+            fail_levels = "issues are found at each profile's risk level: " + ", ".join(
+                f'"{RISK_LEVELS[risk_level_num]}" for {cc_profile_id}'
+                for cc_profile_id, risk_level_num in self.profiles
+            )
+
+        logging.info(f"All environment variables were received. The pipeline will fail if any {fail_levels}")
+
+    @property
+    def session(self):
+        """The HTTP session, created on first use so callers which never use it, like the async API, don't need it."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = create_session(self.pool_size)
+
+        return self._session
+
+    def read_template_file(self, cfn_template_file_location=None):
+        cfn_template_file_location = cfn_template_file_location or self.cfn_template_file_location
+
+        if not os.path.isfile(cfn_template_file_location):
+            logging.critical(f"Template file does not exist: {cfn_template_file_location}")
+            sys.exit(1)
+
+        with open(cfn_template_file_location, "r") as f:
+            cfn_contents = f.read()
+
+        return cfn_contents
+
+    def read_template(self, cfn_template_file_location=None):
+        cfn_template_file_location = cfn_template_file_location or self.cfn_template_file_location
+        cfn_template_contents = self.read_template_file(cfn_template_file_location)
+
+        return CfnTemplate(cfn_template_contents, cfn_template_file_location)
+
+    @staticmethod
+    def generate_payload(cfn_template_contents, cc_profile_id=None):
+        if cc_profile_id is None:
+            cc_profile_id = os.getenv("CC_PROFILE_ID", "")
+
+        payload = {
+            "data": {
+                "attributes": {
+                    "type": "cloudformation-template",
+                    "contents": cfn_template_contents,
+                    "profileId": cc_profile_id,
+                }
+            }
+        }
+
+        return payload
+
+    def minify_template(self, cfn_template):
+        """
+        Returns a template as compact JSON, without comments or indentation, when `CC_MINIFY_TEMPLATE` is enabled.
+        Templates which can't be parsed are sent as they are.
+        """
+        if not self.minify_templates:
+            return cfn_template.text
+
+        try:
+            contents = json.dumps(cfn_template.parsed, separators=(",", ":"))
+
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Unable to minify {cfn_template.location}. It will be sent as it is: {e}")
+            return cfn_template.text
+
+        logging.info(f"Minified {cfn_template.location} from {len(cfn_template.text)} to {len(contents)} characters")
+
+        return contents
+
+    def split_template_contents(self, cfn_template):
+        """
+        Returns the contents to scan for a template. Templates with more than `CC_SPLIT_RESOURCES` resources are split
+        into chunks of related resources, which are scanned separately.
+        """
+        if not self.split_resources:
+            return [self.minify_template(cfn_template)]
+
+        try:
+            parsed = cfn_template.parsed
+
+        except ValueError as e:
+            logging.warning(f"Unable to parse {cfn_template.location} to split it. It will be scanned whole: {e}")
+            return [cfn_template.text]
+
+        resources = parsed.get("Resources") if isinstance(parsed, dict) else None
+
+        if not isinstance(resources, dict) or len(resources) <= self.split_resources:
+            return [self.minify_template(cfn_template)]
+
+        chunks = split_template(parsed, self.split_resources)
+
+        if len(chunks) == 1:
+            return [self.minify_template(cfn_template)]
+
+        logging.info(f"Split the {len(resources)} resources in {cfn_template.location} into {len(chunks)} chunks")
+
+        return [json.dumps(chunk, separators=(",", ":")) for chunk in chunks]
+
+    def run_validations(self, payloads):
+        """Scans the payloads of a split template concurrently and merges their findings."""
+        if len(payloads) == 1:
+            return self.run_validation(payloads[0])
+
+        return merge_findings(self.map_validations(self.run_validation, payloads))
+
+    def run_profile_validations(self, contents):
+        """
+        Scans a prepared template against every profile in `CC_PROFILE_ID`, concurrently when there are several, and
+        combines their findings.
+        """
+
+        def run_profile_validation(cc_profile_id):
+            return self.run_validations([self.generate_payload(chunk, cc_profile_id) for chunk in contents])
+
+        if len(self.profiles) == 1:
+            return run_profile_validation(self.profiles[0][0])
+
+        profile_ids = [cc_profile_id for cc_profile_id, _ in self.profiles]
+
+        return self.merge_profile_findings(self.map_validations(run_profile_validation, profile_ids))
+
+    def map_validations(self, run_validation, items):
+        """
+        Calls `run_validation` with each item, e.g. a chunk's payload or a profile ID, on up to `max_concurrency`
+        threads. Returns their findings in order, attributed to the current thread's template.
+        """
+        cfn_template_file_location = self.metrics.current_template()
+
+        def run_worker(item):
+            with self.metrics.template(cfn_template_file_location):
+                findings = run_validation(item)
+
+                # streamed entries have to be received before the worker moves on to the next item
+                if "data" in findings:
+                    findings["data"] = list(findings["data"])
+
+                return findings
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            return list(executor.map(run_worker, items))
+
+    def merge_profile_findings(self, profile_findings):
+        """
+        Combines the findings of every profile into one result set. Each entry is tagged with the profile it was scanned
+        against, so `get_results` applies that profile's risk level.
+        """
+        for (cc_profile_id, _), findings in zip(self.profiles, profile_findings):
+            for entry in findings.get("data", []):
+                entry["attributes"]["profile-id"] = cc_profile_id
+
+        return merge_findings(profile_findings, split=False)
+
+    def get_settings_fingerprint(self):
+        """
+        Hashes the settings which change the entries returned for a template, so journalled entries are only reused
+        with the same settings. The risk level and baseline are left out, as journalled entries are filtered again.
+        """
+        import hashlib
+
+        settings = {
+            # like the daemon's job settings, the key itself is never written
+            "api_key": hashlib.sha256(self.api_key.encode("utf-8")).hexdigest(),
+            "endpoint": get_scan_endpoint(self.cc_region),
+            "profiles": [cc_profile_id for cc_profile_id, _ in self.profiles],
+            "local_rules": self.local_rules,
+            "split_resources": self.split_resources,
+        }
+
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_cache_key(self, payload):
+        if not self.cache:
+            return None
+
+        attributes = payload["data"]["attributes"]
+
+        return self.cache.key(attributes["contents"], attributes["profileId"], self.cc_region, self.api_key)
+
+    def build_request(self, payload):
+        """Returns the headers and body of a scan request, as compact and optionally compressed JSON."""
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            json_output = json.dumps(payload, indent=4, sort_keys=True)
+            logging.debug(f"Sending the following request:\n{json_output}")
+
+        headers = {
+            "Content-Type": "application/vnd.api+json",
+            "Authorization": "ApiKey " + self.api_key,
+        }
+
+        request_body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        request_size = len(request_body)
+
+        if self.compress_requests:
+            import gzip
+
+            request_body = gzip.compress(request_body, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+            logging.info(f"Sending a {request_size} byte scan request, compressed to {len(request_body)} bytes")
+
+        else:
+            logging.info(f"Sending a {request_size} byte scan request")
+
+        return headers, request_body
+
+    def choose_region(self, exclude=()):
+        """Returns the region to send the next scan request to. The regions are probed before the first request."""
+        if not self.region_selector:
+            return self.cc_region
+
+        if not self.region_selector.probed:
+            with self._probe_lock:
+                if not self.region_selector.probed:
+                    self.region_selector.probe(self.session)
+
+        return self.region_selector.choose(exclude)
+
+    def record_region(self, region, latency, ok):
+        if self.region_selector:
+            self.region_selector.record(region, latency, ok)
+
+    @staticmethod
+    def check_response(resp_json):
+        message = resp_json.get("Message")
+        if message and "deny" in message:
+            logging.critical(
+                f"{message}. Please ensure you've set the correct Conformity region and that your API key is correct"
+            )
+            sys.exit(1)
+
+    def run_validation(self, payload):
+        cache_key = self.get_cache_key(payload)
+
+        if cache_key:
+            if self.stream_responses:
+                cached_chunks = self.cache.get_chunks(cache_key)
+
+                if cached_chunks is not None:
+                    logging.info("Using cached scan results for unchanged template")
+                    self.metrics.record_cache_hit()
+                    return self._parse_streamed_response(cached_chunks)
+
+            else:
+                cached_resp_text = self.cache.get(cache_key)
+
+                if cached_resp_text is not None:
+                    logging.info("Using cached scan results for unchanged template")
+                    self.metrics.record_cache_hit()
+                    return json.loads(cached_resp_text)
+
+        headers, request_body = self.build_request(payload)
+
+        resp = self._post(headers=headers, data=request_body, stream=self.stream_responses)
+
+        if self.stream_responses:
+            chunks = self._count_received(resp.iter_content(chunk_size=RESPONSE_CHUNK_SIZE), resp.request_metrics)
+
+            # only complete scans are cached so errors are retried on the next run
+            if cache_key and resp.status_code == 200:
+                chunks = self.cache.tee(cache_key, chunks)
+
+            resp_json = self._parse_streamed_response(chunks, resp.status_code)
+
+        else:
+            self.metrics.record_bytes_received(resp.request_metrics, len(resp.content))
 
-        try:
-            logging.info("Obtaining required environment variables...")
-            self.cc_region = os.environ["CC_REGION"].lower()
+            try:
+                resp_json = json.loads(resp.text)
 
-            if self.cc_region not in CC_REGIONS:
-                logging.error('Please ensure "CC_REGION" is set to a region which is supported by Conformity')
+            except ValueError:
+                logging.critical(
+                    f"Conformity returned an invalid response (HTTP {resp.status_code}): {resp.text[:200]}"
+                )
                 sys.exit(1)
 
-            self.api_key = os.environ["CC_API_KEY"]
-            self.cfn_template_file_location = os.environ["CFN_TEMPLATE_FILE_LOCATION"]
-            risk_level = os.getenv("CC_RISK_LEVEL", "LOW").upper()
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                json_output = json.dumps(resp_json, indent=4, sort_keys=True)
+                logging.debug(f"Received the following response:\n{json_output}")
 
-        except KeyError:
-            logging.error("Please ensure all environment variables are set")
-            sys.exit(1)
+        self.check_response(resp_json)
 
-        try:
-            self.offending_risk_level_num = RISK_LEVEL_NUMS[risk_level]
+        # `_post` returns the last response once every retry has failed
+        if resp.status_code in RETRY_STATUS_CODES:
+            logging.critical(
+                f"Conformity returned HTTP {resp.status_code} after {self.max_retries + 1} attempt(s): "
+                f"{self._error_text(resp, resp_json)}"
+            )
+            sys.exit(1)
 
-        except KeyError:
-            logging.critical("Unknown risk level. Please use one of LOW | MEDIUM | HIGH | VERY_HIGH | EXTREME")
+        if "data" not in resp_json:
+            logging.critical(
+                f"Conformity returned no findings (HTTP {resp.status_code}): {self._error_text(resp, resp_json)}"
+            )
             sys.exit(1)
 
-        logging.info(
-            f'All environment variables were received. The pipeline will fail if any "{risk_level}" level '
-            f"issues are found"
-        )
+        # only complete scans are cached so errors are retried on the next run
+        if cache_key and not self.stream_responses and not resp_json.get("errors"):
+            self.cache.set(cache_key, resp.text)
 
-    def read_template_file(self):
-        if not os.path.isfile(self.cfn_template_file_location):
-            logging.critical(f"Template file does not exist: {self.cfn_template_file_location}")
-            sys.exit(1)
+        return resp_json
 
-        with open(self.cfn_template_file_location, "r") as f:
-            cfn_contents = f.read()
+    def _error_text(self, resp, resp_json):
+        # a streamed response has already been consumed, and its entries may not have been received yet
+        if self.stream_responses:
+            return json.dumps({key: value for key, value in resp_json.items() if key != "data"})[:200]
 
-        return cfn_contents
+        return resp.text[:200]
+
+    def _count_received(self, chunks, request_metrics):
+        for chunk in chunks:
+            self.metrics.record_bytes_received(request_metrics, len(chunk))
+            yield chunk
 
     @staticmethod
-    def generate_payload(cfn_template_contents):
-        cc_profile_id = os.getenv("CC_PROFILE_ID", "")
+    def _parse_streamed_response(chunks, status_code=200):
+        """Parses a response incrementally. Its `data` entries are decoded one at a time as they are iterated over."""
+        logging.debug("Streaming the response. Check entries are parsed as they are received")
 
-        payload = {
-            "data": {
-                "attributes": {
-                    "type": "cloudformation-template",
-                    "contents": cfn_template_contents,
-                    "profileId": cc_profile_id,
-                }
-            }
-        }
+        def invalid_response(e):
+            logging.critical(f"Conformity returned an invalid response (HTTP {status_code}): {e}")
+            sys.exit(1)
 
-        return payload
+        try:
+            resp_json = JsonStreamParser(chunks).parse(array_key="data")
 
-    def run_validation(self, payload):
-        cfn_scan_endpoint = f"https://{self.cc_region}-api.cloudconformity.com/v1/iac-scanning/scan"
+        except ValueError as e:
+            invalid_response(e)
 
-        json_output = json.dumps(payload, indent=4, sort_keys=True)
-        logging.debug(f"Sending the following request:\n{json_output}")
+        entries = resp_json.get("data")
 
-        headers = {
-            "Content-Type": "application/vnd.api+json",
-            "Authorization": "ApiKey " + self.api_key,
-        }
+        if entries is None or isinstance(entries, list):
+            return resp_json
 
-        resp = requests.post(cfn_scan_endpoint, headers=headers, data=json_output)
-        resp_json = json.loads(resp.text)
-        json_output = json.dumps(resp_json, indent=4, sort_keys=True)
-        logging.debug(f"Received the following response:\n{json_output}")
+        def checked_entries():
+            try:
+                yield from entries
 
-        message = resp_json.get("Message")
-        if message and "deny" in message:
-            logging.critical(
-                f"{message}. Please ensure you've set the correct Conformity region and that your API key is correct"
-            )
-            sys.exit(1)
+            except ValueError as e:
+                invalid_response(e)
+
+        resp_json["data"] = checked_entries()
 
         return resp_json
 
-    def get_results(self, findings):
+    def record_attempt(self, region, latency, bytes_sent, status):
+        """Records a scan request attempt, with `status` set to the error's name if it couldn't be sent."""
+        self.record_region(region, latency, ok=isinstance(status, int) and status < 500)
+
+        return self.metrics.record_request(latency, status, bytes_sent)
+
+    def get_retry(self, attempt, region, failed_regions, status_code=None, error=None, retry_after=None):
+        """
+        Decides whether a scan request attempt is retried, for both the blocking and the async client. Returns `None`
+        if the response is final, or once the retries have run out, and otherwise the region to retry in and how long
+        to wait first. Failed and 5xx requests are retried straight away in the next healthiest region, if there is one.
+        """
+        if error is None and status_code not in RETRY_STATUS_CODES:
+            self.rate_limiters[region].recover()
+            return None
+
+        if attempt == self.max_retries:
+            return None
+
+        if status_code == 429:
+            self.rate_limiters[region].throttle()
+
+        else:
+            failed_regions.add(region)
+
+        reason = type(error).__name__ if error is not None else f"HTTP {status_code}"
+        next_region = self.choose_region(failed_regions)
+
+        if next_region != region:
+            logging.warning(f"Scan request to {region} failed ({reason}). Failing over to {next_region}")
+            return next_region, 0
+
+        delay = get_retry_delay(attempt, retry_after)
+        logging.warning(f"Scan request failed ({reason}). Retrying in {delay:.1f}s")
+
+        return region, delay
+
+    def _post(self, **kwargs):
+        """
+        Sends a rate limited scan request, retrying throttled, failed and 5xx requests with jittered backoff. With
+        `CC_FAILOVER_REGIONS`, failed and 5xx requests are retried straight away in the next healthiest region.
+        """
+        import requests
+
+        failed_regions = set()
+        region = self.choose_region()
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiters[region].acquire()
+
+            start = time.perf_counter()
+            bytes_sent = len(kwargs.get("data") or b"")
+
+            try:
+                with self._request_slots:
+                    resp = self.session.post(
+                        get_scan_endpoint(region), timeout=(CONNECT_TIMEOUT, self.request_timeout), **kwargs
+                    )
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_attempt(region, time.perf_counter() - start, bytes_sent, type(e).__name__)
+                retry = self.get_retry(attempt, region, failed_regions, error=e)
+
+                if retry is None:
+                    logging.critical(f"Unable to connect to Conformity after {attempt + 1} attempt(s): {e}")
+                    sys.exit(1)
+
+            else:
+                resp.request_metrics = self.record_attempt(
+                    region, time.perf_counter() - start, bytes_sent, resp.status_code
+                )
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                retry = self.get_retry(attempt, region, failed_regions, resp.status_code, retry_after=retry_after)
+
+                if retry is None:
+                    return resp
+
+                resp.close()
+
+            region, delay = retry
+
+            if delay:
+                time.sleep(delay)
+
+    def run_local_rules(self, cfn_template):
+        """Checks a template against the offline rules in `local_rules`. Returns their check entries."""
+        try:
+            parsed = cfn_template.parsed
+
+        except ValueError as e:
+            logging.warning(f"Unable to parse {cfn_template.location} for the local rules: {e}")
+            return []
+
+        from local_rules import evaluate_local_rules
+
+        return evaluate_local_rules(parsed)
+
+    def skip_conformity_scan(self, local_entries):
+        """Whether the local rules are enough to decide the result, so the template isn't sent to Conformity."""
+        if self.local_rules == "fail-fast":
+            skip = any(self.is_offending(entry) for entry in local_entries)
+
+        else:
+            skip = self.local_rules == "only"
+
+        if skip:
+            logging.info("Skipping the Conformity scan. The template was only checked against the local rules")
+
+        return skip
+
+    def is_offending(self, entry):
+        attributes = entry["attributes"]
+
+        if attributes["status"] == "SUCCESS" or self.is_suppressed(entry):
+            return False
+
+        risk_level_text = attributes["risk-level"]
+        risk_level_num = RISK_LEVEL_NUMS[risk_level_text]
+
+        return risk_level_num >= self.get_offending_risk_level_num(entry)
+
+    def get_offending_risk_level_num(self, entry):
+        """The risk level from which an entry is offending: its profile's, or `CC_RISK_LEVEL` for untagged entries."""
+        return self.profile_risk_levels.get(entry["attributes"].get("profile-id"), self.offending_risk_level_num)
+
+    def is_suppressed(self, entry):
+        """Whether a failing entry has been accepted in the baseline."""
+        if self.baseline is None or entry["attributes"]["status"] == "SUCCESS":
+            return False
+
+        return entry in self.baseline
+
+    def get_results(self, findings, output_file=OUTPUT_FILE, index=None):
+        """
+        Filters the offending entries out of `findings` in a single pass. Every failing entry is also added to `index`,
+        when one is given. Entries accepted in the baseline are skipped.
+        """
         offending_entries = []
+        index = FindingsIndex() if index is None else index
+        num_suppressed = len(index.suppressed)
 
         if findings.get("errors"):  # pragma: no cover
             logging.critical(findings["errors"])
             sys.exit(1)
 
-        for entry in findings["data"]:
-            attributes = entry["attributes"]
+        # entries are streamed to `output_file` as they're filtered rather than serialised in one go at the end
+        writer = FindingsWriter(output_file, self.output_format) if output_file else None
 
-            if entry["attributes"]["status"] == "SUCCESS":
-                continue
+        try:
+            for entry in findings["data"]:
+                if self.is_suppressed(entry):
+                    index.suppressed.append(entry)
+                    continue
 
-            risk_level_text = attributes["risk-level"]
-            risk_level_num = RISK_LEVEL_NUMS[risk_level_text]
+                risk_level_num = index.add(entry)
 
-            if risk_level_num >= self.offending_risk_level_num:
-                offending_entries.append(entry)
+                if risk_level_num is not None and risk_level_num >= self.get_offending_risk_level_num(entry):
+                    offending_entries.append(entry)
 
-        if not offending_entries:
-            return offending_entries
+                    if writer:
+                        writer.write(entry)
+
+        finally:
+            if writer:
+                writer.close()
 
-        formatted_output = json.dumps(offending_entries, sort_keys=True, indent=4)
-        output = formatted_output.replace(r"\"", "")
+        suppressed = len(index.suppressed) - num_suppressed
 
-        with open(OUTPUT_FILE, "w") as f:
-            f.write(output)
+        if suppressed:
+            logging.info(f"{suppressed} finding(s) were accepted in the baseline and have been ignored")
+
+        if len(self.profiles) > 1:
+            for cc_profile_id, risk_level_num in self.profiles:
+                profile_entries = [e for e in offending_entries if e["attributes"].get("profile-id") == cc_profile_id]
+                logging.info(
+                    f'{len(profile_entries)} offending entries found with profile "{cc_profile_id}" '
+                    f"(risk level {RISK_LEVELS[risk_level_num]})"
+                )
 
         return offending_entries
 
@@ -165,7 +2255,7 @@ class CcValidator:
 
             return True
 
-    def _fail_pipeline(self, cfn_template_contents):
+    def _fail_pipeline(self, cfn_template, cfn_template_file_location=None):
         if os.environ.get("FAIL_PIPELINE", "").lower() == "disabled":
             logging.info(
                 'The "FAIL_PIPELINE" environment variable is set to "disabled". The pipeline will not fail even if '
@@ -182,39 +2272,48 @@ class CcValidator:
             "if the pipeline should fail."
         )
 
-        template_extension = os.path.splitext(self.cfn_template_file_location)[1]
+        if not isinstance(cfn_template, CfnTemplate):
+            cfn_template_file_location = cfn_template_file_location or self.cfn_template_file_location
+            cfn_template = CfnTemplate(cfn_template, cfn_template_file_location)
 
-        if template_extension.lower() == ".json":
-            dict_template = json.loads(cfn_template_contents)
-            fail_pipeline = self._check_fail_pipeline(dict_template)
+        if not cfn_template.format:
+            logging.critical(f"Unknown file extension for template: {cfn_template.extension}")
+            sys.exit(1)
 
-            return fail_pipeline
+        fail_pipeline = self._check_fail_pipeline(cfn_template.parsed)
 
-        elif template_extension.lower() == ".yaml" or template_extension.lower() == ".yml":
-            dict_template = yaml.safe_load(cfn_template_contents)
-            fail_pipeline = self._check_fail_pipeline(dict_template)
+        return fail_pipeline
 
-            return fail_pipeline
+    @staticmethod
+    def log_summary(index):
+        if not index:
+            return
 
-        else:
-            logging.critical(f"Unknown file extension for template: {template_extension}")
-            sys.exit(1)
+        risk_levels = ", ".join(
+            f"{risk_level}: {count}" for risk_level, count in index.summary()["risk_levels"].items()
+        )
+        logging.info(f"{len(index)} failing check(s) by risk level: {risk_levels}")
 
     def run(self):
-        cfn_template_contents = self.read_template_file()
-        payload = self.generate_payload(cfn_template_contents)
-        findings = self.run_validation(payload)
-        offending_entries = self.get_results(findings)
+        index = FindingsIndex()
+
+        with self.metrics.template(self.cfn_template_file_location):
+            cfn_template, offending_entries = self._scan(self.cfn_template_file_location, OUTPUT_FILE, index=index)
+
+        self.log_summary(index)
 
         if not offending_entries:
             logging.info("No offending entries found")
             sys.exit()
 
         num_offending_entries = len(offending_entries)
-        json_offending_entries = json.dumps(offending_entries, indent=4, sort_keys=True)
-        logging.info(f"Offending entries:\n{json_offending_entries}")
+        logging.info("Offending entries:")
 
-        fail_pipeline = self._fail_pipeline(cfn_template_contents)
+        for entry in offending_entries:
+            logging.info(json.dumps(entry, indent=4, sort_keys=True))
+
+        with self.metrics.template(self.cfn_template_file_location), self.metrics.phase("fail_pipeline"):
+            fail_pipeline = self._fail_pipeline(cfn_template)
 
         if fail_pipeline:
             logging.critical(f"{num_offending_entries} offending entries found")
@@ -227,10 +2326,465 @@ class CcValidator:
             )
             sys.exit()
 
+    def _scan(self, cfn_template_file_location, output_file, index=None, cfn_template=None):
+        if cfn_template is None:
+            with self.metrics.phase("read_template"):
+                cfn_template = self.read_template(cfn_template_file_location)
+
+        local_entries = []
+
+        if self.local_rules != "disabled":
+            with self.metrics.phase("local_rules"):
+                local_entries = self.run_local_rules(cfn_template)
+
+        if self.skip_conformity_scan(local_entries):
+            findings = {"data": local_entries}
+
+        else:
+            # the template is read, parsed and split once, however many profiles it's scanned against
+            with self.metrics.phase("generate_payload"):
+                contents = self.split_template_contents(cfn_template)
+
+            with self.metrics.phase("run_validation"):
+                findings = self.run_profile_validations(contents)
+
+            if local_entries and "data" in findings:
+                findings["data"] = itertools.chain(local_entries, findings["data"])
+
+        # when responses are streamed, this includes the time spent receiving the check entries
+        with self.metrics.phase("get_results"):
+            offending_entries = self.get_results(findings, output_file=output_file, index=index)
+
+        return cfn_template, offending_entries
+
+    def scan_template(self, cfn_template_file_location, cfn_template=None, coalescer=None):
+        if coalescer is None and self.journal is None:
+            return self._scan_template(cfn_template_file_location, cfn_template)
+
+        if cfn_template is None:
+            with self.metrics.template(cfn_template_file_location), self.metrics.phase("read_template"):
+                cfn_template = self.read_template(cfn_template_file_location)
+
+        if self.journal is not None:
+            record = self.journal.get(cfn_template_file_location, cfn_template.content_hash)
+
+            if record is not None:
+                logging.info(f"Reusing the journalled scan of unchanged template {cfn_template_file_location}")
+                result = self.reuse_result(cfn_template_file_location, record["entries"], cfn_template)
+                result.findings.passed = record["passed"]
+
+                # a resumed journal already has the record, while a rewritten one needs it again for the next run
+                if not self.journal.resume:
+                    self.journal.append(result, cfn_template.content_hash)
+
+                return result
+
+        if coalescer is None:
+            result = self._scan_template(cfn_template_file_location, cfn_template)
+
+        else:
+            result = self._scan_coalesced(cfn_template_file_location, cfn_template, coalescer)
+
+        if self.journal is not None:
+            self.journal.append(result, cfn_template.content_hash)
+
+        return result
+
+    def _scan_coalesced(self, cfn_template_file_location, cfn_template, coalescer):
+        scan, claimed = coalescer.claim(cfn_template.content_hash)
+
+        if not claimed:
+            result = scan.result()
+            logging.info(f"Reusing the scan of identical template {result.template} for {cfn_template_file_location}")
+
+            return ScanResult(
+                template=cfn_template_file_location,
+                offending_entries=list(result.offending_entries),
+                fail_pipeline=result.fail_pipeline,
+                findings=result.findings,
+            )
+
+        try:
+            result = self._scan_template(cfn_template_file_location, cfn_template)
+
+        # templates waiting for this scan fail in the same way
+        except BaseException as e:
+            scan.set_exception(e)
+            raise
+
+        scan.set_result(result)
+
+        return result
+
+    def _scan_template(self, cfn_template_file_location, cfn_template=None):
+        logging.info(f"Scanning template: {cfn_template_file_location}")
+
+        with self.metrics.template(cfn_template_file_location):
+            result = ScanResult(template=cfn_template_file_location)
+            cfn_template, result.offending_entries = self._scan(
+                cfn_template_file_location, output_file=None, index=result.findings, cfn_template=cfn_template
+            )
+
+            if result.offending_entries:
+                with self.metrics.phase("fail_pipeline"):
+                    result.fail_pipeline = self._fail_pipeline(cfn_template)
+
+        return result
+
+    def scan_templates(self, templates, cfn_templates=None):
+        """Scans templates with up to `max_concurrency` requests in flight. Results are returned in input order."""
+        if self.nested_stacks == "enabled" and cfn_templates is None:
+            return self.scan_stack_graph(templates)
+
+        cfn_templates = cfn_templates or [None] * len(templates)
+        coalescer = ScanCoalescer() if self.deduplicate_templates and len(templates) > 1 else None
+        scan_template = functools.partial(self.scan_template, coalescer=coalescer)
+
+        if self.max_concurrency == 1 or len(templates) == 1:
+            results = [
+                scan_template(template, cfn_template) for template, cfn_template in zip(templates, cfn_templates)
+            ]
+
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(templates))) as executor:
+                results = list(executor.map(scan_template, templates, cfn_templates))
+
+        if coalescer and len(coalescer.scans) < len(templates):
+            logging.info(
+                f"{len(templates) - len(coalescer.scans)} of {len(templates)} template(s) were identical to another "
+                f"template and were not scanned again"
+            )
+
+        return results
+
+    def build_stack_graph(self, templates):
+        """
+        Reads `templates` and the local templates of their nested stacks, following nested stacks at any depth. Returns
+        every template read, once each, and the stack graph of each template's nested templates, both keyed by path.
+        """
+        cfn_templates = {}
+        stack_graph = {}
+        pending = [os.path.normpath(template) for template in reversed(templates)]
+
+        while pending:
+            template = pending.pop()
+
+            if template in stack_graph:
+                continue
+
+            cfn_templates[template] = cfn_template = self.read_template(template)
+
+            try:
+                nested_templates = get_nested_templates(cfn_template)
+
+            # invalid templates are reported when they're scanned
+            except ValueError:
+                nested_templates = []
+
+            stack_graph[template] = []
+
+            for nested_template in nested_templates:
+                if not os.path.isfile(nested_template):
+                    logging.warning(f"Unable to find the nested stack template of {template}: {nested_template}")
+                    continue
+
+                stack_graph[template].append(nested_template)
+                pending.append(nested_template)
+
+        return cfn_templates, stack_graph
+
+    def scan_stack_graph(self, templates):
+        """
+        Scans `templates` and the local templates of their nested stacks. A nested template is scanned once however
+        many parents share it, and its offending entries are added to the result of every parent above it, tagged with
+        a `nested-template` attribute. Results are returned in input order, followed by nested templates which weren't
+        in `templates`.
+        """
+        cfn_templates, stack_graph = self.build_stack_graph(templates)
+        paths = {os.path.normpath(template): template for template in templates}
+        graph_templates = list(stack_graph)
+
+        num_parents = {}
+
+        for nested_templates in stack_graph.values():
+            for nested_template in nested_templates:
+                num_parents[nested_template] = num_parents.get(nested_template, 0) + 1
+
+        num_shared = sum(1 for count in num_parents.values() if count > 1)
+        logging.info(
+            f"Found {len(graph_templates)} unique template(s) in the nested stack graph, "
+            f"{num_shared} of them shared by more than one parent"
+        )
+
+        results = self.scan_templates(
+            [paths.get(template, template) for template in graph_templates],
+            [cfn_templates[template] for template in graph_templates],
+        )
+        results_by_template = dict(zip(graph_templates, results))
+        own_entries = {template: list(result.offending_entries) for template, result in results_by_template.items()}
+
+        for template, result in results_by_template.items():
+            descendants = get_descendants(stack_graph, template)
+            result.nested_templates = [paths.get(descendant, descendant) for descendant in descendants]
+
+            for descendant in descendants:
+                nested_template = results_by_template[descendant].template
+                result.offending_entries.extend(
+                    {**entry, "attributes": {**entry["attributes"], "nested-template": nested_template}}
+                    for entry in own_entries[descendant]
+                )
+
+            # a parent's `FailConformityPipeline` setting also applies to the offending entries of its nested stacks
+            if result.offending_entries and not own_entries[template]:
+                result.fail_pipeline = self._fail_pipeline(cfn_templates[template])
+
+        input_order = {template: position for position, template in enumerate(paths)}
+
+        return sorted(results, key=lambda result: input_order.get(os.path.normpath(result.template), len(input_order)))
+
+    def write_metrics(self):
+        """Writes the run's metrics to `CC_METRICS_FILE` as JSON and `CC_METRICS_PROM_FILE` in Prometheus format."""
+        metrics_file = os.getenv("CC_METRICS_FILE")
+        prometheus_file = os.getenv("CC_METRICS_PROM_FILE")
+
+        if not metrics_file and not prometheus_file:
+            return
+
+        try:
+            self.metrics.write(metrics_file, prometheus_file)
+
+        except OSError as e:
+            logging.warning(f"Unable to write metrics: {e}")
+
+    def update_baseline(self, paths=None):
+        """Scans templates, ignoring the current baseline, and writes their offending entries to the baseline file."""
+        baseline_file = os.getenv("CC_BASELINE_FILE", DEFAULT_BASELINE_FILE)
+        templates = self.detect_templates(find_templates(paths)) if paths else [self.cfn_template_file_location]
+        self.baseline = None
+
+        results = self.scan_templates(templates)
+        baseline = Baseline.from_entries(entry for result in results for entry in result.offending_entries)
+        baseline.write(baseline_file)
+
+        logging.info(f"Wrote {len(baseline)} accepted finding(s) from {len(templates)} template(s) to {baseline_file}")
+
+    def reuse_result(self, cfn_template_file_location, previous_entries, cfn_template=None):
+        """Builds the result of an unchanged template from its previous findings, filtered by the current risk level."""
+        result = ScanResult(template=cfn_template_file_location)
+
+        for entry in previous_entries:
+            if self.is_suppressed(entry):
+                result.findings.suppressed.append(entry)
+                continue
+
+            risk_level_num = result.findings.add(entry)
+
+            if risk_level_num is not None and risk_level_num >= self.get_offending_risk_level_num(entry):
+                result.offending_entries.append(entry)
+
+        if result.offending_entries:
+            result.fail_pipeline = self._fail_pipeline(cfn_template or self.read_template(cfn_template_file_location))
+
+        return result
+
+    def scan_changed_templates(self, templates):
+        """
+        Scans the templates which have changed, reusing the journalled findings of the previous run for every other
+        template whose contents still match. The journal has to be opened with the changed files first.
+        """
+        completed = self.journal.completed if self.journal is not None else {}
+
+        if not completed:
+            logging.warning("Unable to read the previous run's journal. Scanning all templates")
+            return self.scan_templates(templates)
+
+        # nested stack findings are attributed to parents again on every run, so unchanged parents can be reused too
+        results = self.scan_templates(templates)
+
+        logging.info(
+            f"{self.journal.num_missed} of {self.journal.num_missed + self.journal.num_reused} template(s) had changed, "
+            f"had not been scanned before or had been scanned with different settings. The previous findings were "
+            f"reused for the rest"
+        )
+
+        return results
+
+    def write_batch_results(self, results, output_file=OUTPUT_FILE):
+        # every template is recorded, even without offending entries, so later runs know it has been scanned
+        with FindingsWriter(output_file, self.output_format, grouped=True) as writer:
+            for result in results:
+                writer.start_template(result.template)
+
+                for entry in result.offending_entries:
+                    writer.write(entry, template=result.template)
+
+    def detect_templates(self, files):
+        """Drops files which aren't CloudFormation templates, before any of them are sent to Conformity."""
+        if self.template_detection == "disabled":
+            return files
+
+        strict = self.template_detection == "strict"
+        templates = [file for file in files if is_cfn_template(file, strict=strict)]
+
+        for file in sorted(set(files) - set(templates)):
+            logging.info(f"Skipping file which is not a CloudFormation template: {file}")
+
+        return templates
+
+    def open_journal(self, resume=False, changed_files=None):
+        """
+        Starts journalling scans to `CC_JOURNAL_FILE`. With `resume`, continues an interrupted run's journal, and with
+        `changed_files`, reuses the previous run's journal for the other templates.
+        """
+        journal_file = os.getenv("CC_JOURNAL_FILE", DEFAULT_JOURNAL_FILE)
+
+        try:
+            self.journal = ScanJournal(
+                journal_file, resume=resume, changed_files=changed_files, settings=self.get_settings_fingerprint()
+            )
+
+        except OSError as e:
+            logging.warning(f"Unable to open the journal {journal_file}: {e}. The batch can't be resumed if it fails")
+            return
+
+        if resume:
+            logging.info(f"Resuming from {len(self.journal.completed)} template(s) recorded in {journal_file}")
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def run_batch(self, paths, changed_files=None, resume=False):
+        templates = self.detect_templates(find_templates(paths))
+
+        if not templates:
+            logging.critical(f"No templates found in: {' '.join(paths)}")
+            sys.exit(1)
+
+        logging.info(f"Found {len(templates)} template(s) to scan")
+        self.open_journal(resume, changed_files)
+
+        try:
+            if changed_files is None:
+                results = self.scan_templates(templates)
+
+            else:
+                results = self.scan_changed_templates(templates)
+
+        finally:
+            self.close_journal()
+
+        self.write_batch_results(results)
+
+        batch_findings = FindingsIndex()
+
+        for result in results:
+            batch_findings.update(result.findings)
+
+        self.log_summary(batch_findings)
+
+        offending_results = [result for result in results if result.offending_entries]
+
+        if not offending_results:
+            logging.info(f"No offending entries found in {len(results)} template(s)")
+            sys.exit()
+
+        for result in offending_results:
+            logging.info(f"{result.template}: {len(result.offending_entries)} offending entries found")
+
+        failed_results = [result for result in offending_results if result.fail_pipeline]
+
+        if failed_results:
+            logging.critical(f"{len(failed_results)} of {len(results)} template(s) have offending entries")
+            sys.exit(1)
+
+        else:
+            logging.info(
+                f"\nPipeline failure has been disabled so the script will exit with a 0 code.\n"
+                f"{len(offending_results)} of {len(results)} template(s) have offending entries."
+            )
+            sys.exit()
+
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Scans CloudFormation templates with Cloud Conformity")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Template files, directories or glob patterns to scan in a single run. If omitted, the template "
+        "set in CFN_TEMPLATE_FILE_LOCATION is scanned",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always send templates to Conformity instead of reusing cached scan results",
+    )
+    parser.add_argument(
+        "--changed-since",
+        metavar="GIT_REF",
+        help="Batch mode only. Only scan templates added or modified since this git ref, reusing the findings "
+        f"journalled in CC_JOURNAL_FILE (default: {DEFAULT_JOURNAL_FILE}) by the previous run for every other template",
+    )
+    parser.add_argument(
+        "--changed-files",
+        metavar="FILE",
+        help="Batch mode only. A file listing changed paths, one per line, or '-' to read them from stdin. Only these "
+        "templates are scanned, reusing the journalled findings of every other template",
+    )
+
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Scan the templates and write their offending entries to CC_BASELINE_FILE (default: "
+        f"{DEFAULT_BASELINE_FILE}) as accepted findings, replacing the current baseline",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Batch mode only. Skip the templates which an interrupted run recorded in its journal, CC_JOURNAL_FILE "
+        f"(default: {DEFAULT_JOURNAL_FILE}), unless they have changed since",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):  # pragma: no cover
+    args = parse_args(argv)
+
+    if args.update_baseline:
+        cc = CcValidator(template_required=not args.paths, use_cache=not args.no_cache)
+
+        try:
+            cc.update_baseline(args.paths)
+
+        finally:
+            cc.write_metrics()
+
+    elif args.paths:
+        changed_files = None
+
+        if args.changed_since or args.changed_files:
+            changed_files = get_changed_files(args.changed_since, args.changed_files)
+
+        cc = CcValidator(template_required=False, use_cache=not args.no_cache)
+
+        try:
+            cc.run_batch(args.paths, changed_files, resume=args.resume)
+
+        finally:
+            cc.write_metrics()
+
+    else:
+        cc = CcValidator(use_cache=not args.no_cache)
+
+        try:
+            cc.run()
 
-def main():  # pragma: no cover
-    cc = CcValidator()
-    cc.run()
+        finally:
+            cc.write_metrics()
 
 
 if __name__ == "__main__":  # pragma: no cover
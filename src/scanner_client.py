@@ -0,0 +1,209 @@
+"""
+Thin client for `scanner_daemon.py`, used in place of `python3 scanner.py` in pipelines.
+
+It doesn't load the scanner's HTTP or YAML dependencies, so it starts in milliseconds. The templates are scanned by
+the daemon at `CC_DAEMON_URL` (default: http://127.0.0.1:8756), and the findings are written to `findings.json` in the
+same format and with the same exit code as `scanner.py`. The job's settings are sent with the scan request, and if the
+daemon was started with different settings, or isn't running, the templates are scanned in this process instead. So
+are they with any of `scanner.py`'s options, such as `--no-cache` or `--resume`, which the daemon doesn't support.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import urllib.error
+import urllib.request
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+OUTPUT_FILE = "findings.json"
+DEFAULT_DAEMON_URL = "http://127.0.0.1:8756"
+DEFAULT_DAEMON_TIMEOUT = 600
+
+# the environment variables which change a scan's findings or verdict. They're read once when the daemon starts, so
+# jobs are only scanned by the daemon when theirs are the same
+JOB_SETTINGS = (
+    "CC_API_KEY",
+    "CC_REGION",
+    "CC_RISK_LEVEL",
+    "CC_PROFILE_ID",
+    "CC_BASELINE_FILE",
+    "CC_LOCAL_RULES",
+    "CC_TEMPLATE_DETECTION",
+    "CC_NESTED_STACKS",
+    "FAIL_PIPELINE",
+    "FAIL_PIPELINE_CFN",
+)
+
+
+def get_job_settings():
+    """Returns this process's `JOB_SETTINGS`, normalised so the client's and the daemon's can be compared."""
+    settings = {}
+
+    for name in JOB_SETTINGS:
+        value = os.getenv(name) or None
+
+        if value is None:
+            settings[name] = value
+            continue
+
+        # the key itself never leaves the process
+        if name == "CC_API_KEY":
+            value = hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+        # the daemon may have been started from a different directory
+        elif name == "CC_BASELINE_FILE":
+            value = os.path.abspath(value)
+
+        elif name != "CC_PROFILE_ID":
+            value = value.lower()
+
+        settings[name] = value
+
+    return settings
+
+
+def request_scan(paths, daemon_url=DEFAULT_DAEMON_URL, timeout=DEFAULT_DAEMON_TIMEOUT, single=False):
+    """
+    Sends a scan request to the daemon. With `single`, the one template in `paths` is scanned like
+    `CFN_TEMPLATE_FILE_LOCATION` is by `scanner.py`. Returns the daemon's response, or `None` if the daemon can't be
+    reached or was started with different settings.
+    """
+    # the daemon may have been started from a different directory
+    paths = [os.path.abspath(path) for path in paths]
+    scan_request = {"template": paths[0]} if single else {"paths": paths}
+    scan_request["settings"] = get_job_settings()
+    body = json.dumps(scan_request).encode("utf-8")
+    request = urllib.request.Request(
+        f"{daemon_url.rstrip('/')}/scan", data=body, headers={"Content-Type": "application/json"}, method="POST"
+    )
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            return json.load(resp)
+
+    except urllib.error.HTTPError as e:
+        try:
+            error = json.load(e).get("error")
+
+        except ValueError:
+            error = None
+
+        if e.code == 409:
+            logging.warning(f"Unable to scan the templates with the scanner daemon: {error or e}")
+            return None
+
+        logging.critical(f"The scanner daemon was unable to scan the templates: {error or e}")
+        sys.exit(1)
+
+    except (urllib.error.URLError, ConnectionError) as e:
+        logging.warning(f"Unable to reach the scanner daemon at {daemon_url}: {e}")
+        return None
+
+
+def write_findings(scan_response, output_file=OUTPUT_FILE, single=False):
+    """
+    Writes the offending entries like `scanner.py`: a single template's entries as a flat list, only if there are any,
+    and a batch's grouped by template, including the templates without any.
+    """
+    # only imported once the scan is done, as it's the scanner's own writer which keeps the formats the same
+    from scanner import OUTPUT_FORMATS, FindingsWriter
+
+    output_format = os.getenv("CC_OUTPUT_FORMAT", "json").lower()
+
+    if output_format not in OUTPUT_FORMATS:
+        logging.critical(f"Unknown output format. Please use one of {' | '.join(OUTPUT_FORMATS)}")
+        sys.exit(1)
+
+    with FindingsWriter(output_file, output_format, grouped=not single) as writer:
+        for result in scan_response["results"]:
+            if not single:
+                writer.start_template(result["template"])
+
+            for entry in result["offending_entries"]:
+                writer.write(entry, template=None if single else result["template"])
+
+
+def report(scan_response):
+    """Logs the daemon's findings and exits with the same code as `scanner.py`."""
+    results = scan_response["results"]
+    offending_results = [result for result in results if result["offending_entries"]]
+
+    if not offending_results:
+        logging.info(f"No offending entries found in {len(results)} template(s)")
+        sys.exit()
+
+    for result in offending_results:
+        logging.info(f"{result['template']}: {len(result['offending_entries'])} offending entries found")
+
+    failed_results = [result for result in offending_results if result["fail_pipeline"]]
+
+    if failed_results:
+        logging.critical(f"{len(failed_results)} of {len(results)} template(s) have offending entries")
+        sys.exit(1)
+
+    else:
+        logging.info(
+            f"\nPipeline failure has been disabled so the script will exit with a 0 code.\n"
+            f"{len(offending_results)} of {len(results)} template(s) have offending entries."
+        )
+        sys.exit()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scans CloudFormation templates with a running scanner daemon")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Template files, directories or glob patterns to scan. If omitted, the template set in "
+        "CFN_TEMPLATE_FILE_LOCATION is scanned",
+    )
+
+    # the scanner's other arguments, such as `--no-cache` or `--resume`, are passed on to it
+    return parser.parse_known_args(argv)
+
+
+def scan_in_process(argv):
+    logging.warning("Scanning the templates in this process instead")
+
+    # only imported when needed, as the scanner's dependencies take far longer to load than the client
+    import scanner
+
+    scanner.main(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args, scanner_args = parse_args(argv)
+
+    if scanner_args:
+        logging.info(f"The scanner daemon doesn't support {' '.join(scanner_args)}")
+        scan_in_process(argv)
+        return
+
+    paths = args.paths
+    single = not paths
+
+    if single:
+        try:
+            paths = [os.environ["CFN_TEMPLATE_FILE_LOCATION"]]
+
+        except KeyError:
+            logging.error("Please ensure all environment variables are set")
+            sys.exit(1)
+
+    scan_response = request_scan(paths, os.getenv("CC_DAEMON_URL", DEFAULT_DAEMON_URL), single=single)
+
+    if scan_response is None:
+        scan_in_process(argv)
+        return
+
+    write_findings(scan_response, single=single)
+    report(scan_response)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
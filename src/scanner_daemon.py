@@ -0,0 +1,213 @@
+"""
+Long running scanner daemon. A single `CcValidator` is created at startup and shared by every scan, so its settings,
+connection pool, rate limiter and result cache stay warm between pipeline jobs on the same build host.
+
+Start it with the same environment variables as `scanner.py` (`CFN_TEMPLATE_FILE_LOCATION` isn't needed), then run
+`scanner_client.py` in place of `scanner.py`. The settings which change a scan's findings or verdict are read once at
+startup, so jobs with different settings are rejected and the client scans them itself:
+
+    python3 src/scanner_daemon.py --port 8756
+
+Endpoints:
+  * `POST /scan` with `{"paths": [...], "settings": {...}}`: scans the templates, directories or glob patterns and
+    returns every template's offending entries, a summary and whether the pipeline should fail. A single template is
+    scanned like `CFN_TEMPLATE_FILE_LOCATION` with `{"template": ..., "settings": {...}}` instead. Returns a 409 if the
+    job's settings differ from the daemon's
+  * `GET /health`: returns `{"status": "ok"}`
+  * `GET /metrics`: returns the daemon's scan metrics in the Prometheus text format
+"""
+
+import argparse
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scanner import CcValidator, ErrorCapture, FindingsIndex, ScanMetrics, find_templates
+from scanner_client import get_job_settings
+
+DEFAULT_DAEMON_HOST = "127.0.0.1"
+DEFAULT_DAEMON_PORT = 8756
+MAX_REQUEST_SIZE = 1024 * 1024
+# latency percentiles are taken from the latest requests only, so the daemon's metrics stay the same size
+METRICS_LATENCY_WINDOW = 10000
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status_code, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+
+        elif self.path == "/metrics":
+            prometheus_metrics = self.server.validator.metrics.to_prometheus().encode("utf-8")
+            self._send(200, prometheus_metrics, content_type="text/plain; version=0.0.4")
+
+        else:
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/scan":
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        content_length = int(self.headers.get("Content-Length", 0))
+
+        if content_length > MAX_REQUEST_SIZE:
+            self._send(413, {"error": "The scan request is too large"})
+            return
+
+        try:
+            scan_request = json.loads(self.rfile.read(content_length))
+            single = "template" in scan_request
+            paths = [scan_request["template"]] if single else scan_request["paths"]
+            settings = scan_request.get("settings", {})
+
+            if not paths or not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise ValueError('"paths" must be a list of templates, directories or glob patterns')
+
+            if not isinstance(settings, dict):
+                raise ValueError('"settings" must be an object')
+
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send(400, {"error": f"Invalid scan request: {e}"})
+            return
+
+        differing_settings = self.server.get_differing_settings(settings)
+
+        if differing_settings:
+            self._send(
+                409,
+                {
+                    "error": f"The scanner daemon was started with different settings: {', '.join(differing_settings)}",
+                    "settings": differing_settings,
+                },
+            )
+            return
+
+        status_code, scan_response = self.server.scan(paths, single=single)
+        self._send(status_code, scan_response)
+
+
+class ScannerDaemon(ThreadingHTTPServer):
+    """Serves scan requests from a background thread per connection, all sharing one `CcValidator`."""
+
+    daemon_threads = True
+
+    def __init__(self, host=DEFAULT_DAEMON_HOST, port=DEFAULT_DAEMON_PORT, validator=None):
+        super().__init__((host, port), ScanRequestHandler)
+        self.validator = validator or CcValidator(template_required=False)
+        self.validator.metrics = ScanMetrics(latency_window=METRICS_LATENCY_WINDOW, per_template=False)
+        self.settings = get_job_settings()
+        self.error_capture = ErrorCapture()
+        logging.getLogger().addHandler(self.error_capture)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def get_differing_settings(self, settings):
+        """Returns the names of the job's settings which differ from the daemon's. Missing settings are unset."""
+        return [name for name, value in self.settings.items() if settings.get(name) != value]
+
+    def scan(self, paths, single=False):
+        """
+        Scans `paths` and returns an HTTP status code and the response body. With `single`, the one template in `paths`
+        is scanned without looking for templates or nested stacks, like `scanner.py` scans `CFN_TEMPLATE_FILE_LOCATION`.
+        """
+        self.error_capture.start()
+
+        try:
+            if single:
+                results = [self.validator.scan_template(paths[0])]
+
+            else:
+                templates = self.validator.detect_templates(find_templates(paths))
+
+                if not templates:
+                    return 400, {"error": f"No templates found in: {' '.join(paths)}"}
+
+                logging.info(f"Scanning {len(templates)} template(s)")
+                results = self.validator.scan_templates(templates)
+
+        # the scan path exits on errors, which would otherwise stop the handler's thread without a response
+        except SystemExit:
+            errors = self.error_capture.stop()
+            return 500, {"error": errors[-1] if errors else "The scan failed. See the scanner daemon's log"}
+
+        except Exception as e:
+            logging.exception("The scan failed")
+            return 500, {"error": f"The scan failed: {e!r}"}
+
+        finally:
+            self.error_capture.stop()
+
+        findings = FindingsIndex()
+
+        for result in results:
+            findings.update(result.findings)
+
+        scan_response = {
+            "results": [
+                {
+                    "template": result.template,
+                    "offending_entries": result.offending_entries,
+                    "fail_pipeline": result.fail_pipeline,
+                }
+                for result in results
+            ],
+            "summary": findings.summary(),
+            "fail_pipeline": any(result.fail_pipeline for result in results),
+        }
+
+        return 200, scan_response
+
+    def server_close(self):
+        logging.getLogger().removeHandler(self.error_capture)
+        super().server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serves Cloud Conformity template scans from a long running process")
+    parser.add_argument(
+        "--host", default=DEFAULT_DAEMON_HOST, help=f"Address to listen on (default: {DEFAULT_DAEMON_HOST})"
+    )
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_DAEMON_PORT, help=f"Port to listen on (default: {DEFAULT_DAEMON_PORT})"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):  # pragma: no cover
+    args = parse_args(argv)
+    daemon = ScannerDaemon(args.host, args.port)
+    logging.info(f"Scanner daemon listening on {daemon.url}")
+
+    try:
+        daemon.serve_forever()
+
+    except KeyboardInterrupt:
+        logging.info("Shutting down the scanner daemon")
+
+    finally:
+        daemon.server_close()
+        daemon.validator.write_metrics()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import async_scanner
+from async_scanner import AsyncScanner, ScanError
+from mock_conformity import MockConformityServer
+from scanner import CcValidator, ScanCache, find_templates
+
+
+def test_scan_many(monkeypatch, template_tree):
+    """
+    GIVEN `AsyncScanner.scan_many` is called
+    WHEN Conformity finds offending entries in every template
+    THEN return each template's result in input order, without exiting
+    """
+
+    templates = find_templates([str(template_tree)])
+
+    async def scan_many():
+        async with AsyncScanner() as scanner:
+            results = await scanner.scan_many(templates)
+            # the connections are closed with the scanner, so whether they're kept alive is checked before
+            return results, [connection.is_idle() for connection in scanner.client._transport._pool.connections]
+
+    with MockConformityServer(num_checks=5, failure_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        monkeypatch.setenv("CC_CACHE", "disabled")
+        results, idle_connections = asyncio.run(scan_many())
+
+    assert [result.template for result in results] == templates
+    assert all(result.error is None for result in results)
+    # one of the five failing checks is below the MEDIUM risk level
+    assert all(len(result.offending_entries) == 4 and result.fail_pipeline for result in results)
+    assert len(server.requests) == 3
+    assert idle_connections and all(idle_connections)
+
+
+def test_scan_retry(monkeypatch, tmp_path):
+    """
+    GIVEN `scan` is called
+    WHEN Conformity keeps responding with a 503
+    THEN retry the request, then return a result with the error set
+    """
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+    monkeypatch.setattr("scanner.get_retry_delay", lambda attempt, retry_after: 0)
+
+    with MockConformityServer(error_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        monkeypatch.setenv("CC_MAX_RETRIES", "2")
+        result = asyncio.run(async_scanner.scan(str(template_path)))
+
+    assert len(server.requests) == 3
+    assert result.offending_entries == []
+    assert "Conformity returned no findings (HTTP 503)" in result.error
+
+
+def test_scan_missing_template(monkeypatch, tmp_path):
+    """
+    GIVEN `scan_many` is called
+    WHEN one of the templates doesn't exist
+    THEN set the error of its result, and still scan the other templates
+    """
+
+    template_path = tmp_path / "template.json"
+    template_path.write_text('{"Resources": {"MyQueue": {"Type": "AWS::SQS::Queue"}}}')
+    missing_path = str(tmp_path / "missing.yaml")
+
+    with MockConformityServer(num_checks=1) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        results = asyncio.run(async_scanner.scan_many([missing_path, str(template_path)]))
+
+    assert results[0].error == f"Template file does not exist: {missing_path}"
+    assert results[1].error is None
+
+
+def test_scan_off_event_loop(monkeypatch, tmp_path):
+    """
+    GIVEN `scan` is called with the cache, local rules and FAIL_PIPELINE_CFN enabled
+    WHEN a template is read, parsed, checked and cached
+    THEN run all of the blocking work in worker threads, off the event loop
+    """
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+    monkeypatch.setenv("FAIL_PIPELINE_CFN", "enabled")
+    monkeypatch.setenv("CC_LOCAL_RULES", "enabled")
+    monkeypatch.setenv("CC_CACHE_DIR", str(tmp_path / "cache"))
+    threads = {}
+
+    def record_thread(cls, name):
+        func = getattr(cls, name)
+
+        def wrapper(*args, **kwargs):
+            threads[name] = threading.current_thread()
+            return func(*args, **kwargs)
+
+        monkeypatch.setattr(cls, name, wrapper)
+
+    for name in ["read_template", "run_local_rules", "split_template_contents", "get_results", "_fail_pipeline"]:
+        record_thread(CcValidator, name)
+
+    for name in ["get", "set"]:
+        record_thread(ScanCache, name)
+
+    with MockConformityServer(num_checks=5, failure_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        result = asyncio.run(async_scanner.scan(str(template_path)))
+
+    assert result.error is None
+    assert result.fail_pipeline
+    assert len(threads) == 7
+    assert threading.main_thread() not in threads.values()
+
+
+def test_scan_invalid_template(monkeypatch, tmp_path):
+    """
+    GIVEN `scan_many` is called with FAIL_PIPELINE_CFN enabled
+    WHEN one of the templates is invalid YAML
+    THEN set the error of its result instead of raising, and still scan the other templates
+    """
+
+    invalid_path = tmp_path / "invalid.yaml"
+    invalid_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n  - bad: [\n")
+    template_path = tmp_path / "template.json"
+    template_path.write_text('{"Resources": {"MyQueue": {"Type": "AWS::SQS::Queue"}}}')
+    monkeypatch.setenv("FAIL_PIPELINE_CFN", "enabled")
+
+    with MockConformityServer(num_checks=3, failure_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        monkeypatch.setenv("CC_CACHE", "disabled")
+        results = asyncio.run(async_scanner.scan_many([str(invalid_path), str(template_path)]))
+
+    assert results[0].error.startswith("Invalid YAML")
+    assert results[0].offending_entries == []
+    assert results[1].error is None
+    assert results[1].offending_entries
+
+
+def test_invalid_configuration(monkeypatch):
+    """
+    GIVEN `AsyncScanner` is instantiated
+    WHEN the environment variables are invalid
+    THEN raise a `ScanError` instead of exiting
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "SEVERE")
+
+    with pytest.raises(ScanError, match="Unknown risk level"):
+        AsyncScanner()
+
+
+def test_scan_proxy(monkeypatch, tmp_path):
+    """
+    GIVEN `scan` is called with HTTP_PROXY set
+    WHEN the scan request is sent
+    THEN send it through the proxy, like `scanner.py`
+    """
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+
+    for name in ["NO_PROXY", "no_proxy", "HTTP_PROXY", "http_proxy", "ALL_PROXY", "all_proxy"]:
+        monkeypatch.delenv(name, raising=False)
+
+    with MockConformityServer(num_checks=5, failure_rate=1.0) as proxy:
+        monkeypatch.setenv("CC_API_ENDPOINT", "http://conformity.invalid")
+        monkeypatch.setenv("CC_CACHE", "disabled")
+        monkeypatch.setenv("HTTP_PROXY", proxy.url)
+        result = asyncio.run(async_scanner.scan(str(template_path)))
+
+    assert result.error is None
+    assert [request["path"] for request in proxy.requests] == ["http://conformity.invalid/v1/iac-scanning/scan"]
+
+
+def test_scan_profiles(monkeypatch, tmp_path):
+    """
+    GIVEN `scan` is called
+    WHEN `CC_PROFILE_ID` lists several profiles
+    THEN scan the template against every profile and combine their offending entries
+    """
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+
+    with MockConformityServer(num_checks=5, failure_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        monkeypatch.setenv("CC_CACHE", "disabled")
+        monkeypatch.setenv("CC_PROFILE_ID", "prod:LOW,dev:EXTREME")
+        result = asyncio.run(async_scanner.scan(str(template_path)))
+
+    assert sorted(json.loads(request["body"])["data"]["attributes"]["profileId"] for request in server.requests) == [
+        "dev",
+        "prod",
+    ]
+    assert [entry["attributes"]["profile-id"] for entry in result.offending_entries] == ["prod"] * 5 + ["dev"]
@@ -0,0 +1,164 @@
+"""
+Benchmarks the scan path end to end against a local mock of the Conformity scan endpoint.
+
+Every combination of template count and template size is scanned in batch mode, reporting throughput, scan latency
+percentiles and peak memory. Run it from the repository root:
+
+    python tests/benchmark.py --templates 1 10 100 --resources 10 500 --latency 0.05 --json bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "src"))
+
+from mock_conformity import MockConformityServer  # noqa: E402
+from scanner import CcValidator, percentile  # noqa: E402
+
+
+@contextmanager
+def environment(**env_vars):
+    original = {name: os.environ.get(name) for name in env_vars}
+    os.environ.update({name: str(value) for name, value in env_vars.items()})
+
+    try:
+        yield
+
+    finally:
+        for name, value in original.items():
+            if value is None:
+                os.environ.pop(name, None)
+
+            else:
+                os.environ[name] = value
+
+
+def write_templates(template_dir, num_templates, num_resources):
+    templates = []
+
+    for i in range(num_templates):
+        resources = {
+            f"Bucket{i}x{j}": {"Type": "AWS::S3::Bucket", "Properties": {"BucketName": f"bucket-{i}-{j}"}}
+            for j in range(num_resources)
+        }
+        template_path = os.path.join(template_dir, f"template-{i:05d}.json")
+
+        with open(template_path, "w") as f:
+            json.dump({"AWSTemplateFormatVersion": "2010-09-09", "Resources": resources}, f, indent=2)
+
+        templates.append(template_path)
+
+    return templates
+
+
+def run_benchmark(num_templates, num_resources, latency=0.0, error_rate=0.0, num_checks=18, concurrency=4, **env):
+    """Scans `num_templates` templates of `num_resources` resources each and returns the measurements."""
+    with tempfile.TemporaryDirectory() as work_dir, MockConformityServer(latency, error_rate, num_checks) as server:
+        templates = write_templates(work_dir, num_templates, num_resources)
+        env_vars = {
+            "CC_REGION": "us-west-2",
+            "CC_API_KEY": "benchmark",
+            "CC_API_ENDPOINT": server.url,
+            "CC_RISK_LEVEL": "LOW",
+            "CC_MAX_CONCURRENCY": concurrency,
+            "CC_RATE_LIMIT": 1000000,
+            "CC_CACHE": "disabled",
+            **env,
+        }
+
+        with environment(**env_vars):
+            cc = CcValidator(template_required=False, use_cache=False)
+            latencies = []
+            scan_template = cc.scan_template
+
+            def timed_scan_template(*args, **kwargs):
+                start = time.perf_counter()
+                result = scan_template(*args, **kwargs)
+                latencies.append(time.perf_counter() - start)
+                return result
+
+            def scan():
+                results = cc.scan_templates(templates)
+                cc.write_batch_results(results, output_file=os.path.join(work_dir, "findings.json"))
+
+            cc.scan_template = timed_scan_template
+            start = time.perf_counter()
+            scan()
+            elapsed = time.perf_counter() - start
+            num_requests = len(server.requests)
+            request_bytes = sum(len(request["body"]) for request in server.requests)
+
+            # tracing allocations slows the scan path down several times, so memory is measured in a second run
+            cc.scan_template = scan_template
+            tracemalloc.start()
+            scan()
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        return {
+            "templates": num_templates,
+            "resources": num_resources,
+            "concurrency": concurrency,
+            "requests": num_requests,
+            "request_bytes": request_bytes,
+            "elapsed_s": elapsed,
+            "throughput_per_s": num_templates / elapsed,
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p95_s": percentile(latencies, 95),
+            "latency_p99_s": percentile(latencies, 99),
+            "peak_memory_bytes": peak_memory,
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the scanner against a local mock Conformity endpoint")
+    parser.add_argument("--templates", type=int, nargs="+", default=[1, 10, 100], help="Template counts to scan")
+    parser.add_argument("--resources", type=int, nargs="+", default=[10, 200], help="Resources per template")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock endpoint latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 503")
+    parser.add_argument("--checks", type=int, default=18, help="Check entries in every mock response")
+    parser.add_argument("--concurrency", type=int, default=4, help="CC_MAX_CONCURRENCY for the scanner")
+    parser.add_argument("--json", metavar="FILE", help="Also write the measurements to this file as JSON")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    measurements = []
+
+    print(
+        f"{'templates':>9} {'resources':>9} {'seconds':>8} {'tmpl/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak MiB':>9}"
+    )
+
+    for num_templates in args.templates:
+        for num_resources in args.resources:
+            m = run_benchmark(
+                num_templates, num_resources, args.latency, args.error_rate, args.checks, args.concurrency
+            )
+            measurements.append(m)
+
+            print(
+                f"{m['templates']:>9} {m['resources']:>9} {m['elapsed_s']:>8.2f} {m['throughput_per_s']:>8.1f} "
+                f"{m['latency_p50_s'] * 1000:>8.1f} {m['latency_p95_s'] * 1000:>8.1f} "
+                f"{m['latency_p99_s'] * 1000:>8.1f} {m['peak_memory_bytes'] / 2 ** 20:>9.2f}"
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(measurements, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
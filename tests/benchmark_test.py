@@ -0,0 +1,55 @@
+import pytest
+
+from benchmark import run_benchmark
+from mock_conformity import MockConformityServer, make_report
+from scanner import CcValidator
+
+
+def test_mock_report_shape(conformity_report):
+    """
+    GIVEN the mock Conformity endpoint builds a report
+    WHEN it is compared to a real report
+    THEN its check entries have the same shape
+    """
+
+    mock_entry = make_report(num_checks=1)["data"][0]
+    real_entry = conformity_report["data"][0]
+
+    assert mock_entry.keys() == real_entry.keys()
+    assert mock_entry["attributes"].keys() == real_entry["attributes"].keys()
+
+
+def test_run_validation_mock_endpoint(monkeypatch):
+    """
+    GIVEN `CC_API_ENDPOINT` points at the mock Conformity endpoint
+    WHEN `run_validation` is called
+    THEN send the scan request to it and return its report
+    """
+
+    with MockConformityServer(num_checks=5) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+
+        c = CcValidator(use_cache=False)
+        findings = c.run_validation(c.generate_payload("Resources: {}"))
+
+    assert len(findings["data"]) == 5
+    assert server.requests[0]["path"] == "/v1/iac-scanning/scan"
+    assert server.requests[0]["headers"]["Authorization"].startswith("ApiKey ")
+
+
+@pytest.mark.benchmark
+def test_run_benchmark():
+    """
+    GIVEN the benchmark harness is run against the mock Conformity endpoint
+    WHEN several templates are scanned concurrently
+    THEN report throughput, latency percentiles and peak memory for one request per template
+    """
+
+    measurements = run_benchmark(num_templates=6, num_resources=5, latency=0.05, concurrency=3)
+
+    assert measurements["requests"] == 6
+    assert measurements["latency_p50_s"] <= measurements["latency_p99_s"]
+    assert measurements["peak_memory_bytes"] > 0
+
+    # two rounds of three concurrent requests, rather than six sequential ones
+    assert measurements["elapsed_s"] < 6 * 0.05
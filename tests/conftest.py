@@ -13,13 +13,27 @@ sys.path.insert(0, APP_DIR)
 
 def pytest_configure(config):
     config.addinivalue_line("markers", "external: tests which make external API calls")
+    config.addinivalue_line("markers", "benchmark: tests which run the benchmark harness against a mock endpoint")
+
+
+def pytest_collection_modifyitems(config, items):
+    # benchmarks assert on wall clock time, which is flaky on loaded agents, so they only run when selected
+    if "benchmark" in config.getoption("markexpr"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="benchmarks only run with -m benchmark")
+
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
 
 
 @pytest.fixture(autouse=True)
-def set_env_vars(monkeypatch):
+def set_env_vars(monkeypatch, tmp_path_factory):
     valid_template_file_path = f"{TEMPLATE_DIR}/secure-s3-bucket.json"
     monkeypatch.setenv("CFN_TEMPLATE_FILE_LOCATION", valid_template_file_path)
     monkeypatch.setenv("CC_RISK_LEVEL", "MEDIUM")
+    monkeypatch.setenv("CC_CACHE_DIR", str(tmp_path_factory.mktemp("cache")))
 
 
 @pytest.fixture
@@ -37,6 +51,24 @@ def disabled_failed_pipeline_templates(request):
     return request.param
 
 
+@pytest.fixture
+def template_tree(tmp_path):
+    templates = {
+        "app/bucket.yaml": "---\nResources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n",
+        "app/nested/queue.json": '{"Resources": {"MyQueue": {"Type": "AWS::SQS::Queue"}}}',
+        "network/vpc.yml": "Resources:\n  MyVpc:\n    Type: AWS::EC2::VPC\n",
+        "app/README.md": "# not a template",
+        ".git/config.yaml": "core: {}",
+    }
+
+    for name, contents in templates.items():
+        template_path = tmp_path / name
+        template_path.parent.mkdir(parents=True, exist_ok=True)
+        template_path.write_text(contents)
+
+    return tmp_path
+
+
 @pytest.fixture
 def conformity_report():
     return {
@@ -0,0 +1,162 @@
+import pytest
+
+from local_rules import LOCAL_RULES, evaluate_local_rules, local_rule
+from scanner import CfnTemplate
+
+
+def failures(template):
+    return {
+        (entry["relationships"]["rule"]["data"]["id"], entry["attributes"]["resource"])
+        for entry in evaluate_local_rules(template)
+        if entry["attributes"]["status"] == "FAILURE"
+    }
+
+
+def test_insecure_s3_bucket():
+    """
+    GIVEN the local rules are evaluated
+    WHEN an S3 bucket has a public ACL and no encryption, versioning or public access block
+    THEN return a failing entry for each misconfiguration
+    """
+
+    template = {"Resources": {"MyS3Bucket": {"Type": "AWS::S3::Bucket", "Properties": {"AccessControl": "PublicRead"}}}}
+
+    assert failures(template) == {
+        ("LOCAL-S3-001", "MyS3Bucket"),
+        ("LOCAL-S3-002", "MyS3Bucket"),
+        ("LOCAL-S3-003", "MyS3Bucket"),
+        ("LOCAL-S3-004", "MyS3Bucket"),
+    }
+
+
+def test_secure_s3_bucket():
+    """
+    GIVEN the local rules are evaluated
+    WHEN an S3 bucket is private, encrypted and versioned, with every public access block setting enabled
+    THEN return only passing entries
+    """
+
+    block_settings = ("BlockPublicAcls", "BlockPublicPolicy", "IgnorePublicAcls", "RestrictPublicBuckets")
+    template = {
+        "Resources": {
+            "MyS3Bucket": {
+                "Type": "AWS::S3::Bucket",
+                "Properties": {
+                    "AccessControl": "Private",
+                    "BucketEncryption": {"ServerSideEncryptionConfiguration": []},
+                    "VersioningConfiguration": {"Status": "Enabled"},
+                    "PublicAccessBlockConfiguration": {setting: True for setting in block_settings},
+                },
+            }
+        }
+    }
+
+    entries = evaluate_local_rules(template)
+
+    assert len(entries) == 4
+    assert not failures(template)
+
+
+def test_short_form_template():
+    """
+    GIVEN the local rules are evaluated against a parsed YAML template
+    WHEN its resources use short form intrinsic functions
+    THEN treat the unresolvable values as passing and check the rest
+    """
+
+    text = """
+Resources:
+  AdminSecurityGroup:
+    Type: AWS::EC2::SecurityGroup
+    Properties:
+      SecurityGroupIngress:
+        - {IpProtocol: tcp, FromPort: 20, ToPort: 25, CidrIp: 0.0.0.0/0}
+        - {IpProtocol: tcp, FromPort: 3389, ToPort: 3389, CidrIp: !Ref AllowedCidr}
+  Database:
+    Type: AWS::RDS::DBInstance
+    Properties:
+      StorageEncrypted: !Ref Encrypt
+      PubliclyAccessible: "true"
+  Admin:
+    Type: AWS::IAM::Role
+    Properties:
+      Policies:
+        - PolicyDocument:
+            Statement:
+              - {Effect: Allow, Action: "*", Resource: "*"}
+"""
+
+    assert failures(CfnTemplate(text, "template.yaml").parsed) == {
+        ("LOCAL-EC2-001", "AdminSecurityGroup"),
+        ("LOCAL-RDS-002", "Database"),
+        ("LOCAL-IAM-001", "Admin"),
+    }
+
+
+def test_rds_encryption_clusters():
+    """
+    GIVEN the local rules are evaluated
+    WHEN a named Aurora cluster isn't encrypted, and an instance in a cluster doesn't set its own encryption
+    THEN fail the cluster, and leave the instance to the cluster's encryption setting
+    """
+
+    template = {
+        "Resources": {
+            "AuroraCluster": {
+                "Type": "AWS::RDS::DBCluster",
+                "Properties": {"DBClusterIdentifier": "aurora-cluster", "Engine": "aurora-mysql"},
+            },
+            "AuroraInstance": {
+                "Type": "AWS::RDS::DBInstance",
+                "Properties": {"DBClusterIdentifier": {"Ref": "AuroraCluster"}, "Engine": "aurora-mysql"},
+            },
+        }
+    }
+
+    assert failures(template) == {("LOCAL-RDS-001", "AuroraCluster")}
+
+
+def test_custom_rule(monkeypatch):
+    """
+    GIVEN a rule is registered with `local_rule`
+    WHEN the local rules are evaluated
+    THEN include the rule's entries in the same shape as Conformity's check entries
+    """
+
+    monkeypatch.setattr("local_rules.LOCAL_RULES", [])
+
+    @local_rule("CUSTOM-001", "Queue Name Set", "LOW", ["AWS::SQS::Queue"])
+    def queue_name(logical_id, resource_type, properties):
+        if "QueueName" not in properties:
+            return f"Queue {logical_id} has no name"
+
+    entries = evaluate_local_rules({"Resources": {"MyQueue": {"Type": "AWS::SQS::Queue"}}})
+
+    assert len(entries) == 1
+    assert entries[0]["id"] == "local:CUSTOM-001:MyQueue"
+    assert entries[0]["attributes"]["risk-level"] == "LOW"
+    assert entries[0]["attributes"]["rule-title"] == "Queue Name Set"
+    assert entries[0]["attributes"]["status"] == "FAILURE"
+
+
+@pytest.mark.parametrize("template", [None, [], {"Resources": "x"}, {"Resources": {"A": "x", "B": {"Type": 1}}}])
+def test_malformed_template(template):
+    """
+    GIVEN the local rules are evaluated
+    WHEN the template or its resources are malformed
+    THEN return no entries rather than raising
+    """
+
+    assert evaluate_local_rules(template) == []
+
+
+def test_registered_rules():
+    """
+    GIVEN the local rules module is imported
+    WHEN the built in rules are registered
+    THEN every rule has a unique ID
+    """
+
+    rule_ids = [rule.rule_id for rule in LOCAL_RULES]
+
+    assert len(rule_ids) == len(set(rule_ids))
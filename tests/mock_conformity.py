@@ -0,0 +1,136 @@
+"""
+A local stand-in for Conformity's `/v1/iac-scanning/scan` endpoint, used by the benchmarks and tests.
+
+Point the scanner at it with `CC_API_ENDPOINT=<server.url>`.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCAN_PATH = "/v1/iac-scanning/scan"
+
+RISK_LEVELS = [
+    ("LOW", "Low"),
+    ("MEDIUM", "Medium"),
+    ("HIGH", "High"),
+    ("VERY_HIGH", "Very High"),
+    ("EXTREME", "Extreme"),
+]
+
+
+def make_check(index, resource="MyS3Bucket", failure_rate=0.1):
+    """Returns a check entry with the same shape as the ones in the `conformity_report` fixture."""
+    risk_level, pretty_risk_level = RISK_LEVELS[index % len(RISK_LEVELS)]
+    rule_id = f"S3-{index:03d}"
+    status = "FAILURE" if (index * 7919) % 100 < failure_rate * 100 else "SUCCESS"
+
+    return {
+        "attributes": {
+            "categories": ["security"],
+            "cost": 0,
+            "descriptorType": "s3-bucket",
+            "ignored": False,
+            "last-updated-date": None,
+            "message": f"Bucket {resource} check {index}",
+            "not-scored": False,
+            "pretty-risk-level": pretty_risk_level,
+            "provider": "aws",
+            "region": "us-east-1",
+            "resource": resource,
+            "risk-level": risk_level,
+            "rule-title": f"Rule {rule_id}",
+            "status": status,
+            "tags": [f"Name::{resource}"],
+            "waste": 0,
+        },
+        "id": f"ccc:AccountId:{rule_id}:S3:us-east-1:{resource}",
+        "relationships": {
+            "account": {"data": {"id": "AccountId", "type": "accounts"}},
+            "rule": {"data": {"id": rule_id, "type": "rules"}},
+        },
+        "type": "checks",
+    }
+
+
+def make_report(num_checks, failure_rate=0.1):
+    return {
+        "data": [make_check(i, failure_rate=failure_rate) for i in range(num_checks)],
+        "meta": {"missingParameters": []},
+    }
+
+
+class MockConformityHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, so without this Nagle's algorithm adds ~40ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status_code, body, headers=None):
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        with server.lock:
+            server.requests.append({"path": self.path, "headers": dict(self.headers), "body": body})
+
+        if not self.path.endswith(SCAN_PATH):
+            self._send(404, b'{"Message": "Not Found"}')
+            return
+
+        time.sleep(server.latency)
+
+        if server.error_rate and server.random.random() < server.error_rate:
+            self._send(503, b'{"Message": "Service Unavailable"}', headers={"Retry-After": "0"})
+            return
+
+        self._send(200, server.response_body)
+
+
+class MockConformityServer(ThreadingHTTPServer):
+    """
+    Serves canned scan responses on a random local port from a background thread.
+
+    `latency` is added to every request in seconds, `error_rate` is the fraction of requests answered with a 503 and
+    `num_checks` sets the number of check entries, and so the size, of every response.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, num_checks=18, failure_rate=0.1, seed=0):
+        super().__init__(("127.0.0.1", 0), MockConformityHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.response_body = json.dumps(make_report(num_checks, failure_rate)).encode("utf-8")
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
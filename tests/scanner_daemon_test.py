@@ -0,0 +1,195 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+import scanner_client
+from mock_conformity import MockConformityServer
+from scanner import CcValidator
+from scanner_daemon import ScannerDaemon
+
+
+@pytest.fixture
+def scanner_daemon(monkeypatch):
+    with MockConformityServer(num_checks=5, failure_rate=1.0) as conformity:
+        monkeypatch.setenv("CC_API_ENDPOINT", conformity.url)
+        monkeypatch.setenv("CC_MAX_RETRIES", "0")
+        daemon = ScannerDaemon(port=0, validator=CcValidator(template_required=False))
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        monkeypatch.setenv("CC_DAEMON_URL", daemon.url)
+
+        yield daemon, conformity
+
+        daemon.shutdown()
+        daemon.server_close()
+        thread.join()
+
+
+def test_daemon_scan(scanner_daemon, template_tree):
+    """
+    GIVEN the scanner daemon is running
+    WHEN the same templates are scanned twice
+    THEN return each template's offending entries and verdict, reusing the warm cache for the second scan
+    """
+
+    daemon, conformity = scanner_daemon
+
+    scan_response = scanner_client.request_scan([str(template_tree)], daemon.url)
+    cached_scan_response = scanner_client.request_scan([str(template_tree)], daemon.url)
+
+    assert len(scan_response["results"]) == 3
+    assert all(result["offending_entries"] and result["fail_pipeline"] for result in scan_response["results"])
+    assert scan_response["fail_pipeline"] is True
+    assert scan_response["summary"]["failed"] == 15
+    assert cached_scan_response == scan_response
+    assert len(conformity.requests) == 3
+    # the daemon only keeps running totals, so its metrics don't grow with every scan
+    assert daemon.validator.metrics.templates == {}
+
+
+def test_daemon_endpoints(scanner_daemon):
+    """
+    GIVEN the scanner daemon is running
+    WHEN its health and metrics endpoints are requested
+    THEN return its status and its metrics in the Prometheus text format
+    """
+
+    daemon, _ = scanner_daemon
+
+    with urllib.request.urlopen(f"{daemon.url}/health") as resp:
+        assert json.load(resp) == {"status": "ok"}
+
+    with urllib.request.urlopen(f"{daemon.url}/metrics") as resp:
+        assert "cc_scanner_requests" in resp.read().decode("utf-8")
+
+
+def test_daemon_scan_error(caplog, scanner_daemon, tmp_path):
+    """
+    GIVEN the scanner daemon is running
+    WHEN a scan request is invalid or there are no templates to scan
+    THEN the client exits with an error of 1, reporting the daemon's error
+    """
+
+    daemon, _ = scanner_daemon
+
+    with pytest.raises(SystemExit) as e:
+        scanner_client.request_scan([str(tmp_path / "missing")], daemon.url)
+
+    assert e.value.code == 1
+    assert "No templates found in" in caplog.text
+
+
+def test_client_main(monkeypatch, tmp_path, scanner_daemon, template_tree):
+    """
+    GIVEN the client is run in place of `scanner.py`
+    WHEN the daemon finds offending entries
+    THEN write them to `findings.json`, grouped by template, and exit with an error of 1
+    """
+
+    monkeypatch.chdir(tmp_path)
+
+    with pytest.raises(SystemExit) as e:
+        scanner_client.main([str(template_tree)])
+
+    with open(tmp_path / "findings.json") as f:
+        findings = json.load(f)
+
+    assert e.value.code == 1
+    assert len(findings) == 3
+    # one of the five failing checks is below the MEDIUM risk level
+    assert all(len(entries) == 4 for entries in findings.values())
+
+
+@pytest.mark.parametrize("output_format", ["json", "jsonl"])
+def test_client_main_single(monkeypatch, tmp_path, scanner_daemon, template_tree, output_format):
+    """
+    GIVEN the client is run in place of `scanner.py` without any paths
+    WHEN the daemon finds offending entries in the template set in CFN_TEMPLATE_FILE_LOCATION
+    THEN write them to `findings.json` as a flat list, in the format set in CC_OUTPUT_FORMAT
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CFN_TEMPLATE_FILE_LOCATION", str(template_tree / "app/bucket.yaml"))
+    monkeypatch.setenv("CC_OUTPUT_FORMAT", output_format)
+
+    with pytest.raises(SystemExit) as e:
+        scanner_client.main([])
+
+    with open(tmp_path / "findings.json") as f:
+        findings = json.load(f) if output_format == "json" else [json.loads(line) for line in f]
+
+    assert e.value.code == 1
+    assert len(findings) == 4
+    assert all(entry["attributes"]["status"] == "FAILURE" for entry in findings)
+
+
+def test_client_write_findings_none(tmp_path):
+    """
+    GIVEN the daemon's response for a single template
+    WHEN the template has no offending entries
+    THEN don't write `findings.json`, like `scanner.py`
+    """
+
+    scan_response = {"results": [{"template": "template.yaml", "offending_entries": [], "fail_pipeline": False}]}
+
+    scanner_client.write_findings(scan_response, tmp_path / "findings.json", single=True)
+
+    assert not (tmp_path / "findings.json").exists()
+
+
+def test_client_settings_differ(caplog, monkeypatch, scanner_daemon, template_tree):
+    """
+    GIVEN the scanner daemon is running
+    WHEN a job's risk level or pipeline failure settings differ from the daemon's
+    THEN the daemon rejects the job, and the client scans the templates in its own process instead
+    """
+
+    daemon, conformity = scanner_daemon
+    scanned = []
+    monkeypatch.setattr("scanner.main", lambda argv: scanned.append(argv))
+
+    for name, value in [("CC_RISK_LEVEL", "HIGH"), ("FAIL_PIPELINE", "disabled")]:
+        with monkeypatch.context() as m:
+            m.setenv(name, value)
+            scanner_client.main([str(template_tree)])
+
+            assert f"started with different settings: {name}" in caplog.text
+
+    assert scanned == [[str(template_tree)]] * 2
+    assert not conformity.requests
+
+
+def test_client_fallback(monkeypatch, template_tree):
+    """
+    GIVEN the client is run in place of `scanner.py`
+    WHEN the daemon isn't running
+    THEN scan the templates in the client's process instead
+    """
+
+    scanned = []
+    monkeypatch.setenv("CC_DAEMON_URL", "http://127.0.0.1:1")
+    monkeypatch.setattr("scanner.main", lambda argv: scanned.append(argv))
+
+    scanner_client.main([str(template_tree)])
+
+    assert scanned == [[str(template_tree)]]
+
+
+@pytest.mark.parametrize("scanner_args", [["--no-cache"], ["--resume"], ["--changed-since", "origin/master"]])
+def test_client_scanner_args(monkeypatch, scanner_daemon, template_tree, scanner_args):
+    """
+    GIVEN the client is run in place of `scanner.py`
+    WHEN it's given an argument which only `scanner.py` supports
+    THEN scan the templates in the client's process with the same arguments, without the daemon
+    """
+
+    _, conformity = scanner_daemon
+    scanned = []
+    monkeypatch.setattr("scanner.main", lambda argv: scanned.append(argv))
+
+    scanner_client.main(scanner_args + [str(template_tree)])
+
+    assert scanned == [scanner_args + [str(template_tree)]]
+    assert not conformity.requests
@@ -1,9 +1,37 @@
 import os
+import gzip
 import json
 import pytest
 import logging
-
-from scanner import CcValidator
+import sys
+import time
+import threading
+import subprocess
+
+from scanner import (
+    Baseline,
+    CcValidator,
+    CfnTemplate,
+    FindingsIndex,
+    ScanCache,
+    ScanJournal,
+    ScanMetrics,
+    RegionSelector,
+    ScanResult,
+    TokenBucket,
+    create_session,
+    find_templates,
+    get_descendants,
+    get_nested_templates,
+    parse_retry_after,
+    JsonStreamParser,
+    get_changed_files,
+    is_cfn_template,
+    merge_findings,
+    parse_profiles,
+    split_template,
+)
+from mock_conformity import MockConformityServer, make_check
 
 
 def test_env_vars(set_env_vars):
@@ -437,3 +465,1967 @@ def test_run_insecure_template_fail_pipeline_enabled_cfn_disabled(caplog, monkey
         c.run()
 
     assert "offending entries found" in caplog.text
+
+
+def test_find_templates_directory(template_tree):
+    """
+    GIVEN `find_templates` is called
+    WHEN a directory is provided
+    THEN return every template file below it, sorted and skipping hidden directories
+    """
+
+    templates = find_templates([str(template_tree)])
+
+    assert templates == [
+        f"{template_tree}/app/bucket.yaml",
+        f"{template_tree}/app/nested/queue.json",
+        f"{template_tree}/network/vpc.yml",
+    ]
+
+
+def test_find_templates_glob(template_tree):
+    """
+    GIVEN `find_templates` is called
+    WHEN a glob pattern and an overlapping file are provided
+    THEN return the matching templates once each
+    """
+
+    templates = find_templates([f"{template_tree}/**/*.json", f"{template_tree}/app/nested/queue.json"])
+
+    assert templates == [f"{template_tree}/app/nested/queue.json"]
+
+
+def test_run_batch_offending(caplog, monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `run_batch` is called
+    WHEN offending entries are found in the templates
+    THEN write the findings per template and exit with an error of 1
+    """
+
+    templates = find_templates([str(template_tree)])
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.delenv("CFN_TEMPLATE_FILE_LOCATION")
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", lambda payload: conformity_report)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch([str(template_tree)])
+
+    assert e.value.code == 1
+    assert "3 of 3 template(s) have offending entries" in caplog.text
+
+    with open(tmp_path / "findings.json") as f:
+        findings = json.load(f)
+
+    assert sorted(findings) == templates
+
+
+def test_run_batch_pass(caplog, monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `run_batch` is called
+    WHEN no offending entries are found
+    THEN exit with a code of 0
+    """
+    caplog.set_level(logging.INFO)
+
+    monkeypatch.chdir(tmp_path)
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", lambda payload: conformity_report)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch([str(template_tree)])
+
+    assert not e.value.code
+    assert "No offending entries found in 3 template(s)" in caplog.text
+
+
+def test_invalid_max_concurrency(caplog, monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN `CC_MAX_CONCURRENCY` is not a positive integer
+    THEN exit with an error of 1
+    """
+
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "0")
+
+    with pytest.raises(SystemExit):
+        CcValidator()
+
+    assert 'Please ensure "CC_MAX_CONCURRENCY" is set to a positive integer' in caplog.text
+
+
+def test_scan_templates_concurrent_order(monkeypatch, template_tree, conformity_report):
+    """
+    GIVEN `scan_templates` is called with a concurrency above 1
+    WHEN the scans complete out of order
+    THEN return the results in the order the templates were provided
+    """
+
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "3")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    templates = find_templates([str(template_tree)])
+
+    # the first template is the slowest to scan
+    delays = {}
+    for i, template in enumerate(templates):
+        with open(template) as f:
+            delays[f.read()] = 0.02 * (len(templates) - i)
+
+    c = CcValidator()
+
+    def run_validation(payload):
+        time.sleep(delays[payload["data"]["attributes"]["contents"]])
+        return conformity_report
+
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    results = c.scan_templates(templates)
+
+    assert [result.template for result in results] == templates
+
+
+def test_session_pool_size(monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN `CC_POOL_SIZE` is set
+    THEN create a session whose connection pool holds that many connections
+    """
+
+    monkeypatch.setenv("CC_POOL_SIZE", "7")
+
+    c = CcValidator()
+    adapter = c.session.get_adapter("https://us-west-2-api.cloudconformity.com")
+
+    assert adapter._pool_maxsize == 7
+
+
+def test_shared_session():
+    """
+    GIVEN `CcValidator` is instantiated with a session
+    WHEN several validators are created
+    THEN they share the same session and connection pool
+    """
+
+    session = create_session()
+
+    assert CcValidator(session=session).session is CcValidator(session=session).session
+
+
+class FakeResponse:
+    def __init__(self, resp_json, status_code=200, headers=None):
+        self.text = json.dumps(resp_json)
+        self.content = self.text.encode("utf-8")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        body = self.text.encode("utf-8")
+
+        for i in range(0, len(body), chunk_size):
+            yield body[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def test_run_validation_cached(monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called twice for the same template
+    WHEN the scan cache is enabled
+    THEN only send the first request to Conformity and return the cached response for the second
+    """
+
+    c = CcValidator()
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse(conformity_report)
+
+    monkeypatch.setattr(c.session, "post", post)
+    payload = c.generate_payload("Resources: {}")
+
+    assert c.run_validation(payload) == conformity_report
+    assert c.run_validation(payload) == conformity_report
+    assert len(calls) == 1
+
+
+def test_run_validation_cache_api_key(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `run_validation` is called for the same template by two jobs sharing a cache directory
+    WHEN the jobs have different API keys
+    THEN send both requests to Conformity, as the cached response belongs to the other account
+    """
+
+    monkeypatch.setenv("CC_CACHE_DIR", str(tmp_path))
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse(conformity_report)
+
+    for api_key in ["first-key", "second-key", "first-key"]:
+        monkeypatch.setenv("CC_API_KEY", api_key)
+        c = CcValidator()
+        monkeypatch.setattr(c.session, "post", post)
+        c.run_validation(c.generate_payload("Resources: {}"))
+
+    assert len(calls) == 2
+
+
+def test_run_validation_no_cache(monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called twice for the same template
+    WHEN the scan cache is disabled
+    THEN send both requests to Conformity
+    """
+
+    c = CcValidator(use_cache=False)
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse(conformity_report)
+
+    monkeypatch.setattr(c.session, "post", post)
+    payload = c.generate_payload("Resources: {}")
+    c.run_validation(payload)
+    c.run_validation(payload)
+
+    assert len(calls) == 2
+
+
+def test_scan_cache_ttl(tmp_path):
+    """
+    GIVEN a response is stored in `ScanCache`
+    WHEN the entry is older than the TTL
+    THEN treat it as a miss and remove it
+    """
+
+    cache = ScanCache(cache_dir=str(tmp_path), ttl=60)
+    key = cache.key("Resources: {}", "", "us-west-2", "x")
+    cache.set(key, "{}")
+
+    assert cache.get(key) == "{}"
+
+    expired = time.time() - 120
+    os.utime(tmp_path / f"{key}.json", (expired, expired))
+
+    assert cache.get(key) is None
+    assert not os.listdir(tmp_path)
+
+
+def test_scan_cache_size_eviction(tmp_path):
+    """
+    GIVEN responses are stored in `ScanCache`
+    WHEN the cache grows beyond its maximum size
+    THEN evict the oldest entries first
+    """
+
+    cache = ScanCache(cache_dir=str(tmp_path), max_size=25)
+
+    for i in range(3):
+        key = cache.key(str(i), "", "us-west-2", "x")
+        cache.set(key, "x" * 10)
+        os.utime(tmp_path / f"{key}.json", (i, time.time() - 10 + i))
+
+    cache.evict()
+
+    assert cache.get(cache.key("0", "", "us-west-2", "x")) is None
+    assert cache.get(cache.key("2", "", "us-west-2", "x")) == "x" * 10
+
+
+def test_run_validation_retry(caplog, monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called
+    WHEN Conformity throttles the request and then returns a transient error
+    THEN wait for at least `Retry-After`, retry and return the successful response
+    """
+
+    c = CcValidator(use_cache=False)
+    responses = [
+        FakeResponse({"Message": "Too Many Requests"}, status_code=429, headers={"Retry-After": "3"}),
+        FakeResponse({"Message": "Bad Gateway"}, status_code=502),
+        FakeResponse(conformity_report),
+    ]
+    sleeps = []
+
+    monkeypatch.setattr(c.session, "post", lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(c.rate_limiters["us-west-2"], "acquire", lambda: None)
+    monkeypatch.setattr("scanner.time.sleep", sleeps.append)
+
+    assert c.run_validation(c.generate_payload("Resources: {}")) == conformity_report
+    assert len(sleeps) == 2
+    assert sleeps[0] >= 3
+    assert c.rate_limiters["us-west-2"].rate < c.rate_limiters["us-west-2"].max_rate
+    assert "Retrying" in caplog.text
+
+
+def test_run_validation_timeout(caplog, monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called with CC_REQUEST_TIMEOUT set
+    WHEN Conformity doesn't respond within the timeout
+    THEN retry the request, and return the successful response
+    """
+
+    import requests
+
+    monkeypatch.setenv("CC_REQUEST_TIMEOUT", "30")
+    c = CcValidator(use_cache=False)
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+
+        if len(calls) == 1:
+            raise requests.ReadTimeout("Read timed out")
+
+        return FakeResponse(conformity_report)
+
+    monkeypatch.setattr(c.session, "post", post)
+    monkeypatch.setattr("scanner.time.sleep", lambda delay: None)
+
+    assert c.run_validation(c.generate_payload("Resources: {}")) == conformity_report
+    assert len(calls) == 2
+    assert all(kwargs["timeout"] == (10.0, 30.0) for kwargs in calls)
+    assert "Scan request failed (ReadTimeout)" in caplog.text
+
+
+def test_run_validation_retries_exhausted(caplog, monkeypatch):
+    """
+    GIVEN `run_validation` is called
+    WHEN Conformity keeps returning a non JSON error
+    THEN exit with an error of 1 after `CC_MAX_RETRIES` retries
+    """
+
+    monkeypatch.setenv("CC_MAX_RETRIES", "2")
+
+    c = CcValidator(use_cache=False)
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        resp = FakeResponse({}, status_code=503)
+        resp.text = "<html>Service Unavailable</html>"
+        return resp
+
+    monkeypatch.setattr(c.session, "post", post)
+    monkeypatch.setattr("scanner.time.sleep", lambda delay: None)
+
+    with pytest.raises(SystemExit):
+        c.run_validation(c.generate_payload("Resources: {}"))
+
+    assert len(calls) == 3
+    assert "Conformity returned an invalid response (HTTP 503)" in caplog.text
+
+
+@pytest.mark.parametrize("stream", ["disabled", "enabled"])
+def test_run_validation_5xx_retries_exhausted(caplog, monkeypatch, stream):
+    """
+    GIVEN `run_validation` is called
+    WHEN Conformity keeps returning a JSON 5xx error
+    THEN exit with an error of 1 after `CC_MAX_RETRIES` retries, logging the status and body
+    """
+
+    monkeypatch.setenv("CC_MAX_RETRIES", "1")
+    monkeypatch.setenv("CC_STREAM_RESPONSES", stream)
+    monkeypatch.setattr("scanner.time.sleep", lambda delay: None)
+
+    with MockConformityServer(error_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        c = CcValidator(use_cache=False)
+
+        with pytest.raises(SystemExit) as e:
+            c.run_validation(c.generate_payload("Resources: {}"))
+
+    assert e.value.code == 1
+    assert len(server.requests) == 2
+    assert 'Conformity returned HTTP 503 after 2 attempt(s): {"Message": "Service Unavailable"}' in caplog.text
+
+
+def test_run_validation_no_findings(caplog, monkeypatch):
+    """
+    GIVEN `run_validation` is called
+    WHEN Conformity responds without any check entries
+    THEN exit with an error of 1 instead of passing the response on to `get_results`
+    """
+
+    c = CcValidator(use_cache=False)
+    monkeypatch.setattr(c.session, "post", lambda *args, **kwargs: FakeResponse({"message": "Bad Request"}, 400))
+
+    with pytest.raises(SystemExit) as e:
+        c.run_validation(c.generate_payload("Resources: {}"))
+
+    assert e.value.code == 1
+    assert "Conformity returned no findings (HTTP 400)" in caplog.text
+
+
+def test_rate_limit_per_region(monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN both a global and a region specific rate limit are set
+    THEN use the region specific rate limit
+    """
+
+    monkeypatch.setenv("CC_RATE_LIMIT", "10")
+    monkeypatch.setenv("CC_RATE_LIMIT_US_WEST_2", "2.5")
+
+    c = CcValidator()
+
+    assert c.rate_limiters["us-west-2"].max_rate == 2.5
+
+
+def test_rate_limit_failover_regions(monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called with `CC_FAILOVER_REGIONS` and a region specific rate limit set
+    WHEN the request fails over to a region which throttles it
+    THEN acquire and throttle the rate limiter of the region which was called, with that region's rate limit
+    """
+
+    monkeypatch.setenv("CC_FAILOVER_REGIONS", "eu-west-1")
+    monkeypatch.setenv("CC_RATE_LIMIT", "10")
+    monkeypatch.setenv("CC_RATE_LIMIT_EU_WEST_1", "1")
+    monkeypatch.setattr("scanner.time.sleep", lambda delay: None)
+
+    c = CcValidator(use_cache=False)
+    c.region_selector.probed = True
+    responses = [
+        FakeResponse({"Message": "Service Unavailable"}, status_code=503),
+        FakeResponse({"Message": "Too Many Requests"}, status_code=429),
+        FakeResponse(conformity_report),
+    ]
+    acquired = []
+
+    for region, rate_limiter in c.rate_limiters.items():
+        monkeypatch.setattr(rate_limiter, "acquire", lambda region=region: acquired.append(region))
+
+    monkeypatch.setattr(c.session, "post", lambda *args, **kwargs: responses.pop(0))
+
+    assert c.run_validation(c.generate_payload("Resources: {}")) == conformity_report
+    assert acquired == ["us-west-2", "eu-west-1", "eu-west-1"]
+    assert c.rate_limiters["us-west-2"].max_rate == 10
+    assert c.rate_limiters["us-west-2"].rate == 10
+    assert c.rate_limiters["eu-west-1"].max_rate == 1
+    assert c.rate_limiters["eu-west-1"].rate < 1
+
+
+def test_token_bucket_rate():
+    """
+    GIVEN a `TokenBucket` is used
+    WHEN more tokens than the burst size are acquired
+    THEN block until tokens are refilled at the configured rate
+    """
+
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+
+    for _ in range(6):
+        bucket.acquire()
+
+    assert time.monotonic() - start >= 0.09
+
+
+def test_parse_retry_after():
+    """
+    GIVEN `parse_retry_after` is called
+    WHEN the header holds seconds, an HTTP date or garbage
+    THEN return the seconds to wait, or `None` if it can't be parsed
+    """
+
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_get_results_streamed_output(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `get_results` is called
+    WHEN offending entries are found
+    THEN stream them to the output file in the same format as a single `json.dumps` of the list
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    output_file = tmp_path / "findings.json"
+
+    c = CcValidator()
+    report = c.get_results(conformity_report, output_file=str(output_file))
+
+    assert output_file.read_text() == json.dumps(report, sort_keys=True, indent=4).replace(r"\"", "")
+
+
+def test_get_results_jsonl_output(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `get_results` is called
+    WHEN `CC_OUTPUT_FORMAT` is `jsonl`
+    THEN write one offending entry per line
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.setenv("CC_OUTPUT_FORMAT", "jsonl")
+    output_file = tmp_path / "findings.json"
+
+    c = CcValidator()
+    report = c.get_results(conformity_report, output_file=str(output_file))
+
+    with open(output_file) as f:
+        assert [json.loads(line) for line in f] == report
+
+
+def test_write_batch_results_grouped(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `write_batch_results` is called
+    WHEN several templates have offending entries
+    THEN stream a JSON object keyed by template, including templates without offending entries
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    output_file = tmp_path / "findings.json"
+
+    c = CcValidator()
+    entries = c.get_results(conformity_report, output_file=None)
+    results = [
+        ScanResult(template="a.yaml", offending_entries=entries),
+        ScanResult(template="b.yaml"),
+        ScanResult(template="c.yaml", offending_entries=entries[:1]),
+    ]
+
+    c.write_batch_results(results, output_file=str(output_file))
+
+    expected = {"a.yaml": entries, "b.yaml": [], "c.yaml": entries[:1]}
+    assert output_file.read_text() == json.dumps(expected, sort_keys=True, indent=4).replace(r"\"", "")
+
+
+def test_invalid_output_format(caplog, monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN an unknown output format is provided
+    THEN exit with an error of 1
+    """
+
+    monkeypatch.setenv("CC_OUTPUT_FORMAT", "xml")
+
+    with pytest.raises(SystemExit):
+        CcValidator()
+
+    assert "Unknown output format" in caplog.text
+
+
+def chunked(text, chunk_size=7):
+    body = text.encode("utf-8")
+    return [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+
+def test_json_stream_parser(conformity_report):
+    """
+    GIVEN `JsonStreamParser` is given a response in small chunks
+    WHEN the response is parsed
+    THEN yield the `data` entries one at a time and add the members after `data` once they're consumed
+    """
+
+    resp_json = JsonStreamParser(chunked(json.dumps(conformity_report, indent=2))).parse()
+
+    assert not isinstance(resp_json["data"], list)
+    assert list(resp_json["data"]) == conformity_report["data"]
+    assert resp_json["meta"] == conformity_report["meta"]
+
+
+def test_json_stream_parser_members_before_data():
+    """
+    GIVEN `JsonStreamParser` is given a response
+    WHEN members such as `errors` or numbers precede an empty `data` array
+    THEN decode them up front
+    """
+
+    text = '{"Message": "\\u00e9 deny", "count": 12345, "errors": [{"detail": "x"}], "data": []}'
+    resp_json = JsonStreamParser(chunked(text, chunk_size=3)).parse()
+
+    assert resp_json["Message"] == "\u00e9 deny"
+    assert resp_json["count"] == 12345
+    assert resp_json["errors"] == [{"detail": "x"}]
+    assert list(resp_json["data"]) == []
+
+
+def test_json_stream_parser_truncated():
+    """
+    GIVEN `JsonStreamParser` is given a truncated response
+    WHEN the `data` entries are consumed
+    THEN raise a `ValueError`
+    """
+
+    resp_json = JsonStreamParser(chunked('{"data": [{"a": 1}, {"b"')).parse()
+
+    with pytest.raises(ValueError):
+        list(resp_json["data"])
+
+
+def test_run_validation_streamed(monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called twice for the same template
+    WHEN `CC_STREAM_RESPONSES` is `enabled`
+    THEN stream the entries into `get_results` and serve the second scan from the cache
+    """
+
+    monkeypatch.setenv("CC_STREAM_RESPONSES", "enabled")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+
+    c = CcValidator()
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse(conformity_report)
+
+    monkeypatch.setattr(c.session, "post", post)
+    payload = c.generate_payload("Resources: {}")
+    expected = CcValidator().get_results(conformity_report, output_file=None)
+
+    assert c.get_results(c.run_validation(payload), output_file=None) == expected
+    assert c.get_results(c.run_validation(payload), output_file=None) == expected
+    assert len(calls) == 1
+    assert calls[0]["stream"] is True
+
+
+def test_run_batch_changed_files(caplog, monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `run_batch` is called with a set of changed files
+    WHEN the previous run's journal has findings for the unchanged templates
+    THEN only scan the changed templates and reuse the journalled findings of the rest
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    templates = find_templates(["app", "network"])
+
+    c = CcValidator(template_required=False)
+    journal = ScanJournal("findings.journal.jsonl", settings=c.get_settings_fingerprint())
+
+    for template in templates[:2]:
+        result = ScanResult(template=template)
+
+        if template == templates[0]:
+            result.offending_entries = c.get_results(conformity_report, output_file=None, index=result.findings)
+
+        journal.append(result, c.read_template(template).content_hash)
+
+    journal.close()
+    offending_entries = c.get_results(conformity_report, output_file=None)
+    scanned = []
+
+    def run_validation(payload):
+        scanned.append(payload["data"]["attributes"]["contents"])
+        return {"data": []}
+
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"], changed_files={os.path.abspath(templates[1])})
+
+    assert e.value.code == 1
+    assert len(scanned) == 2
+    assert "2 of 3 template(s) had changed, had not been scanned before" in caplog.text
+    with open("findings.json") as f:
+        findings = json.load(f)
+
+    assert {template: [entry["id"] for entry in entries] for template, entries in findings.items()} == {
+        templates[0]: [entry["id"] for entry in offending_entries],
+        templates[1]: [],
+        templates[2]: [],
+    }
+    # the rewritten journal still has every template for the next run
+    assert len(ScanJournal.load("findings.journal.jsonl")) == 3
+
+
+def test_run_batch_changed_files_settings(monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `run_batch` is called with a set of changed files
+    WHEN the risk level has been lowered and a baseline removed since the previous run
+    THEN report the reused templates' findings which are offending with the current settings
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_RISK_LEVEL", "VERY_HIGH")
+    failing_ids = [entry["id"] for entry in conformity_report["data"] if entry["attributes"]["status"] != "SUCCESS"]
+    baseline_file = tmp_path / "baseline.json"
+    baseline_file.write_text(json.dumps({"ids": failing_ids[:1]}))
+    monkeypatch.setenv("CC_BASELINE_FILE", str(baseline_file))
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", lambda payload: conformity_report)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"])
+
+    assert not e.value.code
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.delenv("CC_BASELINE_FILE")
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", lambda payload: pytest.fail("unchanged templates shouldn't be scanned"))
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"], changed_files=set())
+
+    assert e.value.code == 1
+    with open("findings.json") as f:
+        findings = json.load(f)
+
+    assert all(sorted(entry["id"] for entry in entries) == sorted(failing_ids) for entries in findings.values())
+
+
+def test_run_batch_changed_files_scan_settings(caplog, monkeypatch, tmp_path, template_tree):
+    """
+    GIVEN `run_batch` is called with a set of changed files
+    WHEN a stricter profile has been added to CC_PROFILE_ID since the previous run
+    THEN scan the unchanged templates again, as their journalled entries were scanned with different settings
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_PROFILE_ID", "a")
+    scanned = []
+
+    def run_validation(payload):
+        cc_profile_id = payload["data"]["attributes"]["profileId"]
+        scanned.append(cc_profile_id)
+        return {"data": [make_check(2, failure_rate=1.0 if cc_profile_id == "b" else 0.0)]}
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"])
+
+    assert not e.value.code
+
+    monkeypatch.setenv("CC_PROFILE_ID", "a,b:HIGH")
+    scanned.clear()
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"], changed_files=set())
+
+    assert e.value.code == 1
+    assert "b" in scanned
+    assert "were scanned with different settings" in caplog.text
+
+
+def test_get_changed_files(monkeypatch, tmp_path):
+    """
+    GIVEN `get_changed_files` is called with a git ref and a changed files list
+    WHEN files were added, modified and deleted since the ref
+    THEN return the absolute paths of the added, modified and listed files
+    """
+
+    monkeypatch.chdir(tmp_path)
+
+    def git(*args):
+        subprocess.run(["git", *args], check=True, capture_output=True)
+
+    git("init", "-q")
+    git("config", "user.email", "dev@example.com")
+    git("config", "user.name", "dev")
+    (tmp_path / "modified.yaml").write_text("Resources: {}")
+    (tmp_path / "deleted.yaml").write_text("Resources: {}")
+    git("add", "-A")
+    git("commit", "-qm", "base")
+    git("tag", "base")
+    (tmp_path / "modified.yaml").write_text("Resources: {A: 1}")
+    (tmp_path / "added.yaml").write_text("Resources: {}")
+    (tmp_path / "deleted.yaml").unlink()
+    git("add", "-A")
+    git("commit", "-qm", "change")
+    (tmp_path / "changed.txt").write_text("listed.yaml\n\n")
+
+    changed_files = get_changed_files("base", "changed.txt")
+
+    assert changed_files == {str(tmp_path / name) for name in ("modified.yaml", "added.yaml", "listed.yaml")}
+
+
+def test_scan_metrics(monkeypatch, tmp_path, template_tree):
+    """
+    GIVEN templates are scanned against the mock Conformity endpoint
+    WHEN the metrics are written
+    THEN record the time of every phase and the latency, size and status of every request per template
+    """
+
+    metrics_file = tmp_path / "metrics.json"
+    prometheus_file = tmp_path / "metrics.prom"
+    monkeypatch.setenv("CC_METRICS_FILE", str(metrics_file))
+    monkeypatch.setenv("CC_METRICS_PROM_FILE", str(prometheus_file))
+    templates = find_templates([str(template_tree)])
+
+    with MockConformityServer(num_checks=5) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+
+        c = CcValidator(use_cache=False)
+        c.scan_templates(templates)
+        c.write_metrics()
+
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+
+    assert metrics["phases"]["run_validation"]["count"] == 3
+    assert metrics["requests"]["count"] == 3
+    assert metrics["requests"]["status_codes"] == {"200": 3}
+    assert metrics["requests"]["bytes_sent"] == sum(len(request["body"]) for request in server.requests)
+    assert metrics["requests"]["bytes_received"] == 3 * len(server.response_body)
+    assert sorted(metrics["templates"]) == templates
+    assert set(metrics["templates"][templates[0]]["phases"]) == {
+        "read_template",
+        "generate_payload",
+        "run_validation",
+        "get_results",
+    }
+
+    prometheus_metrics = prometheus_file.read_text()
+    assert 'cc_scanner_phase_seconds{phase="run_validation"}' in prometheus_metrics
+    assert 'cc_scanner_requests{status="200"} 3' in prometheus_metrics
+
+
+def test_scan_metrics_latency_window():
+    """
+    GIVEN the metrics of a long running process, with a latency window and without per-template metrics
+    WHEN more requests are recorded than fit in the window
+    THEN keep the totals of every request, but only the latest requests' latencies and no per-template metrics
+    """
+
+    metrics = ScanMetrics(latency_window=3, per_template=False)
+
+    with metrics.template("template.yaml"), metrics.phase("run_validation"):
+        for latency in range(1, 6):
+            request = metrics.record_request(float(latency), 200, 10)
+            metrics.record_bytes_received(request, 20)
+
+    requests_metrics = metrics.to_dict()["requests"]
+
+    assert requests_metrics["count"] == 5
+    assert requests_metrics["bytes_sent"] == 50
+    assert requests_metrics["bytes_received"] == 100
+    assert requests_metrics["status_codes"] == {"200": 5}
+    assert len(metrics.requests) == 3
+    assert requests_metrics["latency_seconds"]["max"] == 5.0
+    assert requests_metrics["latency_seconds"]["p50"] == 4.0
+    assert metrics.templates == {}
+    assert metrics.to_dict()["phases"]["run_validation"]["count"] == 1
+
+
+def test_cfn_template_parsed_once(monkeypatch):
+    """
+    GIVEN a `CfnTemplate` is created from YAML text
+    WHEN its parsed form is used several times
+    THEN parse the text only once and return the same tree to every consumer
+    """
+
+    calls = []
+    parse = CfnTemplate._parse
+
+    def counting_parse(self):
+        calls.append(self)
+        return parse(self)
+
+    monkeypatch.setattr(CfnTemplate, "_parse", counting_parse)
+    cfn_template = CfnTemplate("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n", "template.yaml")
+
+    assert cfn_template.parsed is cfn_template.parsed
+    assert len(calls) == 1
+
+
+def test_cfn_template_short_form_functions():
+    """
+    GIVEN a YAML `CfnTemplate` uses short form intrinsic functions and a template format version
+    WHEN it is parsed
+    THEN load the functions in their long form and keep the version as a string
+    """
+
+    text = """
+AWSTemplateFormatVersion: 2010-09-09
+Conditions:
+  IsProd: !Equals [!Ref Env, prod]
+Resources:
+  MyS3Bucket:
+    Type: AWS::S3::Bucket
+    Condition: IsProd
+    Properties:
+      BucketName: !Sub "${AWS::StackName}-bucket"
+      Arn: !GetAtt MyRole.Arn
+      Tags: !If
+        - IsProd
+        - [{Key: Env, Value: !Condition IsProd}]
+        - !Ref AWS::NoValue
+"""
+    parsed = CfnTemplate(text, "template.yml").parsed
+
+    assert parsed["AWSTemplateFormatVersion"] == "2010-09-09"
+    assert parsed["Conditions"]["IsProd"] == {"Fn::Equals": [{"Ref": "Env"}, "prod"]}
+
+    properties = parsed["Resources"]["MyS3Bucket"]["Properties"]
+    assert properties["BucketName"] == {"Fn::Sub": "${AWS::StackName}-bucket"}
+    assert properties["Arn"] == {"Fn::GetAtt": ["MyRole", "Arn"]}
+    assert properties["Tags"] == {
+        "Fn::If": ["IsProd", [{"Key": "Env", "Value": {"Condition": "IsProd"}}], {"Ref": "AWS::NoValue"}]
+    }
+
+
+def test_fail_pipeline_short_form_template(monkeypatch, tmp_path):
+    """
+    GIVEN `_fail_pipeline` is called with a `CfnTemplate`
+    WHEN the YAML template uses short form intrinsic functions and `FailConformityPipeline` is `disabled`
+    THEN return `False` (pipeline won't fail even if issues are found)
+    """
+
+    monkeypatch.setenv("FAIL_PIPELINE_CFN", "enabled")
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text(
+        "Parameters:\n  FailConformityPipeline: disabled\n"
+        "Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n    Properties:\n      BucketName: !Ref AWS::StackName\n"
+    )
+
+    c = CcValidator()
+
+    assert c._fail_pipeline(c.read_template(str(template_path))) is False
+
+
+@pytest.mark.parametrize(
+    "name, contents, expected, expected_strict",
+    [
+        (
+            "versioned.yaml",
+            "AWSTemplateFormatVersion: 2010-09-09\nResources:\n  Q:\n    Type: AWS::SQS::Queue\n",
+            True,
+            True,
+        ),
+        ("minified.json", '{"Resources":{"Q":{"Type":"AWS::SQS::Queue"}}}', True, True),
+        ("pipeline.yml", "---\nsteps:\n  - run: make test\n", False, False),
+        ("buildspec.yml", "phases:\n  build:\n    commands:\n      - echo AWS::Region\n", False, False),
+        ("notes.yaml", "# Resources: AWS::S3::Bucket is documented elsewhere\nitems: []\n", True, False),
+        ("broken.json", '{"Resources": {"Q": {"Type": "AWS::SQS::Queue"}', True, False),
+    ],
+)
+def test_is_cfn_template(tmp_path, name, contents, expected, expected_strict):
+    """
+    GIVEN `is_cfn_template` is called
+    WHEN a file does or doesn't contain CloudFormation markers and structure
+    THEN detect templates from the markers, and also check the structure when `strict` is set
+    """
+
+    file_path = tmp_path / name
+    file_path.write_text(contents)
+
+    assert is_cfn_template(str(file_path)) is expected
+    assert is_cfn_template(str(file_path), strict=True) is expected_strict
+
+
+def test_run_batch_skips_non_templates(caplog, monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `run_batch` is called on a directory
+    WHEN it contains YAML and JSON files which aren't CloudFormation templates
+    THEN skip them without sending them to Conformity
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.chdir(tmp_path)
+    (template_tree / "app" / "package.json").write_text('{"name": "app", "version": "1.0.0"}')
+    (template_tree / "app" / "docker-compose.yml").write_text("---\nservices: {}\n")
+
+    c = CcValidator(template_required=False)
+    scanned = []
+
+    def run_validation(payload):
+        scanned.append(payload)
+        return conformity_report
+
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit):
+        c.run_batch([str(template_tree)])
+
+    assert len(scanned) == 3
+    assert "Skipping file which is not a CloudFormation template" in caplog.text
+    assert "package.json" in caplog.text
+
+
+@pytest.mark.parametrize("local_rules_mode, expected_requests", [("enabled", 1), ("fail-fast", 0), ("only", 0)])
+def test_scan_template_local_rules(monkeypatch, tmp_path, conformity_report, local_rules_mode, expected_requests):
+    """
+    GIVEN `scan_template` is called on a template with a public S3 bucket
+    WHEN `CC_LOCAL_RULES` is `enabled`, `fail-fast` or `only`
+    THEN report the local findings, and only call Conformity when the local rules don't already fail the template
+    """
+
+    monkeypatch.setenv("CC_LOCAL_RULES", local_rules_mode)
+    monkeypatch.setenv("CC_RISK_LEVEL", "HIGH")
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text(
+        "Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n    Properties:\n      AccessControl: PublicRead\n"
+    )
+
+    c = CcValidator()
+    scanned = []
+
+    def run_validation(payload):
+        scanned.append(payload)
+        return conformity_report
+
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    result = c.scan_template(str(template_path))
+    rule_ids = {entry["relationships"]["rule"]["data"]["id"] for entry in result.offending_entries}
+
+    assert len(scanned) == expected_requests
+    assert rule_ids == {"LOCAL-S3-001", "LOCAL-S3-002", "LOCAL-S3-003"}
+    assert result.fail_pipeline is True
+
+
+def test_split_template():
+    """
+    GIVEN `split_template` is called
+    WHEN resources refer to each other, and to parameters, mappings and conditions
+    THEN keep related resources in the same chunk, with only the sections each chunk depends on
+    """
+
+    template = {
+        "AWSTemplateFormatVersion": "2010-09-09",
+        "Parameters": {"Env": {"Type": "String"}, "Unused": {"Type": "String"}},
+        "Mappings": {"Sizes": {"prod": {"Size": 10}}},
+        "Conditions": {"IsProd": {"Fn::Equals": [{"Ref": "Env"}, "prod"]}, "HasQueue": {"Condition": "IsProd"}},
+        "Resources": {
+            "Bucket": {"Type": "AWS::S3::Bucket"},
+            "Queue": {"Type": "AWS::SQS::Queue", "Condition": "HasQueue"},
+            "Volume": {
+                "Type": "AWS::EC2::Volume",
+                "Properties": {"Size": {"Fn::FindInMap": ["Sizes", "prod", "Size"]}},
+            },
+            "Policy": {
+                "Type": "AWS::S3::BucketPolicy",
+                "Properties": {"Bucket": {"Ref": "Bucket"}, "PolicyDocument": {"Fn::Sub": "${Topic.TopicName}"}},
+            },
+            "Topic": {"Type": "AWS::SNS::Topic"},
+        },
+        "Outputs": {"BucketName": {"Value": {"Ref": "Bucket"}}},
+    }
+
+    chunks = split_template(template, max_resources=2)
+
+    assert [list(chunk["Resources"]) for chunk in chunks] == [["Bucket", "Policy", "Topic"], ["Queue", "Volume"]]
+    assert "Parameters" not in chunks[0] and "Outputs" not in chunks[0]
+    assert chunks[1]["Parameters"] == {"Env": {"Type": "String"}}
+    assert list(chunks[1]["Conditions"]) == ["IsProd", "HasQueue"]
+    assert chunks[1]["Mappings"] == template["Mappings"]
+    assert all(chunk["AWSTemplateFormatVersion"] == "2010-09-09" for chunk in chunks)
+
+
+def test_merge_findings(conformity_report):
+    """
+    GIVEN `merge_findings` is called with the findings of each chunk of a template
+    WHEN the same check is reported by more than one chunk
+    THEN return each check once, ordered by resource logical ID
+    """
+
+    entries = conformity_report["data"]
+    first_entry = dict(entries[0], attributes=dict(entries[0]["attributes"], resource="ZBucket"))
+    second_entry = dict(entries[1], attributes=dict(entries[1]["attributes"], resource="ABucket"))
+
+    merged = merge_findings([{"data": [first_entry, second_entry]}, {"data": [second_entry]}])
+
+    assert merged == {"data": [second_entry, first_entry]}
+    assert merge_findings([{"data": []}, {"Message": "Error"}]) == {"Message": "Error"}
+
+
+def test_scan_template_split(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `scan_template` is called
+    WHEN the template has more resources than `CC_SPLIT_RESOURCES`
+    THEN scan each chunk of the template separately and merge their findings
+    """
+
+    monkeypatch.setenv("CC_SPLIT_RESOURCES", "2")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    resources = {f"Bucket{i}": {"Type": "AWS::S3::Bucket"} for i in range(5)}
+    template_path = tmp_path / "template.json"
+    template_path.write_text(json.dumps({"Resources": resources}))
+
+    c = CcValidator()
+    scanned = []
+
+    def run_validation(payload):
+        chunk = json.loads(payload["data"]["attributes"]["contents"])
+        scanned.append(list(chunk["Resources"]))
+
+        data = [
+            dict(entry, id=f"{entry['id']}:{logical_id}", attributes=dict(entry["attributes"], resource=logical_id))
+            for logical_id in chunk["Resources"]
+            for entry in conformity_report["data"]
+        ]
+
+        return {"data": iter(data)}
+
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    result = c.scan_template(str(template_path))
+    expected_result = c.get_results(conformity_report, output_file=None)
+
+    assert sorted(scanned) == [["Bucket0", "Bucket1"], ["Bucket2", "Bucket3"], ["Bucket4"]]
+    assert len(result.offending_entries) == len(expected_result) * 5
+    assert [entry["attributes"]["resource"] for entry in result.offending_entries] == sorted(
+        f"Bucket{i}" for i in range(5) for _ in expected_result
+    )
+
+
+def test_minify_template(caplog, monkeypatch):
+    """
+    GIVEN `minify_template` is called
+    WHEN `CC_MINIFY_TEMPLATE` is enabled
+    THEN return the template as compact JSON, without its comments
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_MINIFY_TEMPLATE", "enabled")
+    text = "# An S3 bucket\nResources:\n  MyS3Bucket:  # the bucket\n    Type: AWS::S3::Bucket\n"
+
+    c = CcValidator()
+    contents = c.minify_template(CfnTemplate(text, "template.yaml"))
+
+    assert contents == '{"Resources":{"MyS3Bucket":{"Type":"AWS::S3::Bucket"}}}'
+    assert f"from {len(text)} to {len(contents)} characters" in caplog.text
+
+    monkeypatch.setenv("CC_MINIFY_TEMPLATE", "disabled")
+    assert CcValidator().minify_template(CfnTemplate(text, "template.yaml")) == text
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_run_validation_compact_request(monkeypatch, compress):
+    """
+    GIVEN `run_validation` is called
+    WHEN `CC_COMPRESS_REQUESTS` is or isn't enabled
+    THEN send the payload as compact JSON, gzip compressed when enabled
+    """
+
+    if compress:
+        monkeypatch.setenv("CC_COMPRESS_REQUESTS", "enabled")
+
+    payload = CcValidator.generate_payload("Resources: {}")
+
+    with MockConformityServer(num_checks=1) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        CcValidator(use_cache=False).run_validation(payload)
+
+    request = server.requests[0]
+    body = gzip.decompress(request["body"]) if compress else request["body"]
+
+    assert body == json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    assert request["headers"].get("Content-Encoding") == ("gzip" if compress else None)
+
+
+def test_findings_index():
+    """
+    GIVEN check entries are added to a `FindingsIndex`
+    WHEN it is queried by risk level, rule, resource and category
+    THEN return the matching failing entries in the order they were added
+    """
+
+    entries = [make_check(i, resource=f"Bucket{i % 2}", failure_rate=1.0) for i in range(10)]
+    passing_entry = make_check(10, failure_rate=0.0)
+    index = FindingsIndex()
+
+    risk_level_nums = [index.add(entry) for entry in entries + [passing_entry]]
+
+    assert risk_level_nums == [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, None]
+    assert len(index) == 10 and index.passed == 1
+    assert index.select(risk_level="VERY_HIGH") == [entries[3], entries[4], entries[8], entries[9]]
+    assert index.select(risk_level="HIGH", resource="Bucket0") == [entries[2], entries[4], entries[8]]
+    assert index.select(rule_id="S3-007") == [entries[7]]
+    assert index.select(category="security", resource="Missing") == []
+    assert index.select() == entries
+
+    summary = index.summary()
+    assert summary["risk_levels"] == {"EXTREME": 2, "VERY_HIGH": 2, "HIGH": 2, "MEDIUM": 2, "LOW": 2}
+    assert summary["resources"] == {"Bucket0": 5, "Bucket1": 5}
+    assert summary["categories"] == {"security": 10}
+
+
+def test_findings_index_update():
+    """
+    GIVEN the indexes of several templates
+    WHEN they are combined with `update`
+    THEN query the combined entries as if they had been added to one index
+    """
+
+    first_index = FindingsIndex()
+    second_index = FindingsIndex()
+    entries = [make_check(i, failure_rate=1.0) for i in range(6)]
+
+    for entry in entries[:3]:
+        first_index.add(entry)
+
+    for entry in entries[3:]:
+        second_index.add(entry)
+
+    batch_index = FindingsIndex()
+    batch_index.update(first_index)
+    batch_index.update(second_index)
+
+    assert batch_index.select() == entries
+    assert batch_index.select(risk_level="HIGH") == [entries[2], entries[3], entries[4]]
+    assert batch_index.select(rule_id="S3-004") == [entries[4]]
+
+
+def test_scan_template_findings_index(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `scan_template` is called
+    WHEN the scan finds failing entries below the risk level threshold
+    THEN index every failing entry in the result, while only reporting the offending ones
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "HIGH")
+    monkeypatch.setattr(CcValidator, "run_validation", lambda self, payload: conformity_report)
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+
+    result = CcValidator().scan_template(str(template_path))
+    failing_entries = [entry for entry in conformity_report["data"] if entry["attributes"]["status"] != "SUCCESS"]
+
+    assert result.findings.select() == failing_entries
+    assert result.offending_entries == result.findings.select(risk_level="HIGH")
+    assert result.findings.passed == len(conformity_report["data"]) - len(failing_entries)
+
+
+def test_get_results_baseline(caplog, monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `get_results` is called
+    WHEN `CC_BASELINE_FILE` accepts findings by ID and by rule and resource
+    THEN don't report the accepted findings as offending
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    expected_result = CcValidator().get_results(conformity_report, output_file=None)
+    accepted_id = expected_result[0]["id"]
+    accepted_rule = expected_result[1]["relationships"]["rule"]["data"]["id"]
+    baseline_file = tmp_path / "baseline.json"
+    baseline_file.write_text(
+        json.dumps(
+            {
+                "ids": [accepted_id] + [f"ccc:AccountId:X-{i}" for i in range(50000)],
+                "rules": [{"rule": accepted_rule, "resource": "MyS3Bucket"}],
+            }
+        )
+    )
+    monkeypatch.setenv("CC_BASELINE_FILE", str(baseline_file))
+
+    result = CcValidator().get_results(conformity_report, output_file=None)
+
+    assert result == expected_result[2:]
+    assert "2 finding(s) were accepted in the baseline" in caplog.text
+
+
+def test_invalid_baseline_file(caplog, monkeypatch, tmp_path):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN `CC_BASELINE_FILE` can't be read
+    THEN exit with an error of 1
+    """
+
+    baseline_file = tmp_path / "baseline.json"
+    baseline_file.write_text("not json")
+    monkeypatch.setenv("CC_BASELINE_FILE", str(baseline_file))
+
+    with pytest.raises(SystemExit) as e:
+        CcValidator()
+
+    assert e.value.code == 1
+    assert "Unable to read the baseline file" in caplog.text
+
+
+def test_update_baseline(monkeypatch, tmp_path, template_tree, conformity_report):
+    """
+    GIVEN `update_baseline` is called while a baseline is set
+    WHEN the templates are scanned
+    THEN replace the baseline with every current offending entry, so a later batch run has none
+    """
+
+    baseline_file = tmp_path / "baseline.json"
+    Baseline(ids=["ccc:AccountId:Fixed"]).write(baseline_file)
+    monkeypatch.setenv("CC_BASELINE_FILE", str(baseline_file))
+    monkeypatch.setattr(CcValidator, "run_validation", lambda self, payload: conformity_report)
+
+    c = CcValidator(template_required=False)
+    c.update_baseline([str(template_tree)])
+    baseline = Baseline.load(baseline_file)
+    expected_ids = {entry["id"] for entry in c.get_results(conformity_report, output_file=None)}
+
+    assert baseline.ids == expected_ids
+
+    monkeypatch.chdir(tmp_path)
+
+    with pytest.raises(SystemExit) as e:
+        CcValidator(template_required=False).run_batch([str(template_tree)])
+
+    assert e.value.code is None
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "src")
+
+# the time `import scanner` may spend importing its dependencies, excluding compiling and running scanner itself
+STARTUP_IMPORT_BUDGET_US = 75000
+
+
+def run_importtime(args, env=None):
+    """Runs Python with `-X importtime`. Returns the cumulative and self import time of each module in microseconds."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], cwd=SRC_DIR, env=env, capture_output=True, text=True
+    )
+    import_times = {}
+
+    for line in output.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, cumulative_us, module = line[len("import time:") :].split("|")
+
+            if self_us.strip().isdigit():
+                import_times[module.strip()] = (int(cumulative_us), int(self_us))
+
+    return output, import_times
+
+
+def test_import_time():
+    """
+    GIVEN `scanner` is imported in a new interpreter
+    WHEN the import is timed with `-X importtime`
+    THEN don't import `requests`, `yaml` or the local rules, and stay within the startup budget
+    """
+
+    _, import_times = run_importtime(["-c", "import scanner"])
+    cumulative_us, self_us = import_times["scanner"]
+
+    assert not {"requests", "urllib3", "yaml", "local_rules", "argparse"} & set(import_times)
+    assert cumulative_us - self_us < STARTUP_IMPORT_BUDGET_US
+
+
+def test_missing_env_vars_fast_exit():
+    """
+    GIVEN `scanner.py` is run
+    WHEN a required env var is missing
+    THEN exit with an error of 1 before importing `requests` or `yaml`
+    """
+
+    env = {name: value for name, value in os.environ.items() if name != "CC_API_KEY"}
+    output, import_times = run_importtime(["scanner.py"], env=env)
+
+    assert output.returncode == 1
+    assert "Please ensure all environment variables are set" in output.stderr
+    assert not {"requests", "yaml"} & set(import_times)
+
+
+def test_region_selector(monkeypatch):
+    """
+    GIVEN a `RegionSelector`
+    WHEN requests to its regions succeed and fail
+    THEN choose the region with the lowest latency and error rate, trying failed regions again once they recover
+    """
+
+    now = [1000.0]
+    monkeypatch.setattr("scanner.time.monotonic", lambda: now[0])
+    selector = RegionSelector(["us-west-2", "eu-west-1", "ap-southeast-2"])
+
+    assert selector.choose() == "us-west-2"
+
+    selector.record("us-west-2", 0.4, ok=True)
+    selector.record("eu-west-1", 0.1, ok=True)
+    selector.record("ap-southeast-2", 0.2, ok=True)
+
+    assert selector.choose() == "eu-west-1"
+    assert selector.choose(exclude={"eu-west-1"}) == "ap-southeast-2"
+    assert selector.choose(exclude=set(selector.regions)) == "eu-west-1"
+
+    selector.record("eu-west-1", 0.1, ok=False)
+
+    assert selector.choose() == "ap-southeast-2"
+
+    now[0] += 600
+
+    assert selector.choose() == "eu-west-1"
+
+
+def test_region_selector_probe():
+    """
+    GIVEN `RegionSelector.probe` is called
+    WHEN one of the regions can't be reached
+    THEN record it as failed, so the reachable regions are preferred
+    """
+
+    import requests
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            if url.startswith("https://us-west-2"):
+                raise requests.ConnectionError("Connection refused")
+
+            return FakeResponse({})
+
+    selector = RegionSelector(["us-west-2", "eu-west-1"])
+    selector.probe(FakeSession())
+
+    assert selector.probed
+    assert selector.error_rate["us-west-2"] > 0 and selector.error_rate["eu-west-1"] == 0
+    assert selector.choose() == "eu-west-1"
+
+
+def test_run_validation_region_failover(caplog, monkeypatch, conformity_report):
+    """
+    GIVEN `run_validation` is called with `CC_FAILOVER_REGIONS` set
+    WHEN the request to `CC_REGION` fails to connect
+    THEN retry it straight away in the failover region, which is then preferred for later requests
+    """
+
+    import requests
+
+    monkeypatch.setenv("CC_FAILOVER_REGIONS", "eu-west-1")
+    c = CcValidator(use_cache=False)
+    urls = []
+
+    def post(url, **kwargs):
+        urls.append(url)
+
+        if url.startswith("https://us-west-2"):
+            raise requests.ConnectionError("Connection refused")
+
+        return FakeResponse(conformity_report)
+
+    # before any request has been timed, `CC_REGION` is preferred
+    c.region_selector.probed = True
+    monkeypatch.setattr(c.session, "post", post)
+    monkeypatch.setattr("scanner.time.sleep", lambda delay: pytest.fail("Failing over shouldn't wait"))
+
+    assert c.run_validation(c.generate_payload("Resources: {}")) == conformity_report
+    assert c.run_validation(c.generate_payload("Resources: {}")) == conformity_report
+    assert urls == [
+        "https://us-west-2-api.cloudconformity.com/v1/iac-scanning/scan",
+        "https://eu-west-1-api.cloudconformity.com/v1/iac-scanning/scan",
+        "https://eu-west-1-api.cloudconformity.com/v1/iac-scanning/scan",
+    ]
+    assert "Failing over to eu-west-1" in caplog.text
+
+
+def test_invalid_failover_region(caplog, monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN `CC_FAILOVER_REGIONS` lists a region which Conformity doesn't support
+    THEN exit with an error of 1
+    """
+
+    monkeypatch.setenv("CC_FAILOVER_REGIONS", "eu-west-1,mars-north-1")
+
+    with pytest.raises(SystemExit) as e:
+        CcValidator()
+
+    assert e.value.code == 1
+    assert "CC_FAILOVER_REGIONS" in caplog.text
+
+
+def test_parse_profiles():
+    """
+    GIVEN `parse_profiles` is called
+    WHEN `CC_PROFILE_ID` lists several profiles, some with their own risk level
+    THEN return every profile with its risk level, defaulting to `CC_RISK_LEVEL`
+    """
+
+    assert parse_profiles("", 1) == [("", 1)]
+    assert parse_profiles("prod:high, pci:Low ,dev", 1) == [("prod", 2), ("pci", 0), ("dev", 1)]
+
+    with pytest.raises(KeyError):
+        parse_profiles("prod:SEVERE", 1)
+
+
+def test_scan_template_profiles(caplog, monkeypatch, tmp_path):
+    """
+    GIVEN `scan_template` is called
+    WHEN `CC_PROFILE_ID` lists several profiles with different risk levels
+    THEN read the template once, scan it against every profile and combine their offending entries
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_PROFILE_ID", "prod:LOW,dev:HIGH")
+    payloads = []
+    reads = []
+
+    def run_validation(self, payload):
+        payloads.append(payload)
+        return {"data": [make_check(i, failure_rate=1.0) for i in range(5)]}
+
+    read_template_file = CcValidator.read_template_file
+    monkeypatch.setattr(CcValidator, "run_validation", run_validation)
+    monkeypatch.setattr(
+        CcValidator,
+        "read_template_file",
+        lambda self, location: reads.append(location) or read_template_file(self, location),
+    )
+
+    template_path = tmp_path / "template.yaml"
+    template_path.write_text("Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n")
+
+    result = CcValidator().scan_template(str(template_path))
+    profiles = [entry["attributes"]["profile-id"] for entry in result.offending_entries]
+
+    assert len(reads) == 1
+    assert sorted(payload["data"]["attributes"]["profileId"] for payload in payloads) == ["dev", "prod"]
+    # every check fails, one at each risk level, so only HIGH and above are offending with the "dev" profile
+    assert profiles == ["prod"] * 5 + ["dev"] * 3
+    assert len(result.findings.entries) == 10
+    assert result.fail_pipeline
+    assert 'offending entries found with profile "dev" (risk level HIGH)' in caplog.text
+
+
+def test_scan_templates_profiles_concurrency(monkeypatch, tmp_path, conformity_report):
+    """
+    GIVEN `scan_templates` is called with several profiles and CC_SPLIT_RESOURCES set
+    WHEN each template is scanned against every profile in chunks
+    THEN never have more than CC_MAX_CONCURRENCY requests in flight at once
+    """
+
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "2")
+    monkeypatch.setenv("CC_PROFILE_ID", "a,b")
+    monkeypatch.setenv("CC_SPLIT_RESOURCES", "1")
+    templates = []
+
+    for i in range(4):
+        template_path = tmp_path / f"template{i}.yaml"
+        template_path.write_text(
+            f"Resources:\n  MyS3Bucket{i}:\n    Type: AWS::S3::Bucket\n  MyQueue{i}:\n    Type: AWS::SQS::Queue\n"
+        )
+        templates.append(str(template_path))
+
+    c = CcValidator(template_required=False, use_cache=False)
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+    calls = []
+
+    def post(*args, **kwargs):
+        with lock:
+            calls.append(kwargs)
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+
+        time.sleep(0.02)
+
+        with lock:
+            in_flight[0] -= 1
+
+        return FakeResponse(conformity_report)
+
+    monkeypatch.setattr(c.session, "post", post)
+    c.scan_templates(templates)
+
+    assert len(calls) == 4 * 2 * 2
+    assert peak[0] == 2
+
+
+def test_single_profile_risk_level(monkeypatch):
+    """
+    GIVEN `get_results` is called
+    WHEN `CC_PROFILE_ID` is a single profile with its own risk level
+    THEN use the profile's risk level in place of `CC_RISK_LEVEL`, without tagging entries
+    """
+
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.setenv("CC_PROFILE_ID", "prod:VERY_HIGH")
+    findings = {"data": [make_check(i, failure_rate=1.0) for i in range(5)]}
+
+    result = CcValidator().get_results(findings, output_file=None)
+
+    assert [entry["attributes"]["risk-level"] for entry in result] == ["VERY_HIGH", "EXTREME"]
+    assert all("profile-id" not in entry["attributes"] for entry in result)
+
+
+@pytest.mark.parametrize(
+    "profile_ids, message",
+    [
+        ("prod:VERY_HIGH", 'The pipeline will fail if any "VERY_HIGH" level issues are found'),
+        ("prod:HIGH,dev", 'issues are found at each profile\'s risk level: "HIGH" for prod, "MEDIUM" for dev'),
+    ],
+)
+def test_profile_risk_levels_logged(caplog, monkeypatch, profile_ids, message):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN `CC_PROFILE_ID` sets the profiles' own risk levels
+    THEN log the risk level at which each profile fails the pipeline, rather than `CC_RISK_LEVEL`
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_RISK_LEVEL", "MEDIUM")
+    monkeypatch.setenv("CC_PROFILE_ID", profile_ids)
+
+    CcValidator()
+
+    assert message in caplog.text
+
+
+def test_invalid_profile_risk_level(caplog, monkeypatch):
+    """
+    GIVEN `CcValidator` is instantiated
+    WHEN a profile in `CC_PROFILE_ID` has an unknown risk level
+    THEN exit with an error of 1
+    """
+
+    monkeypatch.setenv("CC_PROFILE_ID", "prod:SEVERE")
+
+    with pytest.raises(SystemExit) as e:
+        CcValidator()
+
+    assert e.value.code == 1
+    assert "Unknown risk level" in caplog.text
+
+
+def test_get_nested_templates(tmp_path):
+    """
+    GIVEN `get_nested_templates` is called
+    WHEN a template has nested stacks with local, remote and intrinsic template URLs
+    THEN return the local templates, resolved relative to the template
+    """
+
+    template = {
+        "Resources": {
+            "Network": {"Type": "AWS::CloudFormation::Stack", "Properties": {"TemplateURL": "modules/network.yaml"}},
+            "Storage": {"Type": "AWS::CloudFormation::Stack", "Properties": {"TemplateURL": "file://../shared.json"}},
+            "Network2": {"Type": "AWS::CloudFormation::Stack", "Properties": {"TemplateURL": "modules/network.yaml"}},
+            "Remote": {
+                "Type": "AWS::CloudFormation::Stack",
+                "Properties": {"TemplateURL": "https://s3.amazonaws.com/bucket/stack.yaml"},
+            },
+            "Intrinsic": {"Type": "AWS::CloudFormation::Stack", "Properties": {"TemplateURL": {"Ref": "Url"}}},
+            "MyS3Bucket": {"Type": "AWS::S3::Bucket"},
+        }
+    }
+    cfn_template = CfnTemplate(json.dumps(template), str(tmp_path / "stacks" / "parent.json"))
+
+    assert get_nested_templates(cfn_template) == [
+        str(tmp_path / "stacks" / "modules" / "network.yaml"),
+        str(tmp_path / "shared.json"),
+    ]
+
+
+def test_get_descendants():
+    """
+    GIVEN `get_descendants` is called
+    WHEN the stack graph shares templates between parents and has a cycle
+    THEN return every template below the parent once
+    """
+
+    stack_graph = {"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": ["a"]}
+
+    assert sorted(get_descendants(stack_graph, "a")) == ["b", "c", "d"]
+    assert get_descendants(stack_graph, "x") == []
+
+
+def write_nested_stack_tree(tmp_path):
+    def stack(path):
+        return {"Type": "AWS::CloudFormation::Stack", "Properties": {"TemplateURL": path}}
+
+    templates = {
+        "app.json": {"Resources": {"AppBucket": {"Type": "AWS::S3::Bucket"}, "Shared": stack("modules/shared.json")}},
+        "api.json": {"Resources": {"Shared": stack("modules/shared.json"), "Missing": stack("modules/missing.json")}},
+        "modules/shared.json": {
+            "Resources": {"SharedBucket": {"Type": "AWS::S3::Bucket"}, "Inner": stack("inner.json")}
+        },
+        "modules/inner.json": {"Resources": {"InnerBucket": {"Type": "AWS::S3::Bucket"}}},
+    }
+
+    for name, template in templates.items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(json.dumps(template))
+
+    return str(tmp_path / "app.json"), str(tmp_path / "api.json")
+
+
+def test_scan_stack_graph(caplog, monkeypatch, tmp_path):
+    """
+    GIVEN `scan_templates` is called with `CC_NESTED_STACKS` enabled
+    WHEN several parents share a nested stack template
+    THEN scan every template once and add the nested templates' offending entries to each parent's result
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_NESTED_STACKS", "enabled")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    scanned_resources = []
+
+    def run_validation(self, payload):
+        resources = list(json.loads(payload["data"]["attributes"]["contents"])["Resources"])
+        scanned_resources.extend(resources)
+        return {"data": [make_check(0, resource=resource, failure_rate=1.0) for resource in resources]}
+
+    monkeypatch.setattr(CcValidator, "run_validation", run_validation)
+    app, api = write_nested_stack_tree(tmp_path)
+    shared = str(tmp_path / "modules" / "shared.json")
+    inner = str(tmp_path / "modules" / "inner.json")
+
+    results = CcValidator().scan_templates([api, app])
+
+    def resources(result):
+        return sorted(entry["attributes"]["resource"] for entry in result.offending_entries)
+
+    # the shared template and the template nested in it are only scanned once
+    assert sorted(scanned_resources) == [
+        "AppBucket",
+        "Inner",
+        "InnerBucket",
+        "Missing",
+        "Shared",
+        "Shared",
+        "SharedBucket",
+    ]
+    assert [result.template for result in results] == [api, app, shared, inner]
+    assert resources(results[0]) == ["Inner", "InnerBucket", "Missing", "Shared", "SharedBucket"]
+    assert resources(results[2]) == ["Inner", "InnerBucket", "SharedBucket"]
+    assert sorted(results[1].nested_templates) == sorted([shared, inner])
+    assert results[3].nested_templates == []
+    assert {entry["attributes"].get("nested-template") for entry in results[1].offending_entries} == {
+        None,
+        shared,
+        inner,
+    }
+    assert all(result.fail_pipeline for result in results)
+    # the nested template's own result isn't tagged
+    assert all("nested-template" not in entry["attributes"] for entry in results[3].offending_entries)
+    assert (
+        "Found 4 unique template(s) in the nested stack graph, 1 of them shared by more than one parent" in caplog.text
+    )
+    assert "Unable to find the nested stack template" in caplog.text
+
+
+def test_scan_changed_nested_template(monkeypatch, tmp_path):
+    """
+    GIVEN `scan_changed_templates` is called with `CC_NESTED_STACKS` enabled
+    WHEN only a nested stack template has changed
+    THEN only rescan the nested template, and add its new findings to every parent above it
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_NESTED_STACKS", "enabled")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    app, api = write_nested_stack_tree(tmp_path)
+    inner = str(tmp_path / "modules" / "inner.json")
+    templates = sorted([app, api])
+    scanned_resources = []
+
+    def run_validation(self, payload):
+        resources = list(json.loads(payload["data"]["attributes"]["contents"])["Resources"])
+        scanned_resources.extend(resources)
+        return {"data": [make_check(0, resource=resource, failure_rate=1.0) for resource in resources]}
+
+    monkeypatch.setattr(CcValidator, "run_validation", run_validation)
+    c = CcValidator(template_required=False)
+    c.open_journal()
+    c.scan_templates(templates)
+    c.close_journal()
+
+    with open(inner, "w") as f:
+        json.dump({"Resources": {"InnerQueue": {"Type": "AWS::SQS::Queue"}}}, f)
+
+    scanned_resources.clear()
+    c.open_journal(changed_files={os.path.abspath(inner)})
+    results = c.scan_changed_templates(templates)
+    c.close_journal()
+
+    assert scanned_resources == ["InnerQueue"]
+    assert [result.template for result in results][:2] == templates
+    nested_resources = {
+        entry["attributes"]["resource"]
+        for entry in results[1].offending_entries
+        if "nested-template" in entry["attributes"]
+    }
+    assert nested_resources == {"SharedBucket", "Inner", "InnerQueue"}
+
+
+def test_cfn_template_content_hash():
+    """
+    GIVEN `CfnTemplate.content_hash` is read
+    WHEN templates only differ in whitespace which can't change their findings
+    THEN return the same hash, while YAML indentation and other changes give a different one
+    """
+
+    json_template = CfnTemplate('{\n  "Resources": {\n    "A": {"Type": "AWS::S3::Bucket"}\n  }\n}\n', "a.json")
+    json_reindented = CfnTemplate(
+        '{\r\n    "Resources": {  \r\n\r\n "A": {"Type": "AWS::S3::Bucket"}\r\n}\r\n}', "b.json"
+    )
+    yaml_template = CfnTemplate("Resources:\n  A:\n    Type: AWS::S3::Bucket\n", "a.yaml")
+    yaml_trailing = CfnTemplate("Resources:  \r\n  A:\r\n    Type: AWS::S3::Bucket\r\n\r\n", "b.yaml")
+    yaml_reindented = CfnTemplate("Resources:\n    A:\n        Type: AWS::S3::Bucket\n", "c.yaml")
+
+    assert json_template.content_hash == json_reindented.content_hash
+    assert yaml_template.content_hash == yaml_trailing.content_hash
+    assert yaml_template.content_hash != yaml_reindented.content_hash
+    assert yaml_template.content_hash != CfnTemplate("Resources: {}\n", "d.yaml").content_hash
+
+
+@pytest.mark.parametrize("deduplicate, expected_requests", [("enabled", 2), ("disabled", 6)])
+def test_scan_templates_identical(caplog, monkeypatch, tmp_path, deduplicate, expected_requests):
+    """
+    GIVEN `scan_templates` is called
+    WHEN several templates have the same contents, apart from whitespace
+    THEN only scan each unique template once and share its result with every identical template
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("CC_DEDUPLICATE_TEMPLATES", deduplicate)
+    monkeypatch.setenv("CC_CACHE", "disabled")
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "4")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    contents = ["Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n"] * 3 + [
+        "Resources:  \r\n  MyS3Bucket:\r\n    Type: AWS::S3::Bucket\r\n\r\n",
+        "Resources:\n  MyS3Bucket:\n    Type: AWS::S3::Bucket\n\n",
+        "Resources:\n  OtherBucket:\n    Type: AWS::S3::Bucket\n",
+    ]
+    templates = []
+
+    for i, template_contents in enumerate(contents):
+        template_path = tmp_path / f"{['dev', 'stage', 'prod'][i % 3]}-{i}.yaml"
+        template_path.write_bytes(template_contents.encode("utf-8"))
+        templates.append(str(template_path))
+
+    with MockConformityServer(latency=0.05, num_checks=5, failure_rate=1.0) as server:
+        monkeypatch.setenv("CC_API_ENDPOINT", server.url)
+        results = CcValidator(template_required=False).scan_templates(templates)
+
+    assert len(server.requests) == expected_requests
+    assert [result.template for result in results] == templates
+    assert all(len(result.offending_entries) == 5 and result.fail_pipeline for result in results)
+    assert results[1].offending_entries is not results[0].offending_entries
+
+    if deduplicate == "enabled":
+        assert "4 of 6 template(s) were identical to another template and were not scanned again" in caplog.text
+
+
+def test_scan_journal(monkeypatch, tmp_path):
+    """
+    GIVEN a `ScanJournal` is written and then loaded
+    WHEN the run was interrupted while a record was being written
+    THEN sync records in groups, and load every complete record
+    """
+
+    synced = []
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+    journal_file = tmp_path / "journal.jsonl"
+    journal = ScanJournal(str(journal_file), sync_interval=3600, sync_records=2)
+
+    for i in range(3):
+        result = ScanResult(template=f"template-{i}.yaml")
+        result.findings.add(make_check(i, failure_rate=1.0))
+        journal.append(result, f"hash-{i}")
+
+    assert len(synced) == 1
+    journal.close()
+    assert len(synced) == 2
+
+    with open(journal_file, "a") as f:
+        f.write('{"template": "template-3.yaml", "hash": "ha')
+
+    resumed = ScanJournal(str(journal_file), resume=True)
+    resumed.close()
+
+    assert sorted(resumed.completed) == [os.path.abspath(f"template-{i}.yaml") for i in range(3)]
+    assert resumed.get("template-1.yaml", "hash-1")["entries"] == [make_check(1, failure_rate=1.0)]
+    assert resumed.get("template-1.yaml", "changed") is None
+
+
+def test_run_batch_resume(caplog, monkeypatch, tmp_path, template_tree):
+    """
+    GIVEN `run_batch` is called with `resume`
+    WHEN an earlier run was interrupted after scanning some of the templates
+    THEN only scan the templates which weren't journalled or have changed since, and report every template's findings
+    """
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "1")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.setenv("CC_CACHE", "disabled")
+    templates = find_templates(["app", "network"])
+    scanned = []
+
+    def run_validation(payload):
+        if len(scanned) == 2:
+            raise SystemExit(1)
+
+        contents = payload["data"]["attributes"]["contents"]
+        scanned.append(contents)
+        return {"data": [make_check(0, resource=contents.split()[-1], failure_rate=1.0)]}
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit):
+        c.run_batch(["app", "network"])
+
+    assert len(ScanJournal.load("findings.journal.jsonl")) == 2
+
+    # the first template changes before the run is resumed, so it's scanned again
+    with open(templates[0], "a") as f:
+        f.write("  MyOtherBucket:\n    Type: AWS::S3::Bucket\n")
+
+    scanned.clear()
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"], resume=True)
+
+    assert e.value.code == 1
+    assert len(scanned) == 2
+    assert "Reusing the journalled scan of unchanged template" in caplog.text
+    with open("findings.json") as f:
+        findings = json.load(f)
+
+    assert {template: len(entries) for template, entries in findings.items()} == {template: 1 for template in templates}
+    assert len(ScanJournal.load("findings.journal.jsonl")) == 3
+
+
+def test_run_batch_resume_settings(caplog, monkeypatch, tmp_path, template_tree):
+    """
+    GIVEN `run_batch` is called with `resume`
+    WHEN the interrupted run was scanned with a different CC_PROFILE_ID
+    THEN scan every template again, so `findings.json` never mixes the findings of both profiles
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CC_MAX_CONCURRENCY", "1")
+    monkeypatch.setenv("CC_RISK_LEVEL", "LOW")
+    monkeypatch.setenv("CC_CACHE", "disabled")
+    monkeypatch.setenv("CC_PROFILE_ID", "a")
+    scanned = []
+
+    def run_validation(payload):
+        cc_profile_id = payload["data"]["attributes"]["profileId"]
+        scanned.append(cc_profile_id)
+        return {"data": [make_check(0, resource=cc_profile_id, failure_rate=1.0)]}
+
+    def interrupted_run_validation(payload):
+        if len(scanned) == 2:
+            raise SystemExit(1)
+
+        return run_validation(payload)
+
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", interrupted_run_validation)
+
+    with pytest.raises(SystemExit):
+        c.run_batch(["app", "network"])
+
+    monkeypatch.setenv("CC_PROFILE_ID", "b")
+    c = CcValidator(template_required=False)
+    monkeypatch.setattr(c, "run_validation", run_validation)
+
+    with pytest.raises(SystemExit) as e:
+        c.run_batch(["app", "network"], resume=True)
+
+    with open("findings.json") as f:
+        findings = json.load(f)
+
+    assert e.value.code == 1
+    assert scanned == ["a", "a", "b", "b", "b"]
+    assert "were scanned with different settings" in caplog.text
+    assert [entry["attributes"]["resource"] for entries in findings.values() for entry in entries] == ["b"] * 3